@@ -1,6 +1,6 @@
 import numpy as np
 from datetime import datetime, timedelta
-from db import get_daily_summaries, get_intraday_metrics, DatabaseManager
+from db import get_daily_summaries, get_intraday_metrics, get_intraday_rollup, DatabaseManager
 import json
 
 def check_activity_drop(user_id, current_date):
@@ -549,10 +549,10 @@ def check_intraday_activity_drop(user_id, current_date):
     - Evaluación de la capacidad funcional
     - Adaptación del entorno para favorecer la movilidad segura
     """
-    # Obtener datos intradía de pasos para el día
+    # Obtener los pasos por hora del día (agregado continuo horario: suma de cada hora)
     start_time = current_date.replace(hour=0, minute=0, second=0, microsecond=0)
     end_time = start_time + timedelta(days=1)
-    steps_data = get_intraday_metrics(user_id, 'steps', start_time, end_time)
+    steps_data = [(row[0], row[4]) for row in get_intraday_rollup(user_id, 'steps', start_time, end_time, 60)]
     if not steps_data or len(steps_data) < 12:  # Al menos 12 intervalos (ej: cada 2h)
         return False
     # Buscar intervalos largos (>=2h) con 0 pasos
@@ -1,11 +1,22 @@
 from logging.handlers import RotatingFileHandler
-from flask import Flask, logging, render_template, request, redirect, session, url_for, flash, g, jsonify, Response
+from flask import Flask, logging, render_template, request, redirect, session, url_for, flash, g, jsonify, Response, stream_with_context, send_file
 from rich import _console
 from auth import generate_state, get_tokens, generate_code_verifier, generate_code_challenge, generate_auth_url
-from db import DatabaseManager, get_daily_summaries, get_user_alerts, get_user_id_by_email
+from db import DatabaseManager, get_daily_summaries, get_user_alerts, get_user_id_by_email, build_intraday_export_query, get_user_data_version, intraday_rollup_query, intraday_source, packed_intraday_query, expand_packed_intraday, merge_intraday_points
 from config import CLIENT_ID, REDIRECT_URI
 from translations import TRANSLATIONS
+from jobs import job_runner
+from work_queue import enqueue_device_backfill
+from research_export import EXPORT_TABLES
+from downsampling import lttb
+from chart_encoding import negotiate_format, columnar_payload, FORMAT_ROWS, COLUMNAR_MIMETYPE
+from compression import init_compression
 import os
+import csv
+import json
+import hashlib
+from functools import wraps
+from io import StringIO
 from flask_login import current_user, login_user, logout_user, login_required
 from flask_login import LoginManager, UserMixin
 import logging
@@ -70,6 +81,9 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'  # Ruta para el inicio de sesión
 
+# Compresión gzip/brotli de las respuestas JSON y CSV
+init_compression(app)
+
 
 if FLASK_ENV == 'production':
     # Modo producción: usar IP pública y HTTPS
@@ -168,11 +182,11 @@ def preload_dashboard():
             """)
             
             # Get the latest intraday metrics for each user
-            intraday_metrics = db.execute_query("""
+            intraday_metrics = db.execute_query(f"""
                 SELECT u.name, u.email, i.type, i.value, i.time
                 FROM users u
-                LEFT JOIN intraday_metrics i ON u.id = i.user_id
-                WHERE i.time = (SELECT MAX(time) FROM intraday_metrics WHERE user_id = u.id AND type = i.type)
+                LEFT JOIN {intraday_source('i')} ON u.id = i.user_id
+                WHERE i.time = (SELECT MAX(time) FROM {intraday_source()} WHERE user_id = u.id AND type = i.type)
                 OR i.time IS NULL
                 ORDER BY i.time DESC NULLS LAST
             """)
@@ -276,24 +290,10 @@ def home():
         try:
             # Get recent users with their latest activity (only users with names AND valid tokens)
             recent_users = db.execute_query("""
-                WITH LastUserInstance AS (
-                    SELECT 
-                        email,
-                        MAX(created_at) as last_created
-                    FROM users
-                    GROUP BY email
-                )
-                SELECT u.id, u.name, u.email, 
-                       MAX(d.date) as created_at
-                FROM users u
-                LEFT JOIN daily_summaries d ON u.id = d.user_id
-                INNER JOIN LastUserInstance lui ON u.email = lui.email 
-                    AND u.created_at = lui.last_created
-                WHERE u.name != '' 
-                    AND u.access_token IS NOT NULL 
-                    AND u.refresh_token IS NOT NULL
-                GROUP BY u.id, u.name, u.email
-                ORDER BY created_at DESC NULLS LAST
+                SELECT user_id, name, email, last_update
+                FROM user_status
+                WHERE status = 'active'
+                ORDER BY last_update DESC NULLS LAST
                 LIMIT 10
             """)
             
@@ -330,73 +330,22 @@ def user_stats():
     db = DatabaseManager()
     if db.connect():
         try:
-            # Obtener todos los usuarios con información relevante
+            # Obtener todos los usuarios con su estado (tabla user_status, ver db.user_status_refresh_query)
+            query = """
+                SELECT user_id, name, email, created_at, has_tokens, last_update, has_data, is_latest, status
+                FROM user_status
+            """
+            params = ()
             if search:
-                users = db.execute_query("""
-                    WITH UserInstances AS (
-                        SELECT 
-                            u.id,
-                            u.name,
-                            u.email,
-                            u.created_at,
-                            u.access_token IS NOT NULL AND u.refresh_token IS NOT NULL as has_tokens,
-                            (SELECT MAX(date) FROM daily_summaries d WHERE d.user_id = u.id) as last_update,
-                            EXISTS(SELECT 1 FROM daily_summaries d WHERE d.user_id = u.id) as has_data,
-                            ROW_NUMBER() OVER (PARTITION BY u.email ORDER BY u.created_at DESC) as rn
-                        FROM users u
-                        WHERE LOWER(u.name) LIKE LOWER(%s) OR LOWER(u.email) LIKE LOWER(%s)
-                    )
-                    SELECT *
-                    FROM UserInstances
-                    ORDER BY email, created_at DESC
-                """, (f"%{search}%", f"%{search}%"))
-            else:
-                users = db.execute_query("""
-                    WITH UserInstances AS (
-                        SELECT 
-                            u.id,
-                            u.name,
-                            u.email,
-                            u.created_at,
-                            u.access_token IS NOT NULL AND u.refresh_token IS NOT NULL as has_tokens,
-                            (SELECT MAX(date) FROM daily_summaries d WHERE d.user_id = u.id) as last_update,
-                            EXISTS(SELECT 1 FROM daily_summaries d WHERE d.user_id = u.id) as has_data,
-                            ROW_NUMBER() OVER (PARTITION BY u.email ORDER BY u.created_at DESC) as rn
-                        FROM users u
-                    )
-                    SELECT *
-                    FROM UserInstances
-                    ORDER BY email, created_at DESC
-                """)
+                query += " WHERE LOWER(name) LIKE LOWER(%s) OR LOWER(email) LIKE LOWER(%s)"
+                params = (f"%{search}%", f"%{search}%")
+            users = db.execute_query(query + " ORDER BY email, created_at DESC", params)
 
             # Procesar los usuarios
             processed_users = []
-            current_email = None
             
             for user in users:
-                user_id, name, email, created_at, has_tokens, last_update, has_data, row_num = user
-                
-                # Es la instancia más reciente si row_num = 1
-                is_latest = (row_num == 1)
-                
-                # Si cambiamos de email o es el primer usuario
-                if email != current_email:
-                    current_email = email
-                
-                # Determinar el estado del usuario
-                if is_latest:
-                    if not name:
-                        # Si no tiene nombre, está sin asignar
-                        status = 'unassigned'
-                    elif not has_tokens:
-                        # Si tiene nombre pero no tokens, está desvinculado
-                        status = 'unlinked'
-                    elif has_tokens and name:
-                        # Si tiene nombre y tokens, está activo
-                        status = 'active'
-                else:
-                    # Las instancias anteriores son históricas si tienen nombre y datos
-                    status = 'historical'
+                user_id, name, email, created_at, has_tokens, last_update, has_data, is_latest, status = user
 
                 # Añadir el usuario si:
                 # 1. Es la instancia más reciente, O
@@ -502,6 +451,18 @@ def assign_user():
 
     return render_template('assign_user.html')
 
+def schedule_device_backfill(email):
+    """
+    Queue the initial high-priority backfill of a newly linked device so the
+    ingestion workers fetch its recent history in parallel right away.
+    """
+    try:
+        job_ids = enqueue_device_backfill(email)
+        app.logger.info(f"Relleno inicial encolado para {email}: {len(job_ids)} trabajos")
+    except Exception as e:
+        # The device is already linked; the regular backfill will pick it up later
+        app.logger.error(f"No se pudo encolar el relleno inicial para {email}: {e}")
+
 @app.route('/livelyageing/callback')
 @login_required
 def callback():
@@ -593,6 +554,9 @@ def callback():
                         flash("Error: Se requiere un nombre de usuario para vincular un nuevo correo.", "danger")
                         return redirect(url_for('assign_user'))
 
+                # Fetch the new user's history now instead of waiting for the backfill
+                schedule_device_backfill(email)
+
                 # Clear the session data
                 session.pop('pending_email', None)
                 session.pop('new_user_name', None)
@@ -659,6 +623,7 @@ def reassign_device():
                     # If tokens are valid, proceed to add the new user without reauthorization
                     db.add_user(new_user_name, email, existing_access_token, existing_refresh_token)
                     app.logger.info(f"Device reassigned to {new_user_name} ({email}) without reauthorization.")
+                    schedule_device_backfill(email)
                     return render_template('confirmation.html', user_name=new_user_name, email=email)
             else:
                 app.logger.error(f"Email {email} is not in use.")
@@ -751,33 +716,42 @@ def change_language():
 @login_required
 def refresh_data():
     """
-    Refresh Fitbit data for all users.
+    Encola un refresco de datos de Fitbit en segundo plano.
+
+    Acepta opcionalmente un 'email' (formulario o JSON) para refrescar un único
+    usuario; sin él se refrescan todos. Devuelve el id del trabajo de inmediato.
     """
     try:
-        # Get all unique emails from the database
-        db = DatabaseManager()
-        if not db.connect():
-            return jsonify({'error': 'Database connection error'}), 500
-            
-        try:
-            emails = db.execute_query("SELECT DISTINCT email FROM users")
-        finally:
-            db.close()
+        payload = request.get_json(silent=True) or {}
+        email = (request.form.get('email') or payload.get('email') or '').strip() or None
 
-        # Process each email to fetch new data
-        from fitbit import process_emails
-        from fitbit_intraday import process_emails as process_intraday_emails
-        
-        # Process daily data
-        process_emails(emails)
-        # Process intraday data
-        process_intraday_emails(emails)
-        
-        return jsonify({'success': True})
+        job, created = job_runner.submit_refresh(email)
+        app.logger.info(f"Refresco {'encolado' if created else 'ya en curso'}: job={job.id} email={email or '*'}")
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'deduplicated': not created,
+            'status_url': url_for('refresh_status', job_id=job.id)
+        }), 202
     except Exception as e:
         app.logger.error(f"Error refreshing data: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/livelyageing/refresh_data/<job_id>')
+@login_required
+def refresh_status(job_id):
+    """
+    Devuelve el estado y los contadores de progreso de un trabajo de refresco.
+
+    La página la consulta periódicamente mientras el trabajo está activo: cada
+    consulta termina al instante, en lugar de mantener ocupado un worker síncrono
+    durante todo el refresco como haría un stream abierto.
+    """
+    job = job_runner.get(job_id)
+    if not job:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(job.to_dict())
+
 @app.route('/livelyageing/api/daily_summary')
 @login_required
 def get_daily_summary():
@@ -1033,9 +1007,9 @@ def alerts_dashboard():
                         start_time = alert[1] - timedelta(hours=24)
                         end_time = alert[1]
                         app.logger.info(f"Alerta {alert[0]}: buscando datos intradía de {intraday_metric_type} para user_id={alert[2]} entre {start_time} y {end_time}")
-                        intraday_metrics = db.execute_query("""
+                        intraday_metrics = db.execute_query(f"""
                             SELECT time, value 
-                            FROM intraday_metrics 
+                            FROM {intraday_source()} 
                             WHERE user_id = %s 
                             AND type = %s 
                             AND time BETWEEN %s AND %s 
@@ -1238,10 +1212,11 @@ def acknowledge_alert(alert_id):
             if result[0][0]:
                 return jsonify({'success': False, 'error': 'La alerta ya está reconocida'}), 400
                 
-            # Actualizar solo el campo acknowledged
+            # Marcar como reconocida guardando el momento (cambia la versión de datos del usuario)
             db.execute_query("""
                 UPDATE alerts 
-                SET acknowledged = TRUE
+                SET acknowledged = TRUE,
+                    acknowledged_at = NOW()
                 WHERE id = %s
             """, [alert_id])
                 
@@ -1355,8 +1330,102 @@ def user_detail(user_id):
     finally:
         db.close()
 
+def conditional_user_api(view):
+    """
+    Añade GET condicional (ETag / Last-Modified) a una API por usuario.
+
+    El ETag se calcula a partir de la versión de los datos del usuario
+    (db.get_user_data_version), el día actual (las ventanas de 7 días se desplazan)
+    y la representación pedida (ruta, parámetros y formato). Si el cliente ya
+    tiene esa versión se responde 304 sin ejecutar las consultas de la vista.
+    """
+    @wraps(view)
+    def wrapper(user_id, *args, **kwargs):
+        version = get_user_data_version(user_id)
+        if version is None:
+            return view(user_id, *args, **kwargs)
+
+        today = datetime.now().date()
+        etag = hashlib.sha1(
+            f"{version}|{today}|{request.full_path}|{negotiate_format(request)}".encode()
+        ).hexdigest()
+        # Instantes de la versión (last_alert_id es un id, no una fecha)
+        timestamps = [v for v in (version.intraday_time, version.packed_updated_at,
+                                  version.summary_updated_at, version.last_acknowledged_at)
+                      if v is not None]
+        timestamps.append(datetime.combine(today, time.min).astimezone(timezone.utc))
+        last_modified = max(t.astimezone(timezone.utc) for t in timestamps).replace(microsecond=0)
+
+        # If-None-Match tiene prioridad; If-Modified-Since solo se usa si no viene ETag
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = bool(request.if_modified_since and request.if_modified_since >= last_modified)
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = app.make_response(view(user_id, *args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_modified
+        # El navegador guarda la respuesta pero debe revalidarla siempre
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+def chart_response(payload, fmt):
+    """Respuesta JSON; con la codificación columnar se usa su tipo MIME."""
+    response = jsonify(payload)
+    if fmt != FORMAT_ROWS:
+        response.mimetype = COLUMNAR_MIMETYPE
+    return response
+
+def fetch_user_daily_summary(db, user_id, date):
+    """
+    Obtiene el resumen diario de un usuario para una fecha como diccionario (o None).
+    """
+    summary = db.execute_query(
+        """
+        SELECT 
+            date,
+            steps,
+            heart_rate,
+            sleep_minutes,
+            calories,
+            distance,
+            floors,
+            elevation,
+            active_minutes,
+            sedentary_minutes,
+            nutrition_calories,
+            water,
+            weight,
+            bmi,
+            fat,
+            oxygen_saturation,
+            respiratory_rate,
+            temperature
+        FROM daily_summaries 
+        WHERE user_id = %s AND date = %s
+        """, (user_id, date)
+    )
+    if not summary:
+        return None
+    # Mapear los campos a nombres legibles
+    columns = [desc[0] for desc in db.cursor.description]
+    summary_dict = dict(zip(columns, summary[0]))
+    # Calcular valores adicionales
+    if summary_dict.get('sleep_minutes'):
+        summary_dict['sleep_hours'] = round(summary_dict['sleep_minutes'] / 60, 1)
+    if summary_dict.get('sedentary_minutes'):
+        summary_dict['sedentary_hours'] = round(summary_dict['sedentary_minutes'] / 60, 1)
+    return summary_dict
+
 @app.route('/livelyageing/api/user/<int:user_id>/daily_summary')
 @login_required
+@conditional_user_api
 def api_user_daily_summary(user_id):
     """
     Devuelve el resumen diario para un usuario y una fecha (por defecto hoy).
@@ -1373,360 +1442,549 @@ def api_user_daily_summary(user_id):
     if not db.connect():
         return jsonify({'error': 'DB error'}), 500
     try:
-        summary = db.execute_query(
-            """
-            SELECT 
-                date,
-                steps,
-                heart_rate,
-                sleep_minutes,
-                calories,
-                distance,
-                floors,
-                elevation,
-                active_minutes,
-                sedentary_minutes,
-                nutrition_calories,
-                water,
-                weight,
-                bmi,
-                fat,
-                oxygen_saturation,
-                respiratory_rate,
-                temperature
-            FROM daily_summaries 
-            WHERE user_id = %s AND date = %s
-            """, (user_id, date)
-        )
-        if not summary:
+        summary_dict = fetch_user_daily_summary(db, user_id, date)
+        if not summary_dict:
             return jsonify({'error': 'No hay datos para ese día'}), 404
-        # Mapear los campos a nombres legibles
-        columns = [desc[0] for desc in db.cursor.description]
-        summary_dict = dict(zip(columns, summary[0]))
-        # Calcular valores adicionales
-        if summary_dict.get('sleep_minutes'):
-            summary_dict['sleep_hours'] = round(summary_dict['sleep_minutes'] / 60, 1)
-        if summary_dict.get('sedentary_minutes'):
-            summary_dict['sedentary_hours'] = round(summary_dict['sedentary_minutes'] / 60, 1)
         return jsonify({'summary': summary_dict})
     finally:
         db.close()
 
-@app.route('/livelyageing/api/user/<int:user_id>/intraday')
-@login_required
-def api_user_intraday(user_id):
+# Máximo número de días que se pueden pedir de una vez a la API intradía
+MAX_INTRADAY_RANGE_DAYS = 31
+
+def parse_intraday_args(args, default_type=None):
     """
-    Devuelve los datos intradía para un usuario, fecha y tipo de métrica.
+    Valida los parámetros de la API intradía.
+
+    Returns:
+        tuple: (metric_type, start_date, end_date, points, bucket)
+
+    Raises:
+        ValueError: Con el mensaje de error para el cliente.
     """
-    date_str = request.args.get('date')
-    metric_type = request.args.get('type')
+    metric_type = args.get('type') or default_type
     if not metric_type:
-        return jsonify({'error': 'Falta el tipo de métrica'}), 400
-    if date_str:
-        try:
-            date = datetime.strptime(date_str, "%Y-%m-%d").date()
-        except Exception:
-            return jsonify({'error': 'Formato de fecha inválido'}), 400
-    else:
-        date = datetime.now().date()
-    db = DatabaseManager()
-    if not db.connect():
-        return jsonify({'error': 'DB error'}), 500
+        raise ValueError('Falta el tipo de métrica')
     try:
-        start_time = datetime.combine(date, datetime.min.time())
-        end_time = datetime.combine(date, datetime.max.time())
+        start_str = args.get('start') or args.get('date')
+        start_date = datetime.strptime(start_str, "%Y-%m-%d").date() if start_str else datetime.now().date()
+        end_str = args.get('end')
+        end_date = datetime.strptime(end_str, "%Y-%m-%d").date() if end_str else start_date
+    except Exception:
+        raise ValueError('Formato de fecha inválido')
+    if end_date < start_date or (end_date - start_date).days >= MAX_INTRADAY_RANGE_DAYS:
+        raise ValueError(f'El rango debe estar entre 1 y {MAX_INTRADAY_RANGE_DAYS} días')
+    points = args.get('points', type=int)
+    bucket = args.get('bucket', type=int)
+    if (points is not None and points < 3) or (bucket is not None and bucket < 1):
+        raise ValueError('points debe ser >= 3 y bucket >= 1 minuto')
+    return metric_type, start_date, end_date, points, bucket
+
+def fetch_user_intraday(db, user_id, metric_type, start_date, end_date, points=None, bucket=None):
+    """
+    Obtiene la serie intradía de un usuario, agregada por cubos y/o reducida con LTTB.
+
+    Returns:
+        tuple: (filas, número de puntos antes de reducir)
+    """
+    start_time = datetime.combine(start_date, datetime.min.time())
+    end_time = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+    if bucket:
+        # Cubos de horas o días se leen de los agregados continuos
+        data = db.execute_query(*intraday_rollup_query(user_id, metric_type, start_time, end_time, bucket))
+    else:
         data = db.execute_query(
-            """
+            f"""
             SELECT time, value 
-            FROM intraday_metrics 
+            FROM {intraday_source()} 
             WHERE user_id = %s 
             AND type = %s 
-            AND time BETWEEN %s AND %s 
+            AND time >= %s AND time < %s 
             ORDER BY time
             """, (user_id, metric_type, start_time, end_time)
         )
-        return jsonify({
-            'intraday': [
-                {
-                    'time': row[0].strftime('%H:%M'),
-                    'value': float(row[1])
-                } for row in data
-            ]
-        })
+        # Series de alta resolución guardadas por día en intraday_packed
+        packed = db.execute_query(*packed_intraday_query(user_id, metric_type, start_time, end_time))
+        data = merge_intraday_points(data, expand_packed_intraday(packed, start_time, end_time, include_end=False))
+    data = data or []
+    total_points = len(data)
+    if points and total_points > points:
+        selected = lttb([row[0].timestamp() for row in data], [row[1] for row in data], points)
+        data = [data[i] for i in selected]
+    return data, total_points
+
+def intraday_payload(data, total_points, start_date, end_date, bucket, fmt):
+    """Construye el cuerpo de la respuesta intradía en el formato pedido."""
+    extra = {
+        'total_points': total_points,
+        'start': start_date.isoformat(),
+        'end': end_date.isoformat()
+    }
+    if fmt != FORMAT_ROWS:
+        columns = {'value': [float(row[1]) for row in data]}
+        if bucket:
+            columns['min'] = [float(row[2]) for row in data]
+            columns['max'] = [float(row[3]) for row in data]
+        payload = columnar_payload([row[0] for row in data], columns, numeric=columns, fmt=fmt)
+        payload.update(extra)
+        return payload
+
+    time_format = '%H:%M' if start_date == end_date else '%Y-%m-%d %H:%M'
+    if bucket:
+        intraday = [
+            {
+                'time': row[0].strftime(time_format),
+                'value': float(row[1]),
+                'min': float(row[2]),
+                'max': float(row[3])
+            } for row in data
+        ]
+    else:
+        intraday = [
+            {
+                'time': row[0].strftime(time_format),
+                'value': float(row[1])
+            } for row in data
+        ]
+    return {'intraday': intraday, **extra}
+
+@app.route('/livelyageing/api/user/<int:user_id>/intraday')
+@login_required
+@conditional_user_api
+def api_user_intraday(user_id):
+    """
+    Devuelve los datos intradía para un usuario, rango de fechas y tipo de métrica.
+
+    Parámetros:
+        type: tipo de métrica (obligatorio).
+        date: día a consultar (por defecto hoy), o start/end (YYYY-MM-DD) para varios días.
+        bucket: ancho de cubo en minutos; se agrega en SQL (con los agregados
+            continuos si es múltiplo de una hora) y cada punto incluye la media
+            (value), el mínimo y el máximo del cubo.
+        points: número máximo de puntos; la serie se reduce con LTTB conservando
+            picos y valles.
+        format: 'columnar' o 'f32' para la codificación compacta (ver chart_encoding).
+    """
+    try:
+        metric_type, start_date, end_date, points, bucket = parse_intraday_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    fmt = negotiate_format(request)
+
+    db = DatabaseManager()
+    if not db.connect():
+        return jsonify({'error': 'DB error'}), 500
+    try:
+        data, total_points = fetch_user_intraday(db, user_id, metric_type, start_date, end_date, points, bucket)
+        return chart_response(intraday_payload(data, total_points, start_date, end_date, bucket, fmt), fmt)
     finally:
         db.close()
 
+# Columnas de la API semanal, en el orden de la consulta (tras la fecha)
+WEEKLY_COLUMNS = ['steps', 'heart_rate', 'sleep_hours', 'calories', 'sedentary_hours', 'active_minutes',
+                  'distance', 'floors', 'elevation', 'nutrition_calories', 'water', 'weight', 'bmi',
+                  'fat', 'oxygen_saturation', 'respiratory_rate', 'temperature']
+
+def fetch_user_weekly_summary(db, user_id):
+    """
+    Obtiene los resúmenes diarios de los últimos 7 días, del más reciente al más antiguo.
+    """
+    end_date = datetime.now().date()
+    start_date = end_date - timedelta(days=6)
+    data = db.execute_query(
+        """
+        SELECT 
+            date,
+            steps,
+            heart_rate,
+            sleep_minutes,
+            calories,
+            sedentary_minutes,
+            active_minutes,
+            distance,
+            floors,
+            elevation,
+            nutrition_calories,
+            water,
+            weight,
+            bmi,
+            fat,
+            oxygen_saturation,
+            respiratory_rate,
+            temperature
+        FROM daily_summaries 
+        WHERE user_id = %s 
+        AND date BETWEEN %s AND %s 
+        ORDER BY date DESC
+        """, (user_id, start_date, end_date)
+    )
+    return data or []
+
+def weekly_payload(data, fmt):
+    """Construye el cuerpo de la respuesta semanal en el formato pedido."""
+    rows = []
+    for row in data:
+        values = list(row[1:])
+        values[2] = round(row[3] / 60, 1) if row[3] else None
+        values[4] = round(row[5] / 60, 1) if row[5] else None
+        rows.append(values)
+    if fmt != FORMAT_ROWS:
+        columns = {name: [values[i] for values in rows] for i, name in enumerate(WEEKLY_COLUMNS)}
+        return columnar_payload([row[0] for row in data], columns, numeric=WEEKLY_COLUMNS, fmt=fmt)
+    return {
+        'weekly': [
+            {'date': row[0].strftime('%d/%m'), **dict(zip(WEEKLY_COLUMNS, values))}
+            for row, values in zip(data, rows)
+        ]
+    }
+
 @app.route('/livelyageing/api/user/<int:user_id>/weekly_summary')
 @login_required
+@conditional_user_api
 def api_user_weekly_summary(user_id):
     """
     Devuelve los resúmenes diarios de los últimos 7 días para el usuario.
     """
+    fmt = negotiate_format(request)
     db = DatabaseManager()
     if not db.connect():
         return jsonify({'error': 'DB error'}), 500
     try:
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=6)
-        data = db.execute_query(
-            """
-            SELECT 
-                date,
-                steps,
-                heart_rate,
-                sleep_minutes,
-                calories,
-                sedentary_minutes,
-                active_minutes,
-                distance,
-                floors,
-                elevation,
-                nutrition_calories,
-                water,
-                weight,
-                bmi,
-                fat,
-                oxygen_saturation,
-                respiratory_rate,
-                temperature
-            FROM daily_summaries 
-            WHERE user_id = %s 
-            AND date BETWEEN %s AND %s 
-            ORDER BY date DESC
-            """, (user_id, start_date, end_date)
-        )
-        return jsonify({
-            'weekly': [
-                {
-                    'date': row[0].strftime('%d/%m'),
-                    'steps': row[1],
-                    'heart_rate': row[2],
-                    'sleep_hours': round(row[3] / 60, 1) if row[3] else None,
-                    'calories': row[4],
-                    'sedentary_hours': round(row[5] / 60, 1) if row[5] else None,
-                    'active_minutes': row[6],
-                    'distance': row[7],
-                    'floors': row[8],
-                    'elevation': row[9],
-                    'nutrition_calories': row[10],
-                    'water': row[11],
-                    'weight': row[12],
-                    'bmi': row[13],
-                    'fat': row[14],
-                    'oxygen_saturation': row[15],
-                    'respiratory_rate': row[16],
-                    'temperature': row[17]
-                } for row in data
-            ]
-        })
+        return chart_response(weekly_payload(fetch_user_weekly_summary(db, user_id), fmt), fmt)
     finally:
         db.close()
 
+def fetch_user_recent_alerts(db, user_id):
+    """
+    Obtiene las alertas de los últimos 7 días de un usuario, de la más reciente a la más antigua.
+    """
+    since = datetime.now() - timedelta(days=7)
+    data = db.execute_query(
+        """
+        SELECT 
+            alert_time,
+            alert_type,
+            priority,
+            triggering_value,
+            threshold_value,
+            details,
+            acknowledged
+        FROM alerts 
+        WHERE user_id = %s 
+        AND alert_time >= %s 
+        ORDER BY alert_time DESC
+        """, (user_id, since)
+    )
+    return data or []
+
+def alerts_payload(data, fmt):
+    """Construye el cuerpo de la respuesta de alertas en el formato pedido."""
+    if fmt != FORMAT_ROWS:
+        columns = {
+            'type': [row[1] for row in data],
+            'priority': [row[2] for row in data],
+            'triggering_value': [row[3] for row in data],
+            'threshold_value': [row[4] for row in data],
+            'details': [row[5] for row in data],
+            'acknowledged': [row[6] for row in data]
+        }
+        return columnar_payload([row[0] for row in data], columns, numeric=['triggering_value'], fmt=fmt)
+    return {
+        'alerts': [
+            {
+                'alert_time': row[0].strftime('%d/%m %H:%M'),
+                'type': row[1],
+                'priority': row[2],
+                'triggering_value': row[3],
+                'threshold_value': row[4],
+                'details': row[5],
+                'acknowledged': row[6]
+            } for row in data
+        ]
+    }
+
 @app.route('/livelyageing/api/user/<int:user_id>/alerts')
 @login_required
+@conditional_user_api
 def api_user_alerts(user_id):
     """
     Devuelve las alertas de los últimos 7 días para el usuario.
     """
+    fmt = negotiate_format(request)
     db = DatabaseManager()
     if not db.connect():
         return jsonify({'error': 'DB error'}), 500
     try:
-        since = datetime.now() - timedelta(days=7)
-        data = db.execute_query(
-            """
-            SELECT 
-                alert_time,
-                alert_type,
-                priority,
-                triggering_value,
-                threshold_value,
-                details,
-                acknowledged
-            FROM alerts 
-            WHERE user_id = %s 
-            AND alert_time >= %s 
-            ORDER BY alert_time DESC
-            """, (user_id, since)
-        )
-        
-        return jsonify({
-            'alerts': [
-                {
-                    'alert_time': row[0].strftime('%d/%m %H:%M'),
-                    'type': row[1],
-                    'priority': row[2],
-                    'triggering_value': row[3],
-                    'threshold_value': row[4],
-                    'details': row[5],
-                    'acknowledged': row[6]
-                } for row in data
-            ]
-        })
+        return chart_response(alerts_payload(fetch_user_recent_alerts(db, user_id), fmt), fmt)
     finally:
         db.close()
 
-@app.route('/livelyageing/dashboard/alerts/export')
+@app.route('/livelyageing/api/user/<int:user_id>/bootstrap')
 @login_required
-def export_alerts():
-    import csv
-    from io import StringIO
+@conditional_user_api
+def api_user_bootstrap(user_id):
+    """
+    Devuelve en una sola respuesta todos los paneles de la ficha de usuario.
+
+    Acepta los mismos parámetros que la API intradía (type por defecto 'steps')
+    y devuelve daily_summary, intraday, weekly y alerts con el mismo contenido
+    que sus endpoints individuales. Las cuatro consultas se hacen seguidas sobre
+    una única conexión, en lugar de cuatro peticiones con su propia conexión.
+    """
+    try:
+        metric_type, start_date, end_date, points, bucket = parse_intraday_args(request.args, default_type='steps')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    fmt = negotiate_format(request)
+
     db = DatabaseManager()
     if not db.connect():
-        return "Error de conexión a la base de datos", 500
+        return jsonify({'error': 'DB error'}), 500
     try:
-        # Obtener filtros igual que en alerts_dashboard
-        date_from = request.args.get('date_from')
-        date_to = request.args.get('date_to')
-        priority = request.args.get('priority')
-        acknowledged = request.args.get('acknowledged')
-        user_query = request.args.get('user_query')
-        # Construir la consulta base
-        query = """
-            SELECT 
-                a.alert_time,
-                u.name AS user_name,
-                u.email AS user_email,
-                a.alert_type,
-                a.priority,
-                a.triggering_value,
-                a.threshold_value,
-                a.details,
-                a.acknowledged
-            FROM alerts a
-            JOIN users u ON a.user_id = u.id
-            WHERE 1=1
-        """
-        params = []
-        if date_from:
-            query += " AND a.alert_time >= %s"
-            params.append(f"{date_from} 00:00:00")
-        if date_to:
-            query += " AND a.alert_time <= %s"
-            params.append(f"{date_to} 23:59:59")
-        if priority:
-            query += " AND a.priority = %s"
-            params.append(priority)
-        if acknowledged is not None and acknowledged != '':
-            query += " AND a.acknowledged = %s"
-            params.append(acknowledged == 'true')
-        if user_query:
-            query += " AND (LOWER(u.name) LIKE LOWER(%s) OR LOWER(u.email) LIKE LOWER(%s))"
-            search_term = f"%{user_query}%"
-            params.extend([search_term, search_term])
-        query += " ORDER BY a.alert_time DESC"
-        alerts = db.execute_query(query, params)
-        # Crear CSV con BOM UTF-8 para compatibilidad con Excel
-        si = StringIO()
-        cw = csv.writer(si)
-        cw.writerow(["Fecha/Hora", "Usuario", "Email", "Tipo de Alerta", "Prioridad", "Valor Disparador", "Umbral", "Detalles", "Reconocida"])
-        for a in alerts:
-            cw.writerow([
-                a[0].strftime('%Y-%m-%d %H:%M'),
-                a[1], a[2], a[3], a[4], a[5], a[6], a[7], "Sí" if a[8] else "No"
-            ])
-        output = '\ufeff' + si.getvalue()  # Añadir BOM UTF-8
-        si.close()
-        fecha = datetime.now().strftime('%Y%m%d')
-        return Response(
-            output,
-            mimetype="text/csv; charset=utf-8",
-            headers={"Content-Disposition": f"attachment;filename=alertas_{fecha}.csv"}
-        )
+        summary = fetch_user_daily_summary(db, user_id, start_date)
+        intraday_data, total_points = fetch_user_intraday(db, user_id, metric_type, start_date, end_date, points, bucket)
+        weekly_data = fetch_user_weekly_summary(db, user_id)
+        alerts_data = fetch_user_recent_alerts(db, user_id)
+        return chart_response({
+            'daily_summary': summary,
+            'intraday': intraday_payload(intraday_data, total_points, start_date, end_date, bucket, fmt),
+            'weekly': weekly_payload(weekly_data, fmt),
+            'alerts': alerts_payload(alerts_data, fmt)
+        }, fmt)
     finally:
         db.close()
 
+# Cabeceras y formato de fila comunes a las exportaciones de alertas
+ALERT_CSV_HEADER = ["Fecha/Hora", "Usuario", "Email", "Tipo de Alerta", "Prioridad", "Valor Disparador", "Umbral", "Detalles", "Reconocida"]
+# Tamaño aproximado (en caracteres) de cada trozo enviado al cliente
+CSV_CHUNK_SIZE = 64 * 1024
+
+def format_alert_csv_row(a):
+    return [
+        a[0].strftime('%Y-%m-%d %H:%M'),
+        a[1], a[2], a[3], a[4], a[5], a[6], a[7], "Sí" if a[8] else "No"
+    ]
+
+def csv_stream_response(db, rows, header, format_row, filename):
+    """
+    Devuelve una respuesta CSV que se genera mientras se leen las filas.
+
+    Las filas llegan de un cursor server-side (DatabaseManager.stream_query), se
+    escriben en trozos de ~CSV_CHUNK_SIZE y la conexión se cierra al terminar
+    el envío, de modo que la memoria usada no depende del tamaño del export.
+    """
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        try:
+            # BOM UTF-8 para compatibilidad con Excel
+            buffer.write('\ufeff')
+            writer.writerow(header)
+            # Enviar la cabecera de inmediato, antes de la primera consulta
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+            for row in rows:
+                writer.writerow(format_row(row))
+                if buffer.tell() >= CSV_CHUNK_SIZE:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate(0)
+            yield buffer.getvalue()
+        finally:
+            buffer.close()
+            db.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f"attachment;filename={filename}"}
+    )
+
+@app.route('/livelyageing/dashboard/alerts/export')
+@login_required
+def export_alerts():
+    db = DatabaseManager()
+    if not db.connect():
+        return "Error de conexión a la base de datos", 500
+    # Obtener filtros igual que en alerts_dashboard
+    date_from = request.args.get('date_from')
+    date_to = request.args.get('date_to')
+    priority = request.args.get('priority')
+    acknowledged = request.args.get('acknowledged')
+    user_query = request.args.get('user_query')
+    # Construir la consulta base
+    query = """
+        SELECT 
+            a.alert_time,
+            u.name AS user_name,
+            u.email AS user_email,
+            a.alert_type,
+            a.priority,
+            a.triggering_value,
+            a.threshold_value,
+            a.details,
+            a.acknowledged
+        FROM alerts a
+        JOIN users u ON a.user_id = u.id
+        WHERE 1=1
+    """
+    params = []
+    if date_from:
+        query += " AND a.alert_time >= %s"
+        params.append(f"{date_from} 00:00:00")
+    if date_to:
+        query += " AND a.alert_time <= %s"
+        params.append(f"{date_to} 23:59:59")
+    if priority:
+        query += " AND a.priority = %s"
+        params.append(priority)
+    if acknowledged is not None and acknowledged != '':
+        query += " AND a.acknowledged = %s"
+        params.append(acknowledged == 'true')
+    if user_query:
+        query += " AND (LOWER(u.name) LIKE LOWER(%s) OR LOWER(u.email) LIKE LOWER(%s))"
+        search_term = f"%{user_query}%"
+        params.extend([search_term, search_term])
+    query += " ORDER BY a.alert_time DESC"
+    fecha = datetime.now().strftime('%Y%m%d')
+    return csv_stream_response(
+        db, db.stream_query(query, params), ALERT_CSV_HEADER, format_alert_csv_row,
+        f"alertas_{fecha}.csv"
+    )
+
 @app.route('/livelyageing/user/<int:user_id>/export_alerts')
 @login_required
 def export_user_alerts(user_id):
-    import csv
-    from io import StringIO
     db = DatabaseManager()
     if not db.connect():
         return "Error de conexión a la base de datos", 500
-    try:
-        since = datetime.now() - timedelta(days=7)
-        query = """
-            SELECT 
-                a.alert_time,
-                u.name AS user_name,
-                u.email AS user_email,
-                a.alert_type,
-                a.priority,
-                a.triggering_value,
-                a.threshold_value,
-                a.details,
-                a.acknowledged
-            FROM alerts a
-            JOIN users u ON a.user_id = u.id
-            WHERE a.user_id = %s AND a.alert_time >= %s
-            ORDER BY a.alert_time DESC
-        """
-        alerts = db.execute_query(query, (user_id, since))
-        si = StringIO()
-        cw = csv.writer(si)
-        cw.writerow(["Fecha/Hora", "Usuario", "Email", "Tipo de Alerta", "Prioridad", "Valor Disparador", "Umbral", "Detalles", "Reconocida"])
-        for a in alerts:
-            cw.writerow([
-                a[0].strftime('%Y-%m-%d %H:%M'),
-                a[1], a[2], a[3], a[4], a[5], a[6], a[7], "Sí" if a[8] else "No"
-            ])
-        output = '\ufeff' + si.getvalue()
-        si.close()
-        fecha = datetime.now().strftime('%Y%m%d')
-        return Response(
-            output,
-            mimetype="text/csv; charset=utf-8",
-            headers={"Content-Disposition": f"attachment;filename=alertas_usuario_{user_id}_{fecha}.csv"}
-        )
-    finally:
-        db.close()
+    since = datetime.now() - timedelta(days=7)
+    query = """
+        SELECT 
+            a.alert_time,
+            u.name AS user_name,
+            u.email AS user_email,
+            a.alert_type,
+            a.priority,
+            a.triggering_value,
+            a.threshold_value,
+            a.details,
+            a.acknowledged
+        FROM alerts a
+        JOIN users u ON a.user_id = u.id
+        WHERE a.user_id = %s AND a.alert_time >= %s
+        ORDER BY a.alert_time DESC
+    """
+    fecha = datetime.now().strftime('%Y%m%d')
+    return csv_stream_response(
+        db, db.stream_query(query, (user_id, since)), ALERT_CSV_HEADER, format_alert_csv_row,
+        f"alertas_usuario_{user_id}_{fecha}.csv"
+    )
 
 @app.route('/livelyageing/user/<int:user_id>/export_intraday')
 @login_required
 def export_user_intraday(user_id):
-    import csv
-    from io import StringIO
+    """
+    Exporta a CSV los datos intradía de las fechas y métricas seleccionadas.
+
+    Todas las combinaciones fecha × métrica se resuelven en una sola consulta.
+    Con layout=wide se genera una columna por métrica en lugar de una fila por punto.
+    """
+    # Obtener fechas y métricas seleccionadas
+    dates = request.args.getlist('dates')
+    metrics = list(dict.fromkeys(request.args.getlist('metrics')))
+    wide = request.args.get('layout') == 'wide'
+    if not dates or not metrics:
+        return "Debe seleccionar al menos una fecha y una métrica", 400
+    try:
+        days = sorted({datetime.strptime(d, "%Y-%m-%d").date() for d in dates})
+        query, params = build_intraday_export_query(user_id, days, metrics, wide=wide)
+    except ValueError as e:
+        return f"Parámetros de exportación inválidos: {e}", 400
     db = DatabaseManager()
     if not db.connect():
         return "Error de conexión a la base de datos", 500
+
+    if wide:
+        header = ["Fecha", "Hora"] + metrics
+        format_row = lambda row: (row[0].strftime('%Y-%m-%d'), row[0].strftime('%H:%M'), *row[1:])
+    else:
+        header = ["Fecha", "Hora", "Métrica", "Valor"]
+        format_row = lambda row: (row[0].strftime('%Y-%m-%d'), row[0].strftime('%H:%M'), row[1], row[2])
+    fecha = datetime.now().strftime('%Y%m%d')
+    return csv_stream_response(
+        db, db.stream_query(query, params), header, format_row,
+        f"intradia_usuario_{user_id}_{fecha}.csv"
+    )
+
+@app.route('/livelyageing/research/export', methods=['POST'])
+@login_required
+def research_export():
+    """
+    Encola la exportación Parquet de una cohorte (ver research_export.py).
+
+    Parámetros (formulario o JSON): user_ids, start (YYYY-MM-DD), end (YYYY-MM-DD)
+    y opcionalmente tables. Devuelve el id del trabajo de inmediato.
+    """
+    payload = request.get_json(silent=True) or {}
     try:
-        # Obtener fechas y métricas seleccionadas
-        dates = request.args.getlist('dates')
-        metrics = request.args.getlist('metrics')
-        if not dates or not metrics:
-            return "Debe seleccionar al menos una fecha y una métrica", 400
-        # Preparar consulta
-        rows = []
-        for date_str in dates:
-            for metric in metrics:
-                start_time = datetime.strptime(date_str, "%Y-%m-%d")
-                end_time = start_time + timedelta(days=1)
-                query = """
-                    SELECT time, type, value
-                    FROM intraday_metrics
-                    WHERE user_id = %s AND type = %s AND time >= %s AND time < %s
-                    ORDER BY time
-                """
-                data = db.execute_query(query, (user_id, metric, start_time, end_time))
-                for row in data:
-                    rows.append((row[0].date().strftime('%Y-%m-%d'), row[0].strftime('%H:%M'), row[1], row[2]))
-        # Crear CSV
-        si = StringIO()
-        cw = csv.writer(si)
-        cw.writerow(["Fecha", "Hora", "Métrica", "Valor"])
-        for r in rows:
-            cw.writerow(r)
-        output = '\ufeff' + si.getvalue()
-        si.close()
-        fecha = datetime.now().strftime('%Y%m%d')
-        return Response(
-            output,
-            mimetype="text/csv; charset=utf-8",
-            headers={"Content-Disposition": f"attachment;filename=intradia_usuario_{user_id}_{fecha}.csv"}
-        )
-    finally:
-        db.close()
+        user_ids = payload.get('user_ids') or request.form.getlist('user_ids')
+        if isinstance(user_ids, str):
+            user_ids = user_ids.split(',')
+        user_ids = [int(u) for u in user_ids]
+        start_date = datetime.strptime(payload.get('start') or request.form.get('start', ''), "%Y-%m-%d").date()
+        end_date = datetime.strptime(payload.get('end') or request.form.get('end', ''), "%Y-%m-%d").date()
+        tables = payload.get('tables') or request.form.getlist('tables') or None
+        if isinstance(tables, str):
+            tables = tables.split(',')
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Parámetros inválidos: {e}'}), 400
+    if not user_ids or end_date < start_date:
+        return jsonify({'error': 'Debe indicar usuarios y un rango de fechas válido'}), 400
+    unknown = [t for t in tables or [] if t not in EXPORT_TABLES]
+    if unknown:
+        return jsonify({'error': f"Tablas desconocidas: {', '.join(unknown)}"}), 400
+
+    job = job_runner.submit_export(user_ids, start_date, end_date, tables)
+    app.logger.info(f"Exportación de cohorte encolada: job={job.id} usuarios={user_ids} {start_date}..{end_date}")
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': url_for('research_export_status', job_id=job.id),
+        'download_url': url_for('research_export_download', job_id=job.id)
+    }), 202
+
+@app.route('/livelyageing/research/export/<job_id>')
+@login_required
+def research_export_status(job_id):
+    """
+    Devuelve el estado de una exportación de cohorte.
+    """
+    job = job_runner.get(job_id)
+    if not job or job.kind != 'export':
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/livelyageing/research/export/<job_id>/download')
+@login_required
+def research_export_download(job_id):
+    """
+    Descarga el .zip con los ficheros Parquet de una exportación terminada.
+
+    El .zip se conserva EXPORT_TTL_HOURS horas (ver jobs.JobRunner.purge_exports);
+    después hay que volver a lanzar la exportación.
+    """
+    job = job_runner.get(job_id)
+    if not job or job.kind != 'export':
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    job_runner.purge_exports()
+    if job.expired:
+        return jsonify({'error': 'La exportación ha caducado; vuelva a lanzarla'}), 410
+    if not job.archive_path:
+        return jsonify({'error': 'La exportación aún no está lista', 'status': job.status}), 409
+    return send_file(os.path.abspath(job.archive_path), mimetype='application/zip', as_attachment=True,
+                     download_name=f"cohorte_{job.start_date}_{job.end_date}.zip")
 
 @app.route('/livelyageing/unlink_user', methods=['POST'])
 @login_required
@@ -1776,6 +2034,7 @@ def unlink_user():
                 
                 # Commit the transaction
                 db.execute_query("COMMIT")
+                db.refresh_user_status(email)
                 
                 flash('Dispositivo desvinculado correctamente. El usuario y sus datos históricos se mantienen.', 'success')
             except Exception as e:
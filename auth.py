@@ -67,17 +67,6 @@ def generate_code_challenge(code_verifier):
     code_challenge = base64.urlsafe_b64encode(sha256).rstrip(b'=').decode('utf-8')
     return code_challenge
 
-def refresh_token(refresh_token):
-    payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token,
-    }
-    response = requests.post(TOKEN_URL, data=payload)
-    tokens = response.json()
-    return tokens.get("access_token"), tokens.get("refresh_token")
-
 def generate_auth_url(code_challenge, state):
     """
     Genera la URL de autorización para Fitbit con los parámetros adecuados.
@@ -0,0 +1,102 @@
+"""
+Codificación columnar compacta para las APIs de gráficas.
+
+En lugar de una lista de diccionarios (una clave repetida por fila y un
+strftime por punto), la respuesta columnar envía arrays paralelos:
+
+    {
+        "format": "columnar",
+        "t": [1716444000, 1716444900, ...],          # epoch en segundos
+        "columns": {"value": [72.0, 75.0, ...]}
+    }
+
+Con format=f32 las columnas numéricas viajan como float32 little-endian en
+base64 y los tiempos como desplazamientos int32 respecto a "t0":
+
+    {
+        "format": "columnar", "encoding": "f32",
+        "t0": 1716444000, "t": "<base64 int32>",
+        "columns": {"value": "<base64 float32>", "type": ["steps", ...]}
+    }
+
+En el navegador: new Float32Array(Uint8Array.from(atob(s), c => c.charCodeAt(0)).buffer).
+Los valores nulos se envían como NaN en float32.
+
+El formato se negocia con ?format=columnar|f32 o con la cabecera
+Accept: application/vnd.livelyageing.columnar+json.
+"""
+
+import base64
+import calendar
+from datetime import date, datetime
+
+import numpy as np
+
+COLUMNAR_MIMETYPE = 'application/vnd.livelyageing.columnar+json'
+
+FORMAT_ROWS = 'rows'
+FORMAT_COLUMNAR = 'columnar'
+FORMAT_F32 = 'f32'
+
+
+def negotiate_format(request):
+    """
+    Determina el formato de respuesta pedido por el cliente.
+
+    Returns:
+        str: FORMAT_ROWS (por defecto), FORMAT_COLUMNAR o FORMAT_F32.
+    """
+    requested = request.args.get('format')
+    if requested in (FORMAT_COLUMNAR, FORMAT_F32):
+        return requested
+    if COLUMNAR_MIMETYPE in request.headers.get('Accept', ''):
+        return FORMAT_COLUMNAR
+    return FORMAT_ROWS
+
+
+def to_epoch(value):
+    """Convierte un datetime (o date, a medianoche UTC) a epoch en segundos."""
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    if isinstance(value, date):
+        return calendar.timegm(value.timetuple())
+    return value
+
+
+def _b64(array):
+    return base64.b64encode(array.astype(array.dtype.newbyteorder('<')).tobytes()).decode('ascii')
+
+
+def columnar_payload(times, columns, numeric=(), fmt=FORMAT_COLUMNAR):
+    """
+    Construye el cuerpo de una respuesta columnar.
+
+    Args:
+        times (list): Marcas de tiempo (datetime o date) de cada fila.
+        columns (dict): Nombre de columna -> lista de valores, en el orden de times.
+        numeric (iterable): Columnas numéricas que pueden codificarse en float32.
+        fmt (str): FORMAT_COLUMNAR o FORMAT_F32.
+
+    Returns:
+        dict: Cuerpo listo para jsonify.
+    """
+    epochs = [to_epoch(t) for t in times]
+    numeric = set(numeric)
+    if fmt != FORMAT_F32:
+        return {'format': FORMAT_COLUMNAR, 't': epochs, 'columns': columns}
+
+    t0 = epochs[0] if epochs else 0
+    offsets = np.asarray(epochs, dtype=np.int64) - t0
+    encoded = {}
+    for name, values in columns.items():
+        if name in numeric:
+            encoded[name] = _b64(np.array([np.nan if v is None else v for v in values], dtype=np.float32))
+        else:
+            encoded[name] = values
+    return {
+        'format': FORMAT_COLUMNAR,
+        'encoding': FORMAT_F32,
+        't0': t0,
+        't': _b64(offsets.astype(np.int32)),
+        'columns': encoded
+    }
@@ -0,0 +1,117 @@
+"""
+Compresión transparente de las respuestas JSON y CSV.
+
+Las series intradía en JSON y las exportaciones CSV son texto muy repetitivo, y
+en las redes lentas de los centros el tiempo de transferencia domina. Tras cada
+petición se comprime la respuesta si el cliente lo acepta (Accept-Encoding):
+
+- br (Brotli) si el paquete brotli está instalado, si no gzip.
+- Solo tipos de texto comprimibles (JSON, CSV y el formato columnar de las
+  gráficas) y, en respuestas normales, solo por encima de MIN_SIZE bytes.
+- Las respuestas en streaming (exportaciones CSV) se comprimen trozo a trozo,
+  sin cargarlas en memoria; cada trozo se vacía (flush) para que el cliente
+  reciba datos desde el principio.
+
+Uso: init_compression(app)
+"""
+
+import gzip
+import zlib
+
+from flask import request
+
+from chart_encoding import COLUMNAR_MIMETYPE
+
+try:
+    import brotli
+except ImportError:  # Brotli es opcional; sin él se usa gzip
+    brotli = None
+
+# Tamaño mínimo (bytes) para comprimir una respuesta no streaming
+MIN_SIZE = 1024
+# Nivel de compresión gzip (6 es el equilibrio habitual entre CPU y tamaño)
+GZIP_LEVEL = 6
+# Calidad Brotli; 4-5 comprime mejor que gzip -6 con un coste de CPU similar
+BROTLI_QUALITY = 4
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'text/csv',
+    COLUMNAR_MIMETYPE,
+}
+
+
+def choose_encoding(request):
+    """Devuelve 'br', 'gzip' o None según Accept-Encoding y lo disponible."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def _compress_stream(chunks, encoding):
+    """Comprime un iterable de trozos (str o bytes) de forma incremental."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush = compressor.process, compressor.flush
+        finish = compressor.finish
+    else:
+        # wbits=31: formato gzip (cabecera y CRC) en lugar de zlib
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        process = compressor.compress
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield process(chunk) + flush()
+        yield finish()
+    finally:
+        # Propagar el cierre al generador original (p. ej. para cerrar la conexión a la BD)
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+
+def compress_response(response, request):
+    """
+    Comprime la respuesta si procede. Devuelve la misma respuesta (modificada o no).
+    """
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'Content-Encoding' in response.headers
+            or request.method == 'HEAD'):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(_compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_compression(app):
+    """Registra la compresión de respuestas en la aplicación Flask."""
+    @app.after_request
+    def _compress_after_request(response):
+        return compress_response(response, request)
@@ -31,6 +31,35 @@ DB_CONFIG = {
     "sslmode": "require"
 }
 
+# Formato de almacenamiento intradía:
+# - 'narrow': una fila por (usuario, instante, tipo) en intraday_metrics (por defecto).
+# - 'wide': una fila por (usuario, instante) con una columna por métrica en intraday_wide.
+INTRADAY_LAYOUT = os.getenv("INTRADAY_LAYOUT", "narrow")
+
+# Resolución con la que fitbit_intraday pide cada serie: '1sec', '1min', '5min' o '15min'.
+# '1sec' solo existe para la frecuencia cardíaca; esas series (~86.400 puntos por día)
+# se guardan empaquetadas por usuario y día en intraday_packed.
+INTRADAY_DETAIL_LEVELS = {
+    'heart_rate': os.getenv("INTRADAY_DETAIL_HEART_RATE", "15min"),
+    'steps': os.getenv("INTRADAY_DETAIL_STEPS", "15min"),
+    'calories': os.getenv("INTRADAY_DETAIL_CALORIES", "15min"),
+    'distance': os.getenv("INTRADAY_DETAIL_DISTANCE", "15min"),
+    'active_zone_minutes': os.getenv("INTRADAY_DETAIL_ACTIVE_ZONE_MINUTES", "15min"),
+}
+
+# Retención de datos en TimescaleDB (días). Sin definir = conservar indefinidamente.
+# init_db crea o elimina la política de retención de cada tabla según estos valores.
+RETENTION_DAYS = {
+    'intraday_metrics': os.getenv("INTRADAY_RETENTION_DAYS"),
+    'sleep_logs': os.getenv("SLEEP_LOGS_RETENTION_DAYS"),
+    'alerts': os.getenv("ALERTS_RETENTION_DAYS"),
+}
+
+# Un día se da por cerrado (db.day_is_final) cuando la última sincronización del
+# dispositivo es posterior a su fin más este margen en horas; los recolectores ya
+# no lo vuelven a descargar.
+FINAL_DAY_GRACE_HOURS = int(os.getenv("FINAL_DAY_GRACE_HOURS", "6"))
+
 
 # Lista de usuarios Fitbit (correos electrónicos)
 USERS = [
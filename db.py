@@ -1,10 +1,536 @@
 import psycopg2
 from psycopg2 import sql
-from config import DB_CONFIG
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from config import DB_CONFIG, RETENTION_DAYS, INTRADAY_LAYOUT, FINAL_DAY_GRACE_HOURS
 from encryption import encrypt_token, decrypt_token
 import random
+import time
+import uuid
+import numpy as np
+from collections import namedtuple
 from datetime import datetime, timedelta
 
+# Tipos de métrica intradía que recopila fitbit_intraday
+INTRADAY_METRIC_TYPES = ('heart_rate', 'steps', 'calories', 'distance', 'active_zone_minutes')
+
+def intraday_source(alias='intraday_metrics'):
+    """
+    Relación intradía en formato largo (user_id, time, type, value) para usar en FROM.
+
+    Con INTRADAY_LAYOUT = 'wide' se despliegan las columnas de intraday_wide en
+    filas con un LATERAL VALUES; los filtros por user_id y time se aplican sobre
+    el índice (user_id, time) de intraday_wide. Así las consultas de lectura son
+    las mismas con ambos formatos.
+
+    Args:
+        alias (str): Alias de la relación en la consulta.
+    """
+    if INTRADAY_LAYOUT != 'wide':
+        return "intraday_metrics" if alias == 'intraday_metrics' else f"intraday_metrics AS {alias}"
+    values = ", ".join(f"('{m}', w.{m})" for m in INTRADAY_METRIC_TYPES)
+    return f"""(
+            SELECT w.user_id, w.time, m.type, m.value
+            FROM intraday_wide w
+            CROSS JOIN LATERAL (VALUES {values}) AS m(type, value)
+            WHERE m.value IS NOT NULL
+        ) AS {alias}"""
+
+def intraday_insert_query(user_id, timestamp, metric_type, value):
+    """
+    Consulta de inserción de un punto intradía según INTRADAY_LAYOUT.
+
+    En formato ancho cada métrica rellena su columna de la fila (user_id, time),
+    creándola si no existe.
+
+    Returns:
+        tuple: (consulta, parámetros)
+    """
+    if INTRADAY_LAYOUT != 'wide':
+        return ("""
+            INSERT INTO intraday_metrics (user_id, time, type, value)
+            VALUES (%s, %s, %s, %s);
+        """, (user_id, timestamp, metric_type, value))
+    if metric_type not in INTRADAY_METRIC_TYPES:
+        raise ValueError(f"Métrica intradía desconocida: {metric_type}")
+    query = sql.SQL("""
+        INSERT INTO intraday_wide (user_id, time, {column})
+        VALUES (%s, %s, %s)
+        ON CONFLICT (user_id, time) DO UPDATE SET {column} = EXCLUDED.{column};
+    """).format(column=sql.Identifier(metric_type))
+    return query, (user_id, timestamp, value)
+
+def intraday_batch_insert_query(metric_type):
+    """
+    Consulta para insertar varios puntos de una métrica con execute_values.
+
+    Returns:
+        tuple: (consulta con un único %s para VALUES, función (user_id, timestamp, value) -> fila)
+    """
+    if INTRADAY_LAYOUT != 'wide':
+        return ("INSERT INTO intraday_metrics (user_id, time, type, value) VALUES %s",
+                lambda user_id, timestamp, value: (user_id, timestamp, metric_type, value))
+    if metric_type not in INTRADAY_METRIC_TYPES:
+        raise ValueError(f"Métrica intradía desconocida: {metric_type}")
+    query = sql.SQL("""
+        INSERT INTO intraday_wide (user_id, time, {column}) VALUES %s
+        ON CONFLICT (user_id, time) DO UPDATE SET {column} = EXCLUDED.{column}
+    """).format(column=sql.Identifier(metric_type))
+    return query, lambda user_id, timestamp, value: (user_id, timestamp, value)
+
+# Resoluciones cuyas series se guardan empaquetadas en intraday_packed (una fila
+# por usuario, métrica y día) en lugar de una fila por punto
+PACKED_DETAIL_LEVELS = ('1sec',)
+
+def pack_intraday_day(offsets, values):
+    """
+    Codifica los puntos de un día para intraday_packed.
+
+    Los instantes se guardan como diferencias en segundos entre puntos consecutivos
+    (el primero, desde el inicio del día): a resolución de segundo casi todas valen 1
+    y la compresión TOAST de PostgreSQL las reduce a casi nada. Los valores se guardan
+    como REAL (float4). Si un instante aparece varias veces se conserva el último valor.
+
+    Args:
+        offsets (array-like): Segundos desde el inicio del día de cada punto.
+        values (array-like): Valores, en el orden de offsets.
+
+    Returns:
+        tuple: (time_deltas, point_values) como listas, ordenadas por tiempo.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)[::-1]
+    values = np.asarray(values, dtype=np.float32)[::-1]
+    # np.unique devuelve la primera aparición; sobre los arrays invertidos, la última
+    unique, index = np.unique(offsets, return_index=True)
+    return np.diff(unique, prepend=0).tolist(), values[index].tolist()
+
+def unpack_intraday_day(time_deltas, point_values):
+    """Inverso de pack_intraday_day: devuelve (offsets, values) como arrays de NumPy."""
+    return (np.cumsum(np.asarray(time_deltas, dtype=np.int64)),
+            np.asarray(point_values, dtype=np.float64))
+
+def packed_intraday_query(user_id, metric_type, start_time=None, end_time=None):
+    """
+    Consulta de los días empaquetados de una serie que se solapan con [start_time, end_time].
+
+    Returns:
+        tuple: (consulta, parámetros); cada fila es (day_start, time_deltas, point_values).
+    """
+    query = """
+        SELECT day_start, time_deltas, point_values FROM intraday_packed
+        WHERE user_id = %s AND type = %s
+    """
+    params = [user_id, metric_type]
+    if start_time:
+        query += " AND day_start > %s::timestamptz - INTERVAL '1 day'"
+        params.append(start_time)
+    if end_time:
+        query += " AND day_start <= %s"
+        params.append(end_time)
+    return query + " ORDER BY day_start", params
+
+def _seconds_since(day_start, moment):
+    # Los límites sin zona horaria se interpretan en la zona de la sesión, como en PostgreSQL
+    if moment.tzinfo is None and day_start.tzinfo is not None:
+        moment = moment.replace(tzinfo=day_start.tzinfo)
+    return (moment - day_start).total_seconds()
+
+def expand_packed_intraday(rows, start_time=None, end_time=None, include_end=True):
+    """
+    Despliega las filas de packed_intraday_query en puntos (time, value).
+
+    El filtrado por rango se hace sobre los arrays del día y solo se crean
+    objetos datetime para los puntos que caen dentro.
+
+    Args:
+        rows (list): Filas (day_start, time_deltas, point_values).
+        start_time (datetime, optional): Inicio del rango (incluido).
+        end_time (datetime, optional): Fin del rango.
+        include_end (bool): Si end_time está incluido en el rango.
+
+    Returns:
+        list: Tuplas (time, value) ordenadas por tiempo.
+    """
+    points = []
+    for day_start, time_deltas, point_values in rows or []:
+        offsets, values = unpack_intraday_day(time_deltas, point_values)
+        mask = np.ones(len(offsets), dtype=bool)
+        if start_time:
+            mask &= offsets >= _seconds_since(day_start, start_time)
+        if end_time:
+            limit = _seconds_since(day_start, end_time)
+            mask &= (offsets <= limit) if include_end else (offsets < limit)
+        points.extend(
+            (day_start + timedelta(seconds=int(offset)), float(value))
+            for offset, value in zip(offsets[mask], values[mask])
+        )
+    return points
+
+def packed_intraday_source(alias='p'):
+    """
+    Relación (user_id, time, type, value, day_start) con los puntos de intraday_packed
+    desplegados, para usar en FROM junto a intraday_source().
+
+    Cada instante es day_start más la suma acumulada de time_deltas, como en
+    unpack_intraday_day. Los filtros por user_id, type y day_start se aplican sobre
+    la clave primaria de intraday_packed; conviene acotar day_start además de time
+    para no desplegar días enteros fuera del rango.
+
+    Args:
+        alias (str): Alias de la relación en la consulta.
+    """
+    return f"""(
+            SELECT pk.user_id, pk.day_start + make_interval(secs => x.offset_seconds) AS time,
+                   pk.type, x.value::double precision AS value, pk.day_start
+            FROM intraday_packed pk
+            CROSS JOIN LATERAL (
+                SELECT SUM(u.delta) OVER (ORDER BY u.n) AS offset_seconds, u.value
+                FROM unnest(pk.time_deltas, pk.point_values) WITH ORDINALITY AS u(delta, value, n)
+            ) x
+        ) AS {alias}"""
+
+def merge_intraday_points(rows, packed_points):
+    """Une las filas (time, value) de la tabla intradía con los puntos empaquetados."""
+    if not packed_points:
+        return rows
+    return sorted(list(rows or []) + packed_points, key=lambda row: row[0])
+
+def migrate_intraday_to_wide(db):
+    """
+    Copia intraday_metrics a intraday_wide, usuario a usuario.
+
+    Los puntos que ya existan en intraday_wide no se sobrescriben, así que puede
+    repetirse sin duplicar datos.
+
+    Args:
+        db (DatabaseManager): Conexión abierta.
+    """
+    columns = ", ".join(INTRADAY_METRIC_TYPES)
+    pivots = ", ".join(f"MAX(value) FILTER (WHERE type = '{m}')" for m in INTRADAY_METRIC_TYPES)
+    users = db.execute_query("SELECT DISTINCT user_id FROM intraday_metrics") or []
+    for (user_id,) in users:
+        db.execute_query(f"""
+            INSERT INTO intraday_wide (user_id, time, {columns})
+            SELECT user_id, time, {pivots}
+            FROM intraday_metrics
+            WHERE user_id = %s
+            GROUP BY user_id, time
+            ON CONFLICT (user_id, time) DO NOTHING;
+        """, (user_id,))
+        print(f"Datos intradía del usuario {user_id} copiados a intraday_wide.")
+
+# Índices secundarios que gestiona init_db, uno por forma de consulta frecuente.
+# (nombre, definición, consulta a la que sirve). En las hipertablas el índice se
+# crea en todos los chunks. daily_summaries no necesita uno propio: la restricción
+# UNIQUE(user_id, date) ya crea el índice (user_id, date) que usan sus lecturas.
+INDEXES = (
+    ('idx_users_email_created',
+     "users (email, created_at DESC, id DESC) INCLUDE (name)",
+     "Instancia más reciente de un email (get_latest_user_id_by_email, get_user_tokens...); "
+     "cubre id y name para resolverla con un index-only scan"),
+    ('idx_intraday_user_type_time',
+     "intraday_metrics (user_id, type, time DESC)",
+     "Serie intradía de un usuario y métrica en un rango (API intradía, alertas, checkpoints)"),
+    ('idx_sleep_logs_user_start',
+     "sleep_logs (user_id, start_time DESC)",
+     "Registros de sueño de un usuario en un rango (get_sleep_logs)"),
+    ('idx_alerts_user_time',
+     "alerts (user_id, alert_time DESC)",
+     "Alertas recientes de un usuario (ficha de usuario, get_user_alerts)"),
+    ('idx_alerts_priority_time',
+     "alerts (priority, alert_time DESC)",
+     "Filtro por prioridad del panel de alertas"),
+    ('idx_alerts_unacknowledged',
+     "alerts (alert_time DESC) WHERE acknowledged = FALSE",
+     "Alertas pendientes y urgentes del panel (índice parcial: solo las no reconocidas)"),
+    ('idx_user_status_email',
+     "user_status (email, created_at DESC)",
+     "Listado de user_stats ordenado por email e instancia"),
+    ('idx_user_status_active',
+     "user_status (last_update DESC NULLS LAST) WHERE status = 'active'",
+     "Usuarios activos con actividad más reciente (home)"),
+    ('idx_ingestion_jobs_claim',
+     "ingestion_jobs (priority DESC, created_at) WHERE status IN ('pending', 'running')",
+     "Siguiente trabajo a reclamar de la cola de ingesta (work_queue.WorkQueue.claim)"),
+)
+
+def create_indexes(db):
+    """
+    Crea los índices de INDEXES que no existan.
+
+    Args:
+        db (DatabaseManager): Conexión abierta.
+    """
+    for name, definition, _ in INDEXES:
+        db.execute_query(f"CREATE INDEX IF NOT EXISTS {name} ON {definition};")
+
+# Configuración de cada hipertabla: intervalo de chunk y compresión de los chunks
+# antiguos. Solo se comprime intraday_metrics, la tabla de alto volumen: en ella
+# solo se hacen INSERT simples, también en chunks antiguos ya comprimidos cuando
+# el relleno histórico (work_queue) escribe días pasados, y TimescaleDB admite
+# INSERT en chunks comprimidos desde la versión 2.3. intraday_wide no se comprime:
+# se actualiza columna a columna con ON CONFLICT DO UPDATE, también en días
+# antiguos, y eso sobre chunks comprimidos requiere TimescaleDB 2.11 o posterior.
+# En daily_summaries (upserts del día) y alerts (reconocimientos) también se
+# actualizan filas antiguas. La retención se configura en config.RETENTION_DAYS.
+HYPERTABLE_SETTINGS = {
+    'intraday_metrics': {
+        'chunk_interval': '1 day',
+        'compress_segmentby': 'user_id, type',
+        'compress_orderby': 'time DESC',
+        'compress_after': '7 days',
+    },
+    'intraday_wide': {'chunk_interval': '7 days'},
+    'daily_summaries': {'chunk_interval': '365 days'},
+    'sleep_logs': {'chunk_interval': '90 days'},
+    'alerts': {'chunk_interval': '30 days'},
+}
+
+def hypertable_size_report(db):
+    """
+    Devuelve el tamaño en disco de cada hipertabla.
+
+    Returns:
+        dict: tabla -> (bytes totales, bytes antes de comprimir, bytes comprimidos);
+            los dos últimos son None si la tabla no tiene chunks comprimidos.
+    """
+    report = {}
+    for table, settings in HYPERTABLE_SETTINGS.items():
+        size = db.execute_query("SELECT hypertable_size(%s)", (table,))
+        stats = None
+        if settings.get('compress_after'):
+            stats = db.execute_query("""
+                SELECT before_compression_total_bytes, after_compression_total_bytes
+                FROM hypertable_compression_stats(%s)
+            """, (table,))
+        before, after = stats[0] if stats else (None, None)
+        report[table] = (size[0][0] if size else None, before, after)
+    return report
+
+def print_size_report(title, report):
+    print(f"{title}:")
+    for table, (total, before, after) in report.items():
+        line = f"  {table}: {(total or 0) / 1024 / 1024:.1f} MB"
+        if before and after:
+            line += f" (comprimido {before / 1024 / 1024:.1f} MB -> {after / 1024 / 1024:.1f} MB)"
+        print(line)
+
+def configure_hypertables(db):
+    """
+    Aplica HYPERTABLE_SETTINGS y las políticas de retención de RETENTION_DAYS.
+
+    El nuevo intervalo de chunk solo afecta a los chunks que se creen a partir de
+    ahora. Los chunks ya elegibles se comprimen en el momento, sin esperar al
+    trabajo de la política, y se muestra el tamaño en disco antes y después.
+    """
+    before = hypertable_size_report(db)
+    for table, settings in HYPERTABLE_SETTINGS.items():
+        db.execute_query(
+            "SELECT set_chunk_time_interval(%s, %s::interval)",
+            (table, settings['chunk_interval'])
+        )
+
+        if settings.get('compress_after'):
+            enabled = db.execute_query("""
+                SELECT compression_enabled FROM timescaledb_information.hypertables
+                WHERE hypertable_name = %s
+            """, (table,))
+            if not (enabled and enabled[0][0]):
+                db.execute_query(f"""
+                    ALTER TABLE {table} SET (
+                        timescaledb.compress,
+                        timescaledb.compress_segmentby = '{settings['compress_segmentby']}',
+                        timescaledb.compress_orderby = '{settings['compress_orderby']}'
+                    );
+                """)
+            db.execute_query(
+                "SELECT add_compression_policy(%s, %s::interval, if_not_exists => TRUE)",
+                (table, settings['compress_after'])
+            )
+            db.execute_query("""
+                SELECT compress_chunk(c, if_not_compressed => TRUE)
+                FROM show_chunks(%s, older_than => %s::interval) c
+            """, (table, settings['compress_after']))
+        else:
+            # Tablas que se comprimían en versiones anteriores (intraday_wide):
+            # se quita la política y se descomprimen sus chunks para poder actualizarlos
+            db.execute_query("SELECT remove_compression_policy(%s, if_exists => TRUE)", (table,))
+            db.execute_query("""
+                SELECT decompress_chunk(format('%%I.%%I', c.chunk_schema, c.chunk_name)::regclass, if_compressed => TRUE)
+                FROM timescaledb_information.chunks c
+                WHERE c.hypertable_name = %s AND c.is_compressed
+            """, (table,))
+
+        # Retención: la política refleja siempre la configuración actual
+        db.execute_query("SELECT remove_retention_policy(%s, if_exists => TRUE)", (table,))
+        retention_days = RETENTION_DAYS.get(table)
+        if retention_days:
+            db.execute_query(
+                "SELECT add_retention_policy(%s, %s::interval)",
+                (table, f"{int(retention_days)} days")
+            )
+    print_size_report("Tamaño de las hipertablas antes de configurarlas", before)
+    print_size_report("Tamaño de las hipertablas después de configurarlas", hypertable_size_report(db))
+
+# Agregados continuos de intraday_metrics: (vista, cubo, minutos del cubo, ventana
+# de refresco hacia atrás, margen final, frecuencia de refresco). La ventana hacia
+# atrás cubre los datos que llegan tarde (pulseras que sincronizan días después) y
+# debe ser menor que la retención de intraday_metrics si se configura una.
+# Los cubos diarios son días UTC (time_bucket sin zona horaria).
+INTRADAY_ROLLUPS = (
+    ('intraday_metrics_hourly', '1 hour', 60, '7 days', '1 hour', '30 minutes'),
+    ('intraday_metrics_daily', '1 day', 1440, '30 days', '1 hour', '1 hour'),
+)
+
+def create_continuous_aggregates(db):
+    """
+    Crea los agregados continuos de INTRADAY_ROLLUPS con su política de refresco.
+
+    Guardan por usuario, métrica y cubo la media, mínimo, máximo, suma y número de
+    puntos. Con materialized_only = false las consultas combinan lo materializado
+    con los datos en bruto aún no agregados, así que siempre están al día.
+    CREATE MATERIALIZED VIEW ... WITH (timescaledb.continuous) y el refresco
+    inicial no pueden ejecutarse dentro de una transacción: se usa autocommit.
+
+    Args:
+        db (DatabaseManager): Conexión abierta.
+    """
+    db.connection.autocommit = True
+    try:
+        for view, bucket, _, start_offset, end_offset, schedule in INTRADAY_ROLLUPS:
+            exists = db.execute_query(
+                "SELECT 1 FROM timescaledb_information.continuous_aggregates WHERE view_name = %s",
+                (view,)
+            )
+            if exists:
+                continue
+            db.execute_query(f"""
+                CREATE MATERIALIZED VIEW IF NOT EXISTS {view}
+                WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+                SELECT
+                    user_id,
+                    type,
+                    time_bucket(INTERVAL '{bucket}', time) AS bucket,
+                    AVG(value) AS avg_value,
+                    MIN(value) AS min_value,
+                    MAX(value) AS max_value,
+                    SUM(value) AS sum_value,
+                    COUNT(*) AS count_value
+                FROM intraday_metrics
+                GROUP BY user_id, type, bucket
+                WITH NO DATA;
+            """)
+            db.execute_query(
+                f"CREATE INDEX IF NOT EXISTS idx_{view}_user_type_bucket ON {view} (user_id, type, bucket DESC);"
+            )
+            db.execute_query("""
+                SELECT add_continuous_aggregate_policy(%s,
+                    start_offset => %s::interval,
+                    end_offset => %s::interval,
+                    schedule_interval => %s::interval,
+                    if_not_exists => TRUE)
+            """, (view, start_offset, end_offset, schedule))
+            # Materializar el histórico existente una sola vez, al crear la vista
+            db.execute_query("CALL refresh_continuous_aggregate(%s, NULL, NULL)", (view,))
+            print(f"Agregado continuo {view} creado.")
+    finally:
+        db.connection.autocommit = False
+
+def refresh_intraday_rollups(start_time, end_time):
+    """
+    Materializa los agregados de INTRADAY_ROLLUPS en [start_time, end_time) si el
+    rango empieza antes de su ventana de refresco.
+
+    La política de cada agregado solo refresca los últimos días y la parte en
+    tiempo real (materialized_only = false) solo cubre lo posterior a lo ya
+    materializado, así que los días antiguos que escribe el relleno histórico no
+    llegarían nunca a las vistas. Se llama al terminar de recopilar un rango
+    intradía. El rango se amplía un día por cada lado porque los cubos diarios son
+    días UTC.
+
+    Args:
+        start_time (datetime): Inicio del rango escrito.
+        end_time (datetime): Fin (excluido) del rango escrito.
+    """
+    # Los agregados continuos se construyen sobre intraday_metrics (formato estrecho)
+    if INTRADAY_LAYOUT == 'wide':
+        return
+    connection = connect_to_db()
+    if connection:
+        try:
+            # refresh_continuous_aggregate no puede ejecutarse dentro de una transacción
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                for view, _, _, start_offset, _, _ in INTRADAY_ROLLUPS:
+                    cursor.execute("SELECT %s::timestamptz < NOW() - %s::interval", (start_time, start_offset))
+                    if not cursor.fetchone()[0]:
+                        continue
+                    cursor.execute(
+                        "CALL refresh_continuous_aggregate(%s, %s::timestamptz - INTERVAL '1 day', %s::timestamptz + INTERVAL '1 day')",
+                        (view, start_time, end_time)
+                    )
+            return True
+        except Exception as e:
+            print(f"Error al refrescar los agregados intradía: {e}")
+        finally:
+            connection.autocommit = False
+            connection.close()
+    return False
+
+def user_status_refresh_query(email=None):
+    """
+    Consulta que recalcula las filas de user_status a partir de users y daily_summaries.
+
+    El estado de cada instancia sigue las reglas de la página de estadísticas:
+    la instancia más reciente de cada email es 'unassigned' (sin nombre),
+    'unlinked' (sin tokens) o 'active'; las anteriores son 'historical'.
+
+    Args:
+        email (str, optional): Recalcular solo las instancias de este email.
+            Por defecto se recalculan todas.
+
+    Returns:
+        tuple: (consulta, parámetros)
+    """
+    where = "WHERE email = %s" if email else ""
+    query = f"""
+        INSERT INTO user_status (
+            user_id, email, name, created_at, is_latest, has_tokens,
+            last_update, has_data, status, updated_at
+        )
+        SELECT
+            u.id, u.email, u.name, u.created_at, u.rn = 1, u.has_tokens,
+            d.last_update, d.last_update IS NOT NULL,
+            CASE
+                WHEN u.rn > 1 THEN 'historical'
+                WHEN COALESCE(u.name, '') = '' THEN 'unassigned'
+                WHEN NOT u.has_tokens THEN 'unlinked'
+                ELSE 'active'
+            END,
+            NOW()
+        FROM (
+            SELECT id, email, name, created_at,
+                   access_token IS NOT NULL AND refresh_token IS NOT NULL AS has_tokens,
+                   ROW_NUMBER() OVER (PARTITION BY email ORDER BY created_at DESC) AS rn
+            FROM users
+            {where}
+        ) u
+        LEFT JOIN LATERAL (
+            SELECT MAX(date) AS last_update FROM daily_summaries WHERE user_id = u.id
+        ) d ON TRUE
+        ON CONFLICT (user_id) DO UPDATE SET
+            email = EXCLUDED.email,
+            name = EXCLUDED.name,
+            created_at = EXCLUDED.created_at,
+            is_latest = EXCLUDED.is_latest,
+            has_tokens = EXCLUDED.has_tokens,
+            last_update = EXCLUDED.last_update,
+            has_data = EXCLUDED.has_data,
+            status = EXCLUDED.status,
+            updated_at = EXCLUDED.updated_at;
+    """
+    return query, ((email,) if email else ())
+
 class DatabaseManager:
     def __init__(self):
         self.connection = None
@@ -65,6 +591,33 @@ class DatabaseManager:
             self.rollback()
             return None
 
+    def stream_query(self, query, params=None, batch_size=2000):
+        """
+        Ejecuta una consulta con un cursor con nombre (server-side) y devuelve
+        las filas una a una, trayéndolas del servidor por lotes.
+
+        A diferencia de execute_query, el resultado nunca se carga entero en
+        memoria, por lo que sirve para exportaciones de cualquier tamaño.
+
+        Args:
+            query (str): Consulta SQL.
+            params (list/tuple, optional): Parámetros de la consulta.
+            batch_size (int): Filas que se traen del servidor en cada viaje.
+
+        Yields:
+            tuple: Cada fila del resultado.
+        """
+        cursor = self.connection.cursor(name=f"stream_{uuid.uuid4().hex}")
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(query, params or ())
+            for row in cursor:
+                yield row
+        finally:
+            # El cursor con nombre vive dentro de la transacción: cerrarlo y terminarla
+            cursor.close()
+            self.commit()
+
     def execute_many(self, query, params_list):
         """Ejecuta una consulta múltiple veces con diferentes parámetros."""
         try:
@@ -103,8 +656,30 @@ class DatabaseManager:
             RETURNING id
         """
         result = self.execute_query(query, (name, email, encrypted_access_token, encrypted_refresh_token))
+        # La nueva instancia pasa a ser la más reciente del email
+        self.refresh_user_status(email)
         return result[0][0] if result else None
 
+    def refresh_user_status(self, email=None):
+        """
+        Recalcula la tabla user_status para un email (o para todos los usuarios).
+
+        Debe llamarse tras cualquier cambio en users (alta, desvinculación,
+        reasignación, tokens); la ingesta de datos la mantiene con mark_user_data.
+        """
+        query, params = user_status_refresh_query(email)
+        return self.execute_query(query, params)
+
+    def mark_user_data(self, user_id, date):
+        """Actualiza last_update/has_data de user_status tras ingerir un día de datos."""
+        return self.execute_query("""
+            UPDATE user_status
+            SET last_update = GREATEST(last_update, %s::date),
+                has_data = TRUE,
+                updated_at = NOW()
+            WHERE user_id = %s
+        """, (date, user_id))
+
     def get_daily_summaries(self, user_id, start_date=None, end_date=None):
         """
         Obtiene los resúmenes diarios de un usuario en un rango de fechas.
@@ -137,8 +712,8 @@ class DatabaseManager:
 
     def get_intraday_metrics(self, user_id, metric_type, start_time=None, end_time=None):
         """Obtiene las métricas intradía de un usuario."""
-        query = """
-            SELECT time, value FROM intraday_metrics
+        query = f"""
+            SELECT time, value FROM {intraday_source()}
             WHERE user_id = %s AND type = %s
         """
         params = [user_id, metric_type]
@@ -153,7 +728,9 @@ class DatabaseManager:
         
         query += " ORDER BY time"
         
-        return self.execute_query(query, params)
+        rows = self.execute_query(query, params)
+        packed = self.execute_query(*packed_intraday_query(user_id, metric_type, start_time, end_time))
+        return merge_intraday_points(rows, expand_packed_intraday(packed, start_time, end_time))
 
     def get_sleep_logs(self, user_id, start_date=None, end_date=None):
         """Obtiene los registros de sueño de un usuario."""
@@ -265,9 +842,72 @@ class DatabaseManager:
             return None
 
 # Función de conveniencia para mantener compatibilidad con el código existente
+# Pool de conexiones de los procesos de larga duración (ver enable_connection_pool)
+_connection_pool = None
+
+class _PooledConnection:
+    """Conexión del pool: se usa como una normal, pero close() la devuelve al pool."""
+
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        # Los atributos de la conexión (p. ej. autocommit) se fijan en la conexión real
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._connection, name, value)
+
+    def close(self):
+        if self._connection is None:
+            return
+        broken = bool(self._connection.closed)
+        try:
+            if not broken:
+                # No devolver al pool una transacción a medias ni en autocommit
+                self._connection.rollback()
+                self._connection.autocommit = False
+        except Exception:
+            broken = True
+        finally:
+            self._pool.putconn(self._connection, close=broken)
+            self._connection = None
+
+def enable_connection_pool(minconn=1, maxconn=10):
+    """
+    Hace que connect_to_db reutilice conexiones de un pool en lugar de abrir una
+    nueva en cada llamada. Pensado para procesos de larga duración como
+    ingestion_daemon; el código existente no cambia, porque cerrar la conexión
+    la devuelve al pool.
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = ThreadedConnectionPool(
+            minconn, maxconn,
+            host=DB_CONFIG["host"],
+            database=DB_CONFIG["database"],
+            user=DB_CONFIG["user"],
+            password=DB_CONFIG["password"],
+            port=DB_CONFIG["port"],
+            sslmode=DB_CONFIG["sslmode"]
+        )
+
+def close_connection_pool():
+    """Cierra todas las conexiones del pool y vuelve a abrir una conexión por llamada."""
+    global _connection_pool
+    if _connection_pool is not None:
+        _connection_pool.closeall()
+        _connection_pool = None
+
 def connect_to_db():
     """Función de conveniencia para mantener compatibilidad con el código existente."""
     try:
+        if _connection_pool is not None:
+            return _PooledConnection(_connection_pool, _connection_pool.getconn())
         connection = psycopg2.connect(
             host=DB_CONFIG["host"],
             database=DB_CONFIG["database"],
@@ -309,9 +949,12 @@ def init_db():
                 email VARCHAR(255) NOT NULL,
                 access_token TEXT,
                 refresh_token TEXT,
+                token_expires_at TIMESTAMPTZ,
                 created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
             );
         """)
+        # Bases de datos creadas antes de guardar la caducidad del token (tokens.TokenManager)
+        db.execute_query("ALTER TABLE users ADD COLUMN IF NOT EXISTS token_expires_at TIMESTAMPTZ;")
         
         # Crear tabla de resúmenes diarios
         db.execute_query("""
@@ -336,9 +979,15 @@ def init_db():
                 oxygen_saturation FLOAT,
                 respiratory_rate FLOAT,
                 temperature FLOAT,
+                updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
                 UNIQUE(user_id, date)
             );
         """)
+        # Bases de datos creadas antes de existir updated_at (ver get_user_data_version)
+        db.execute_query("""
+            ALTER TABLE daily_summaries
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP;
+        """)
         
         # Convertir a hipertabla
         db.execute_query("""
@@ -367,6 +1016,52 @@ def init_db():
             );
         """)
 
+        # Formato ancho de las métricas intradía (INTRADAY_LAYOUT = 'wide'): una fila por
+        # usuario e instante, cinco veces menos filas y entradas de índice
+        db.execute_query("""
+            CREATE TABLE IF NOT EXISTS intraday_wide (
+                user_id INTEGER REFERENCES users(id),
+                time TIMESTAMPTZ NOT NULL,
+                heart_rate FLOAT,
+                steps FLOAT,
+                calories FLOAT,
+                distance FLOAT,
+                active_zone_minutes FLOAT,
+                UNIQUE (user_id, time)
+            );
+        """)
+        db.execute_query("""
+            SELECT create_hypertable('intraday_wide', 'time',
+                if_not_exists => TRUE,
+                migrate_data => TRUE
+            );
+        """)
+        if INTRADAY_LAYOUT == 'wide':
+            empty = db.execute_query("SELECT NOT EXISTS (SELECT 1 FROM intraday_wide)")
+            if empty and empty[0][0]:
+                migrate_intraday_to_wide(db)
+
+        # Series de alta resolución (PACKED_DETAIL_LEVELS): una fila por usuario,
+        # métrica y día con los instantes codificados en diferencias (pack_intraday_day)
+        db.execute_query("""
+            CREATE TABLE IF NOT EXISTS intraday_packed (
+                user_id INTEGER REFERENCES users(id),
+                type VARCHAR(50) NOT NULL,
+                day_start TIMESTAMPTZ NOT NULL,
+                detail_level VARCHAR(10) NOT NULL,
+                points INTEGER NOT NULL,
+                time_deltas INTEGER[] NOT NULL,
+                point_values REAL[] NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (user_id, type, day_start)
+            );
+        """)
+        # Bases de datos creadas antes de existir updated_at (ver get_user_data_version)
+        db.execute_query("""
+            ALTER TABLE intraday_packed
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+        """)
+
         # Crear tabla de registros de sueño
         db.execute_query("""
             CREATE TABLE IF NOT EXISTS sleep_logs (
@@ -418,6 +1113,83 @@ def init_db():
             );
         """)
         
+        # Estado materializado de cada instancia de usuario (home y user_stats)
+        db.execute_query("""
+            CREATE TABLE IF NOT EXISTS user_status (
+                user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+                email VARCHAR(255) NOT NULL,
+                name VARCHAR(255),
+                created_at TIMESTAMPTZ,
+                is_latest BOOLEAN NOT NULL DEFAULT FALSE,
+                has_tokens BOOLEAN NOT NULL DEFAULT FALSE,
+                last_update DATE,
+                has_data BOOLEAN NOT NULL DEFAULT FALSE,
+                status VARCHAR(20) NOT NULL,
+                updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        # Reconstruir desde cero (también rellena bases de datos existentes)
+        db.refresh_user_status()
+
+        # Cola de trabajos de ingesta (ver work_queue.py)
+        db.execute_query("""
+            CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                id BIGSERIAL PRIMARY KEY,
+                email VARCHAR(255) NOT NULL,
+                stream VARCHAR(20) NOT NULL,
+                start_date DATE NOT NULL,
+                end_date DATE NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                status VARCHAR(10) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 5,
+                not_before TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                leased_by TEXT,
+                lease_expires_at TIMESTAMPTZ,
+                last_error TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMPTZ
+            );
+        """)
+        # Un único trabajo abierto por unidad: encolar dos veces lo mismo no lo duplica
+        db.execute_query("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_ingestion_jobs_open
+            ON ingestion_jobs (email, stream, start_date, end_date)
+            WHERE status IN ('pending', 'running');
+        """)
+        # Frentes de planificación por email y flujo: último día planificado como
+        # reciente y día más nuevo que falta por rellenar hacia atrás
+        db.execute_query("""
+            CREATE TABLE IF NOT EXISTS ingestion_frontier (
+                email VARCHAR(255) NOT NULL,
+                stream VARCHAR(20) NOT NULL,
+                fresh_through DATE NOT NULL,
+                backfill_next DATE NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (email, stream)
+            );
+        """)
+        # Días ya descargados por usuario y flujo; los cerrados no se vuelven a pedir
+        db.execute_query("""
+            CREATE TABLE IF NOT EXISTS ingestion_coverage (
+                user_id INTEGER REFERENCES users(id),
+                stream VARCHAR(20) NOT NULL,
+                day DATE NOT NULL,
+                final BOOLEAN NOT NULL DEFAULT FALSE,
+                fetched_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (user_id, stream, day)
+            );
+        """)
+
+        # Índices de las consultas frecuentes (ver INDEXES)
+        create_indexes(db)
+
+        # Chunks, compresión y retención de las hipertablas (ver HYPERTABLE_SETTINGS)
+        configure_hypertables(db)
+
+        # Agregados horarios y diarios de intraday_metrics (ver INTRADAY_ROLLUPS)
+        create_continuous_aggregates(db)
+
         print("Base de datos inicializada correctamente con TimeScaleDB.")
         return True
                 
@@ -463,11 +1235,8 @@ def insert_intraday_data(user_id, timestamp, data_type, value):
     if conn:
         try:
             with conn.cursor() as cursor:
-                # Insertar directamente en la tabla intraday_metrics
-                cursor.execute("""
-                    INSERT INTO intraday_metrics (user_id, time, type, value)
-                    VALUES (%s, %s, %s, %s);
-                """, (user_id, timestamp, data_type, value))
+                # Insertar en la tabla del formato configurado (INTRADAY_LAYOUT)
+                cursor.execute(*intraday_insert_query(user_id, timestamp, data_type, value))
                 
                 conn.commit()
                 print(f"Datos intradía {data_type} para usuario {user_id} guardados exitosamente en intraday_metrics.")
@@ -517,7 +1286,8 @@ def save_to_db(user_id, date, **data):
                     fat = EXCLUDED.fat,
                     oxygen_saturation = EXCLUDED.oxygen_saturation,
                     respiratory_rate = EXCLUDED.respiratory_rate,
-                    temperature = EXCLUDED.temperature;
+                    temperature = EXCLUDED.temperature,
+                    updated_at = NOW();
                 """
                 cursor.execute(insert_query, (
                     user_id, date,
@@ -552,12 +1322,23 @@ def get_user_tokens(email):
     """
     Retrieve and decrypt tokens for the user with the most recent timestamp or highest user_id.
     """
+    access_token, refresh_token, _ = get_user_token_record(email)
+    return access_token, refresh_token
+
+def get_user_token_record(email):
+    """
+    Retrieve and decrypt the tokens of the most recent user instance, with the
+    access token expiry (None if unknown, e.g. tokens stored before it was tracked).
+
+    Returns:
+        tuple: (access_token, refresh_token, token_expires_at)
+    """
     conn = connect_to_db()
     if conn:
         try:
             with conn.cursor() as cur:
                 cur.execute("""
-                    SELECT access_token, refresh_token 
+                    SELECT access_token, refresh_token, token_expires_at
                     FROM users 
                     WHERE email = %s 
                     ORDER BY created_at DESC, id DESC 
@@ -565,16 +1346,16 @@ def get_user_tokens(email):
                 """, (email,))
                 result = cur.fetchone()
                 if result:
-                    encrypted_access_token, encrypted_refresh_token = result
+                    encrypted_access_token, encrypted_refresh_token, expires_at = result
                     # Decrypt the tokens
                     access_token = decrypt_token(encrypted_access_token)
                     refresh_token = decrypt_token(encrypted_refresh_token)
-                    return access_token, refresh_token
+                    return access_token, refresh_token, expires_at
         except Exception as e:
             print(f"Error retrieving user tokens: {e}")
         finally:
             conn.close()
-    return None, None
+    return None, None, None
 
 def get_unique_emails():
     """
@@ -621,7 +1402,7 @@ def get_user_id_by_email(email):
             connection.close()
     return None
 
-def update_users_tokens(email, access_token, refresh_token):
+def update_users_tokens(email, access_token, refresh_token, expires_at=None):
     """
     Actualiza los tokens de acceso y actualización de un usuario.
 
@@ -629,6 +1410,7 @@ def update_users_tokens(email, access_token, refresh_token):
         email (str): Correo electrónico del usuario.
         access_token (str): Nuevo token de acceso.
         refresh_token (str): Nuevo token de actualización.
+        expires_at (datetime, optional): Caducidad del token de acceso.
     """
     # Encrypt the tokens before storing them
     encrypted_access_token = encrypt_token(access_token)
@@ -641,9 +1423,10 @@ def update_users_tokens(email, access_token, refresh_token):
             with connection.cursor() as cursor:
                 cursor.execute("""
                     UPDATE users
-                    SET access_token = %s, refresh_token = %s
+                    SET access_token = %s, refresh_token = %s, token_expires_at = %s
                     WHERE id = %s;
-                """, (encrypted_access_token, encrypted_refresh_token, user_id))
+                """, (encrypted_access_token, encrypted_refresh_token, expires_at, user_id))
+                cursor.execute(*user_status_refresh_query(email))
                 connection.commit()
                 print(f"Tokens actualizados para {email}.")
         except Exception as e:
@@ -651,6 +1434,127 @@ def update_users_tokens(email, access_token, refresh_token):
         finally:
             connection.close()
 
+# Intentos de guardar unos tokens recién refrescados antes de soltar el cerrojo
+TOKEN_SAVE_ATTEMPTS = 3
+
+def refresh_tokens_single_flight(email, refresh, still_valid):
+    """
+    Refresca los tokens de un email de forma que solo un proceso llame a Fitbit a la vez.
+
+    Los refresh tokens de Fitbit son de un solo uso: si dos procesos refrescan a la
+    vez con el mismo, el segundo invalida la autorización. Aquí el refresco se
+    serializa con un cerrojo consultivo de PostgreSQL por email
+    (pg_advisory_lock), válido entre procesos y máquinas. Con el cerrojo tomado
+    se releen los tokens: si otro proceso los acaba de refrescar (still_valid),
+    se devuelven esos sin llamar a Fitbit; si no, se refrescan y se guardan antes
+    de soltar el cerrojo, de modo que quien lo espere vea ya los nuevos.
+
+    En cuanto Fitbit acepta el refresco el refresh token anterior deja de servir,
+    así que el guardado se reintenta TOKEN_SAVE_ATTEMPTS veces. El cerrojo es de
+    sesión y no de transacción para que un rollback no lo suelte entre intentos.
+    Si aun así no se guardan, se registra el refresh token nuevo cifrado para
+    poder recuperarlo sin volver a vincular el dispositivo.
+
+    Args:
+        email (str): Correo electrónico del usuario.
+        refresh (callable): refresh_token -> (access_token, refresh_token, expires_at).
+        still_valid (callable): (access_token, refresh_token, expires_at) -> bool.
+
+    Returns:
+        tuple: (access_token, refresh_token, expires_at), o (None, None, None) si no se pudo.
+    """
+    connection = connect_to_db()
+    if not connection:
+        return None, None, None
+    lock_key = f"fitbit_token:{email}"
+    locked = False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(hashtext(%s));", (lock_key,))
+            locked = True
+            cursor.execute("""
+                SELECT id, access_token, refresh_token, token_expires_at
+                FROM users
+                WHERE email = %s
+                ORDER BY created_at DESC, id DESC
+                LIMIT 1;
+            """, (email,))
+            row = cursor.fetchone()
+        connection.commit()
+        if not row or not row[1] or not row[2]:
+            _release_token_lock(connection, lock_key, locked)
+            return None, None, None
+        user_id = row[0]
+        current = (decrypt_token(row[1]), decrypt_token(row[2]), row[3])
+        if still_valid(current):
+            _release_token_lock(connection, lock_key, locked)
+            return current
+        access_token, refresh_token, expires_at = refresh(current[1])
+        if not access_token or not refresh_token:
+            _release_token_lock(connection, lock_key, locked)
+            return None, None, None
+    except Exception as e:
+        print(f"Error al refrescar los tokens: {e}")
+        _release_token_lock(connection, lock_key, locked)
+        return None, None, None
+
+    # Fitbit ya ha aceptado el refresh token anterior: los nuevos deben guardarse
+    saved = False
+    for attempt in range(1, TOKEN_SAVE_ATTEMPTS + 1):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE users
+                    SET access_token = %s, refresh_token = %s, token_expires_at = %s
+                    WHERE id = %s;
+                """, (encrypt_token(access_token), encrypt_token(refresh_token), expires_at, user_id))
+            connection.commit()
+            saved = True
+            break
+        except Exception as e:
+            print(f"Error al guardar los tokens refrescados de {email} (intento {attempt}/{TOKEN_SAVE_ATTEMPTS}): {e}")
+            try:
+                connection.rollback()
+            except Exception:
+                pass
+            if attempt < TOKEN_SAVE_ATTEMPTS:
+                time.sleep(attempt)
+
+    if saved:
+        print(f"Tokens actualizados para {email}.")
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(*user_status_refresh_query(email))
+            connection.commit()
+        except Exception as e:
+            print(f"Error al actualizar el estado de {email}: {e}")
+            connection.rollback()
+    else:
+        print(f"No se pudieron guardar los tokens refrescados de {email}; el anterior ya no es válido. "
+              f"Refresh token nuevo (cifrado) para recuperarlo: {encrypt_token(refresh_token)}")
+    _release_token_lock(connection, lock_key, locked)
+    # Aunque no se hayan guardado, los tokens nuevos sirven en este proceso
+    return access_token, refresh_token, expires_at
+
+def _release_token_lock(connection, lock_key, locked):
+    """Suelta el cerrojo de refresco (si se llegó a tomar) y cierra la conexión."""
+    try:
+        if locked and not connection.closed:
+            connection.rollback()
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(hashtext(%s));", (lock_key,))
+            connection.commit()
+    except Exception as e:
+        print(f"Error al liberar el cerrojo de refresco de tokens: {e}")
+        # Un cerrojo de sesión no liberado bloquearía al siguiente usuario de la
+        # conexión: se cierra la conexión real para que el pool no la reutilice
+        try:
+            getattr(connection, '_connection', connection).close()
+        except Exception:
+            pass
+    finally:
+        connection.close()
+
 def get_user_history(user_id):
     """
     Obtiene el historial completo de un usuario utilizando el nuevo esquema TimeScaleDB.
@@ -943,7 +1847,8 @@ def insert_daily_summary(user_id, date, **data):
             fat = EXCLUDED.fat,
             oxygen_saturation = EXCLUDED.oxygen_saturation,
             respiratory_rate = EXCLUDED.respiratory_rate,
-            temperature = EXCLUDED.temperature;
+            temperature = EXCLUDED.temperature,
+            updated_at = NOW();
         """
         
         db.execute_query(insert_query, (
@@ -966,6 +1871,7 @@ def insert_daily_summary(user_id, date, **data):
             data.get("respiratory_rate"),
             data.get("temperature")
         ))
+        db.mark_user_data(user_id, date)
         
         return True
     except Exception as e:
@@ -976,7 +1882,7 @@ def insert_daily_summary(user_id, date, **data):
 
 def insert_intraday_metric(user_id, timestamp, metric_type, value):
     """
-    Inserta una métrica intradía en la tabla intraday_metrics.
+    Inserta una métrica intradía en intraday_metrics o intraday_wide (según INTRADAY_LAYOUT).
     
     Args:
         user_id (int): ID del usuario.
@@ -988,11 +1894,7 @@ def insert_intraday_metric(user_id, timestamp, metric_type, value):
     if connection:
         try:
             with connection.cursor() as cursor:
-                insert_query = """
-                INSERT INTO intraday_metrics (user_id, time, type, value)
-                VALUES (%s, %s, %s, %s);
-                """
-                cursor.execute(insert_query, (user_id, timestamp, metric_type, value))
+                cursor.execute(*intraday_insert_query(user_id, timestamp, metric_type, value))
                 connection.commit()
                 print(f"Métrica intradía {metric_type} para usuario {user_id} guardada exitosamente.")
         except Exception as e:
@@ -1001,6 +1903,90 @@ def insert_intraday_metric(user_id, timestamp, metric_type, value):
         finally:
             connection.close()
 
+def insert_intraday_batch(user_id, metric_type, points):
+    """
+    Inserta en una sola transacción los puntos de una métrica intradía.
+
+    Args:
+        user_id (int): ID del usuario.
+        metric_type (str): Tipo de métrica ('heart_rate', 'steps', etc.).
+        points (list): Tuplas (timestamp, value) sin instantes repetidos.
+
+    Returns:
+        int: Número de puntos insertados, o 0 si hubo un error.
+    """
+    if not points:
+        return 0
+    connection = connect_to_db()
+    if connection:
+        try:
+            query, make_row = intraday_batch_insert_query(metric_type)
+            with connection.cursor() as cursor:
+                execute_values(cursor, query, [make_row(user_id, t, v) for t, v in points], page_size=1000)
+                connection.commit()
+                print(f"{len(points)} puntos intradía {metric_type} para usuario {user_id} guardados exitosamente.")
+                return len(points)
+        except Exception as e:
+            print(f"Error al guardar los puntos intradía: {e}")
+            connection.rollback()
+        finally:
+            connection.close()
+    return 0
+
+def store_packed_intraday(user_id, metric_type, day_start, offsets, values, detail_level):
+    """
+    Guarda los puntos de un día de una serie en intraday_packed.
+
+    Si el día ya existe se fusionan los puntos nuevos con los guardados (los
+    nuevos prevalecen en instantes repetidos), así que puede llamarse varias
+    veces a lo largo del día.
+
+    Args:
+        user_id (int): ID del usuario.
+        metric_type (str): Tipo de métrica ('heart_rate', ...).
+        day_start (datetime): Medianoche del día.
+        offsets (array-like): Segundos desde day_start de cada punto.
+        values (array-like): Valores de los puntos.
+        detail_level (str): Resolución de la serie ('1sec', ...).
+
+    Returns:
+        int: Número de puntos del día tras la fusión, o 0 si hubo un error.
+    """
+    connection = connect_to_db()
+    if connection:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT time_deltas, point_values FROM intraday_packed
+                    WHERE user_id = %s AND type = %s AND day_start = %s
+                    FOR UPDATE
+                """, (user_id, metric_type, day_start))
+                existing = cursor.fetchone()
+                if existing:
+                    old_offsets, old_values = unpack_intraday_day(*existing)
+                    offsets = np.concatenate([old_offsets, np.asarray(offsets, dtype=np.int64)])
+                    values = np.concatenate([old_values, np.asarray(values, dtype=np.float64)])
+                time_deltas, point_values = pack_intraday_day(offsets, values)
+                cursor.execute("""
+                    INSERT INTO intraday_packed (user_id, type, day_start, detail_level, points, time_deltas, point_values)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (user_id, type, day_start) DO UPDATE SET
+                        detail_level = EXCLUDED.detail_level,
+                        points = EXCLUDED.points,
+                        time_deltas = EXCLUDED.time_deltas,
+                        point_values = EXCLUDED.point_values,
+                        updated_at = NOW();
+                """, (user_id, metric_type, day_start, detail_level, len(time_deltas), time_deltas, point_values))
+                connection.commit()
+                print(f"Serie {metric_type} empaquetada del usuario {user_id} guardada ({len(time_deltas)} puntos).")
+                return len(time_deltas)
+        except Exception as e:
+            print(f"Error al guardar la serie intradía empaquetada: {e}")
+            connection.rollback()
+        finally:
+            connection.close()
+    return 0
+
 def insert_sleep_log(user_id, start_time, end_time, **data):
     """
     Inserta un registro de sueño en la base de datos.
@@ -1123,6 +2109,109 @@ def get_daily_summaries(user_id, start_date=None, end_date=None):
     finally:
         db.close()
 
+def get_last_intraday_times(user_id, since_time, until_time=None):
+    """
+    Último instante guardado de cada métrica intradía de un usuario en [since_time, until_time).
+
+    Consulta tanto el formato de filas (INTRADAY_LAYOUT) como intraday_packed. Los
+    límites acotan la búsqueda a los chunks del periodo en la hipertabla.
+
+    Args:
+        user_id (int): ID del usuario.
+        since_time (datetime): Instante a partir del cual buscar (p. ej. medianoche de hoy).
+        until_time (datetime, optional): Fin (excluido) de la búsqueda; sin límite por defecto.
+
+    Returns:
+        dict: Tipo de métrica -> último instante (datetime sin zona horaria, hora local
+            de la sesión, como los que se insertan).
+    """
+    connection = connect_to_db()
+    if connection:
+        try:
+            with connection.cursor() as cursor:
+                until_time = until_time or datetime.max
+                cursor.execute(f"""
+                    SELECT type, MAX(time)::timestamp FROM {intraday_source()}
+                    WHERE user_id = %s AND time >= %s AND time < %s
+                    GROUP BY type
+                    UNION ALL
+                    SELECT type, (day_start + make_interval(secs => (SELECT SUM(d) FROM unnest(time_deltas) AS d)))::timestamp
+                    FROM intraday_packed
+                    WHERE user_id = %s AND day_start > %s::timestamptz - INTERVAL '1 day' AND day_start < %s
+                """, (user_id, since_time, until_time, user_id, since_time, until_time))
+                last_times = {}
+                for metric_type, last_time in cursor.fetchall():
+                    if last_time and (metric_type not in last_times or last_time > last_times[metric_type]):
+                        last_times[metric_type] = last_time
+                return last_times
+        except Exception as e:
+            print(f"Error al obtener los últimos instantes intradía: {e}")
+        finally:
+            connection.close()
+    return {}
+
+def day_is_final(day, last_sync):
+    """
+    Indica si los datos de un día ya no pueden cambiar: el dispositivo se sincronizó
+    después del fin del día más FINAL_DAY_GRACE_HOURS.
+
+    Args:
+        day (date): Día (hora local del usuario).
+        last_sync (datetime): Última sincronización del dispositivo (hora local,
+            sin zona horaria), o None si no se conoce.
+    """
+    if last_sync is None:
+        return False
+    day_end = datetime.combine(day, datetime.min.time()) + timedelta(days=1)
+    return last_sync >= day_end + timedelta(hours=FINAL_DAY_GRACE_HOURS)
+
+def get_final_days(user_id, stream, start_date, end_date):
+    """
+    Días cerrados de un usuario y flujo entre dos fechas (ambas incluidas).
+
+    Returns:
+        set: Fechas (date) que no hace falta volver a descargar.
+    """
+    connection = connect_to_db()
+    if connection:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT day FROM ingestion_coverage
+                    WHERE user_id = %s AND stream = %s AND day BETWEEN %s AND %s AND final
+                """, (user_id, stream, start_date, end_date))
+                return {row[0] for row in cursor.fetchall()}
+        except Exception as e:
+            print(f"Error al obtener los días cerrados: {e}")
+        finally:
+            connection.close()
+    return set()
+
+def record_coverage(user_id, stream, day, final):
+    """
+    Registra que un día de un usuario y flujo se ha descargado completo.
+
+    Un día cerrado sigue cerrado aunque se vuelva a registrar como abierto.
+    """
+    connection = connect_to_db()
+    if connection:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO ingestion_coverage (user_id, stream, day, final)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (user_id, stream, day) DO UPDATE
+                    SET final = ingestion_coverage.final OR EXCLUDED.final, fetched_at = NOW()
+                """, (user_id, stream, day, final))
+                connection.commit()
+                return True
+        except Exception as e:
+            print(f"Error al registrar la cobertura: {e}")
+            connection.rollback()
+        finally:
+            connection.close()
+    return False
+
 def get_intraday_metrics(user_id, metric_type, start_time=None, end_time=None):
     """
     Obtiene las métricas intradía de un usuario en un rango de tiempo.
@@ -1140,8 +2229,8 @@ def get_intraday_metrics(user_id, metric_type, start_time=None, end_time=None):
     if connection:
         try:
             with connection.cursor() as cursor:
-                query = """
-                SELECT time, value FROM intraday_metrics
+                query = f"""
+                SELECT time, value FROM {intraday_source()}
                 WHERE user_id = %s AND type = %s
                 """
                 params = [user_id, metric_type]
@@ -1158,13 +2247,187 @@ def get_intraday_metrics(user_id, metric_type, start_time=None, end_time=None):
                 
                 cursor.execute(query, params)
                 metrics = cursor.fetchall()
-                return metrics
+                cursor.execute(*packed_intraday_query(user_id, metric_type, start_time, end_time))
+                packed = expand_packed_intraday(cursor.fetchall(), start_time, end_time)
+                return merge_intraday_points(metrics, packed)
         except Exception as e:
             print(f"Error al obtener las métricas intradía: {e}")
         finally:
             connection.close()
     return []
 
+# Versión de los datos de un usuario (ver get_user_data_version); los campos se
+# leen por nombre para que añadir uno no desplace a los demás
+DataVersion = namedtuple('DataVersion', (
+    'intraday_time', 'packed_updated_at', 'summary_updated_at',
+    'last_alert_id', 'last_acknowledged_at'
+))
+
+def get_user_data_version(user_id):
+    """
+    Obtiene una versión barata de los datos de un usuario, que cambia cada vez que
+    se ingieren datos nuevos o se crea o reconoce una alerta.
+
+    Args:
+        user_id (int): ID del usuario.
+
+    El último instante intradía se busca por tipo de métrica (un LATERAL con
+    ORDER BY time DESC LIMIT 1 por tipo), de modo que cada búsqueda es una sola
+    lectura del índice (user_id, type, time DESC) en lugar de recorrer todas las
+    filas y chunks del usuario. Las series empaquetadas (intraday_packed, una fila
+    por día y tipo) aportan su última escritura, que también cambia al rellenar
+    días antiguos.
+
+    Returns:
+        DataVersion: última métrica intradía, última escritura empaquetada, última
+            actualización de resumen diario, id de la última alerta (un entero, no
+            una fecha) y último reconocimiento; o None si hay error.
+    """
+    db = DatabaseManager()
+    if not db.connect():
+        print("Error al conectar a la base de datos")
+        return None
+
+    try:
+        result = db.execute_query(f"""
+            SELECT
+                (SELECT MAX(l.time)
+                 FROM unnest(%s::text[]) AS t(type)
+                 CROSS JOIN LATERAL (
+                     SELECT i.time FROM {intraday_source('i')}
+                     WHERE i.user_id = %s AND i.type = t.type
+                     ORDER BY i.time DESC
+                     LIMIT 1
+                 ) l),
+                (SELECT MAX(updated_at) FROM intraday_packed WHERE user_id = %s),
+                (SELECT MAX(updated_at) FROM daily_summaries WHERE user_id = %s),
+                (SELECT MAX(id) FROM alerts WHERE user_id = %s),
+                (SELECT MAX(acknowledged_at) FROM alerts WHERE user_id = %s)
+        """, (list(INTRADAY_METRIC_TYPES), user_id, user_id, user_id, user_id, user_id))
+        return DataVersion(*result[0]) if result else None
+    finally:
+        db.close()
+
+def build_intraday_export_query(user_id, dates, metrics, wide=False):
+    """
+    Construye una única consulta para exportar varias fechas y métricas intradía.
+
+    Las fechas se cruzan con intraday_metrics mediante unnest(), de modo que cada
+    día se resuelve como un rango [día, día + 1) sobre el índice de tiempo, y las
+    métricas se filtran con type = ANY(...). Los puntos de las series empaquetadas
+    (intraday_packed, p. ej. la frecuencia cardíaca a 1 segundo) se despliegan y se
+    unen a los de la tabla intradía. Todo sale ya ordenado por tiempo.
+
+    Args:
+        user_id (int): ID del usuario.
+        dates (list): Fechas (date) a exportar.
+        metrics (list): Tipos de métrica; deben estar en INTRADAY_METRIC_TYPES.
+        wide (bool): Si es True, devuelve una fila por instante con una columna
+            por métrica (time, <metric1>, <metric2>, ...). Si es False, una fila
+            por punto (time, type, value).
+
+    Returns:
+        tuple: (consulta compuesta, parámetros) listos para cursor.execute.
+    """
+    unknown = [m for m in metrics if m not in INTRADAY_METRIC_TYPES]
+    if unknown:
+        raise ValueError(f"Métricas intradía desconocidas: {', '.join(unknown)}")
+
+    source = sql.SQL("""
+        FROM (
+            SELECT r.time, r.type, r.value
+            FROM {}
+            JOIN unnest(%s::date[]) AS d(day)
+                ON r.time >= d.day AND r.time < d.day + 1
+            WHERE r.user_id = %s AND r.type = ANY(%s)
+            UNION ALL
+            SELECT p.time, p.type, p.value
+            FROM {}
+            JOIN unnest(%s::date[]) AS d(day)
+                ON p.day_start > d.day - INTERVAL '1 day' AND p.day_start < d.day + 1
+                AND p.time >= d.day AND p.time < d.day + 1
+            WHERE p.user_id = %s AND p.type = ANY(%s)
+        ) i
+    """).format(sql.SQL(intraday_source('r')), sql.SQL(packed_intraday_source('p')))
+    params = (list(dates), user_id, list(metrics)) * 2
+
+    if wide:
+        columns = sql.SQL(", ").join(
+            sql.SQL("MAX(i.value) FILTER (WHERE i.type = {}) AS {}").format(sql.Literal(m), sql.Identifier(m))
+            for m in metrics
+        )
+        query = sql.SQL("SELECT i.time, {} {} GROUP BY i.time ORDER BY i.time").format(columns, source)
+    else:
+        query = sql.SQL("SELECT i.time, i.type, i.value {} ORDER BY i.time, i.type").format(source)
+    return query, params
+
+def intraday_rollup_query(user_id, metric_type, start_time, end_time, bucket_minutes):
+    """
+    Construye la consulta de una serie intradía agregada en cubos de bucket_minutes.
+
+    Si el cubo es múltiplo de un día o de una hora se lee del agregado continuo
+    correspondiente (INTRADAY_ROLLUPS), que tiene un orden de magnitud menos filas
+    que intraday_metrics; si no, se agrega en bruto con time_bucket. En ambos casos
+    la media es la ponderada por número de puntos.
+
+    Args:
+        user_id (int): ID del usuario.
+        metric_type (str): Tipo de métrica.
+        start_time (datetime): Inicio del rango (incluido); conviene alinearlo al cubo.
+        end_time (datetime): Fin del rango (excluido).
+        bucket_minutes (int): Ancho del cubo en minutos.
+
+    Returns:
+        tuple: (consulta, parámetros). Cada fila es
+            (cubo, media, mínimo, máximo, suma, número de puntos).
+    """
+    interval = f"{bucket_minutes} minutes"
+    # Los agregados continuos se construyen sobre intraday_metrics (formato estrecho)
+    rollups = INTRADAY_ROLLUPS if INTRADAY_LAYOUT != 'wide' else ()
+    for view, _, minutes, _, _, _ in sorted(rollups, key=lambda r: -r[2]):
+        if bucket_minutes % minutes == 0:
+            query = f"""
+                SELECT time_bucket(%s::interval, bucket) AS b,
+                       SUM(sum_value) / NULLIF(SUM(count_value), 0),
+                       MIN(min_value), MAX(max_value),
+                       SUM(sum_value), SUM(count_value)
+                FROM {view}
+                WHERE user_id = %s AND type = %s
+                AND bucket >= %s AND bucket < %s
+                GROUP BY b
+                ORDER BY b
+            """
+            return query, (interval, user_id, metric_type, start_time, end_time)
+    query = f"""
+        SELECT time_bucket(%s::interval, time) AS b,
+               AVG(value), MIN(value), MAX(value), SUM(value), COUNT(*)
+        FROM {intraday_source()}
+        WHERE user_id = %s AND type = %s
+        AND time >= %s AND time < %s
+        GROUP BY b
+        ORDER BY b
+    """
+    return query, (interval, user_id, metric_type, start_time, end_time)
+
+def get_intraday_rollup(user_id, metric_type, start_time, end_time, bucket_minutes):
+    """
+    Obtiene una serie intradía agregada por cubos (ver intraday_rollup_query).
+
+    Returns:
+        list: Tuplas (cubo, media, mínimo, máximo, suma, número de puntos).
+    """
+    connection = connect_to_db()
+    if connection:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(*intraday_rollup_query(user_id, metric_type, start_time, end_time, bucket_minutes))
+                return cursor.fetchall()
+        except Exception as e:
+            print(f"Error al obtener la serie intradía agregada: {e}")
+        finally:
+            connection.close()
+    return []
+
 def get_sleep_logs(user_id, start_date=None, end_date=None):
     """
     Obtiene los registros de sueño de un usuario en un rango de fechas.
@@ -1218,7 +2481,13 @@ def reset_database():
                 cursor.execute("DROP TABLE IF EXISTS alerts CASCADE;")  # Drop alerts first
                 cursor.execute("DROP TABLE IF EXISTS sleep_logs CASCADE;")
                 cursor.execute("DROP TABLE IF EXISTS intraday_metrics CASCADE;")
+                cursor.execute("DROP TABLE IF EXISTS intraday_wide CASCADE;")
+                cursor.execute("DROP TABLE IF EXISTS intraday_packed CASCADE;")
                 cursor.execute("DROP TABLE IF EXISTS daily_summaries CASCADE;")
+                cursor.execute("DROP TABLE IF EXISTS user_status CASCADE;")
+                cursor.execute("DROP TABLE IF EXISTS ingestion_jobs CASCADE;")
+                cursor.execute("DROP TABLE IF EXISTS ingestion_frontier CASCADE;")
+                cursor.execute("DROP TABLE IF EXISTS ingestion_coverage CASCADE;")
                 cursor.execute("DROP TABLE IF EXISTS users CASCADE;")
                 
                 connection.commit()
@@ -1312,22 +2581,13 @@ def create_test_data():
                         # Pasos cada hora
                         time = datetime.combine(date, datetime.min.time()) + timedelta(hours=hour)
                         steps = random.randint(0, 1000)
-                        cursor.execute("""
-                            INSERT INTO intraday_metrics (user_id, time, type, value)
-                            VALUES (%s, %s, %s, %s)
-                        """, (user_id, time, 'steps', steps))
+                        cursor.execute(*intraday_insert_query(user_id, time, 'steps', steps))
                         # Frecuencia cardíaca cada hora
                         hr = random.randint(60, 120)
-                        cursor.execute("""
-                            INSERT INTO intraday_metrics (user_id, time, type, value)
-                            VALUES (%s, %s, %s, %s)
-                        """, (user_id, time, 'heart_rate', hr))
+                        cursor.execute(*intraday_insert_query(user_id, time, 'heart_rate', hr))
                         # Calorías cada hora
                         calories = random.randint(50, 200)
-                        cursor.execute("""
-                            INSERT INTO intraday_metrics (user_id, time, type, value)
-                            VALUES (%s, %s, %s, %s)
-                        """, (user_id, time, 'calories', calories))
+                        cursor.execute(*intraday_insert_query(user_id, time, 'calories', calories))
             
             # Crear alertas de prueba para la fecha de hoy
             alert_types = [
@@ -1359,6 +2619,7 @@ def create_test_data():
                 'Frecuencia cardíaca anormalmente alta',
                 False
             ))
+            cursor.execute(*user_status_refresh_query('test@example.com'))
             conn.commit()
             print("Datos de prueba creados exitosamente")
             return True
@@ -1479,6 +2740,7 @@ def generate_demo_data():
                 )
             )
             print(f"[DEMO] Daily summary insertado para usuario {user_id} en fecha {date}")
+        db.mark_user_data(user_id, date)
 
     # SOLO el primer usuario recibe datos intradía ricos y anómalos
     first_user_id = user_ids[0]
@@ -1492,14 +2754,8 @@ def generate_demo_data():
                 t = datetime.combine(date, datetime.min.time()) + timedelta(hours=h, minutes=m)
                 hr = 72 + random.randint(-4, 4)  # heart rate normal con variabilidad
                 st = 38 + random.randint(-6, 6)  # steps normal con variabilidad
-                db.execute_query(
-                    "INSERT INTO intraday_metrics (user_id, time, type, value) VALUES (%s, %s, %s, %s)",
-                    (first_user_id, t, 'heart_rate', hr)
-                )
-                db.execute_query(
-                    "INSERT INTO intraday_metrics (user_id, time, type, value) VALUES (%s, %s, %s, %s)",
-                    (first_user_id, t, 'steps', st)
-                )
+                db.execute_query(*intraday_insert_query(first_user_id, t, 'heart_rate', hr))
+                db.execute_query(*intraday_insert_query(first_user_id, t, 'steps', st))
     # Día 3: anomalías para alertas high y medium, y variabilidad en normales
     date = base_date - timedelta(days=2)
     # Generar datos base normales
@@ -1529,14 +2785,8 @@ def generate_demo_data():
             st = 85   # MEDIUM
         elif h == 22 and m == 0:
             st = 18   # MEDIUM
-        db.execute_query(
-            "INSERT INTO intraday_metrics (user_id, time, type, value) VALUES (%s, %s, %s, %s)",
-            (first_user_id, t, 'heart_rate', hr)
-        )
-        db.execute_query(
-            "INSERT INTO intraday_metrics (user_id, time, type, value) VALUES (%s, %s, %s, %s)",
-            (first_user_id, t, 'steps', st)
-        )
+        db.execute_query(*intraday_insert_query(first_user_id, t, 'heart_rate', hr))
+        db.execute_query(*intraday_insert_query(first_user_id, t, 'steps', st))
     print(f"[DEMO] Datos intradía simplificados (solo 2 anomalías HR) insertados para usuario {first_user_id}.")
 
     print("[DEMO] Evaluando alertas para todos los usuarios...")
@@ -0,0 +1,53 @@
+"""
+Reducción de series temporales para las gráficas intradía.
+
+Implementa Largest-Triangle-Three-Buckets (LTTB), que elige en cada cubo el punto
+que forma el triángulo de mayor área con sus vecinos. Conserva picos y valles
+(lo que importa para ver anomalías de frecuencia cardíaca) usando muchos menos
+puntos que la serie original.
+"""
+
+import numpy as np
+
+
+def lttb(times, values, threshold):
+    """
+    Reduce una serie a como máximo `threshold` puntos con LTTB.
+
+    Args:
+        times (array-like): Marcas de tiempo numéricas (p. ej. epoch en segundos), crecientes.
+        values (array-like): Valores de la serie.
+        threshold (int): Número de puntos deseado (>= 3).
+
+    Returns:
+        numpy.ndarray: Índices de los puntos seleccionados, en orden creciente.
+    """
+    x = np.asarray(times, dtype=np.float64)
+    y = np.asarray(values, dtype=np.float64)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    # Límites de los threshold - 2 cubos interiores (el primer y último punto van aparte)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # Punto medio del cubo siguiente (o el último punto en el cubo final)
+        next_start, next_end = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        if next_end <= next_start:
+            next_end = next_start + 1
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        # Área del triángulo (a, candidato, media del cubo siguiente) para todo el cubo a la vez
+        areas = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
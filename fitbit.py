@@ -1,8 +1,9 @@
-from base64 import b64encode
 from dotenv import load_dotenv
 import requests
 from datetime import datetime, timedelta
-from db import get_unique_emails, save_to_db, get_user_tokens, get_latest_user_id_by_email, update_users_tokens, insert_daily_summary, insert_intraday_metric, DatabaseManager
+from db import get_unique_emails, save_to_db, get_latest_user_id_by_email, insert_daily_summary, insert_intraday_metric, DatabaseManager, get_final_days, record_coverage, day_is_final
+from tokens import token_manager, api_session, get_last_sync_time
+from work_queue import WorkQueue, STREAM_DAILY, STREAM_ALERTS, PRIORITY_NORMAL
 
 import sys
 import os
@@ -24,48 +25,18 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-def refresh_access_token(refresh_token):
-    """
-    Refresca el access token usando el refresh token según el estándar OAuth 2.0 (RFC 6749).
-    """
-    url = "https://api.fitbit.com/oauth2/token"
-    CLIENT_ID = os.getenv("CLIENT_ID")
-    CLIENT_SECRET = os.getenv("CLIENT_SECRET")
-    
-    # Autenticación del cliente usando Basic Auth
-    auth_header = b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
-    headers = {
-        "Authorization": f"Basic {auth_header}",
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    
-    # Parámetros de la solicitud
-    data = {
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token
-    }
-    
-    # Hacer la solicitud POST
-    response = requests.post(url, headers=headers, data=data)
-    
-    # Verificar la respuesta
-    if response.status_code == 200:
-        # Si la solicitud es exitosa, devolver los nuevos tokens
-        new_tokens = response.json()
-        print(f"Token refreshed successfully: {new_tokens}")
-        return new_tokens.get("access_token"), new_tokens.get("refresh_token")
-    else:
-        # Si la solicitud falla, imprimir el error y devolver None
-        print(f"Error refreshing token: {response.status_code}, {response.text}")
-        return None, None
-    
-
+# Días más recientes (hasta hoy) que process_emails recoge de todos los usuarios antes del histórico
+FRESH_DAYS = 2
 
-def get_fitbit_data(access_token, email):
+def get_fitbit_data(access_token, email, progress=None, evaluate_alerts=True):
     headers = {"Authorization": f"Bearer {access_token}"}
+    def api_get(url):
+        # Contabiliza cada llamada a la API para el progreso de los trabajos en segundo plano
+        if progress:
+            progress.api_call()
+        return api_session.get(url, headers=headers)
     def fetch_and_store(date_str):
         user_id = get_latest_user_id_by_email(email)
-        db = DatabaseManager()
         if not user_id:
             logger.error(f"Error: No se encontró user_id para el email {email}")
             return False
@@ -88,7 +59,7 @@ def get_fitbit_data(access_token, email):
         try:
             # Datos de actividad diaria
             activity_url = f"https://api.fitbit.com/1/user/-/activities/date/{date_str}.json"
-            response = requests.get(activity_url, headers=headers)
+            response = api_get(activity_url)
             response.raise_for_status()
             activity_data = response.json()
             if 'summary' in activity_data:
@@ -104,35 +75,35 @@ def get_fitbit_data(access_token, email):
                 })
             # Frecuencia cardíaca
             heart_rate_url = f"https://api.fitbit.com/1/user/-/activities/heart/date/{date_str}/1d.json"
-            response = requests.get(heart_rate_url, headers=headers)
+            response = api_get(heart_rate_url)
             response.raise_for_status()
             heart_rate_data = response.json()
             if 'activities-heart' in heart_rate_data and heart_rate_data['activities-heart']:
                 data['heart_rate'] = heart_rate_data['activities-heart'][0].get('value', {}).get('restingHeartRate', 0)
             # Sueño
             sleep_url = f"https://api.fitbit.com/1.2/user/-/sleep/date/{date_str}.json"
-            response = requests.get(sleep_url, headers=headers)
+            response = api_get(sleep_url)
             response.raise_for_status()
             sleep_data = response.json()
             if 'sleep' in sleep_data:
                 data['sleep_minutes'] = sum(log.get('minutesAsleep', 0) for log in sleep_data['sleep'])
             # Nutrición
             nutrition_url = f"https://api.fitbit.com/1/user/-/foods/log/date/{date_str}.json"
-            response = requests.get(nutrition_url, headers=headers)
+            response = api_get(nutrition_url)
             response.raise_for_status()
             nutrition_data = response.json()
             if 'summary' in nutrition_data:
                 data['nutrition_calories'] = nutrition_data['summary'].get('calories', 0)
             # Agua
             water_url = f"https://api.fitbit.com/1/user/-/foods/log/water/date/{date_str}.json"
-            response = requests.get(water_url, headers=headers)
+            response = api_get(water_url)
             response.raise_for_status()
             water_data = response.json()
             if 'summary' in water_data:
                 data['water'] = water_data['summary'].get('water', 0)
             # SpO2
             spo2_url = f"https://api.fitbit.com/1/user/-/spo2/date/{date_str}.json"
-            response = requests.get(spo2_url, headers=headers)
+            response = api_get(spo2_url)
             if response.status_code == 200:
                 spo2_data = response.json()
                 if isinstance(spo2_data.get('value'), dict):
@@ -141,7 +112,7 @@ def get_fitbit_data(access_token, email):
                     data['spo2'] = float(spo2_data.get('value', 0))
             # Frecuencia respiratoria
             respiratory_rate_url = f"https://api.fitbit.com/1/user/-/br/date/{date_str}.json"
-            response = requests.get(respiratory_rate_url, headers=headers)
+            response = api_get(respiratory_rate_url)
             if response.status_code == 200:
                 respiratory_data = response.json()
                 if isinstance(respiratory_data.get('value'), dict):
@@ -150,7 +121,7 @@ def get_fitbit_data(access_token, email):
                     data['respiratory_rate'] = float(respiratory_data.get('value', 0))
             # Temperatura
             temperature_url = f"https://api.fitbit.com/1/user/-/temp/core/date/{date_str}.json"
-            response = requests.get(temperature_url, headers=headers)
+            response = api_get(temperature_url)
             if response.status_code == 200:
                 temperature_data = response.json()
                 data['temperature'] = temperature_data.get('value', 0)
@@ -160,26 +131,17 @@ def get_fitbit_data(access_token, email):
                 date=date_str,
                 **data
             )
-            # Evaluar alertas después de guardar los datos
+            if progress:
+                progress.rows(1)
+            # Evaluar alertas después de guardar los datos (en la cola de ingesta
+            # lo hace un trabajo propio, ver work_queue.STREAM_ALERTS)
             current_date = datetime.strptime(date_str, "%Y-%m-%d")
-            alerts = evaluate_all_alerts(user_id, current_date)
+            alerts = evaluate_all_alerts(user_id, current_date) if evaluate_alerts else None
             if alerts:
                 logger.info(f"Alertas generadas para {email}: {alerts}")
             # Verificar calidad de datos
-            if any(v == 0 for v in [data['steps'], data['active_minutes'], data['heart_rate']]):
-                if db.connect():
-                    try:
-                        db.insert_alert(
-                            user_id=user_id,
-                            alert_type='data_quality',
-                            priority='high',
-                            triggering_value=0,
-                            threshold='30',
-                            timestamp=current_date,
-                            details="alerts.data_quality.zero_values"
-                        )
-                    finally:
-                        db.close()
+            if evaluate_alerts:
+                check_data_quality(user_id, current_date, data)
             logger.info(f"Datos recopilados para {email} en {date_str}:")
             for key, value in data.items():
                 logger.info(f"{key}: {value}")
@@ -197,7 +159,61 @@ def get_fitbit_data(access_token, email):
             return False
     return fetch_and_store
 
-def process_emails(emails):
+def check_data_quality(user_id, current_date, data=None):
+    """
+    Inserta una alerta data_quality si el resumen del día tiene a cero los pasos,
+    los minutos activos o la frecuencia cardíaca.
+
+    Args:
+        user_id (int): ID del usuario.
+        current_date (datetime): Día del resumen.
+        data (dict, optional): Resumen recién descargado; si no se pasa, se lee el
+            guardado en daily_summaries (p. ej. desde work_queue.STREAM_ALERTS).
+    """
+    if data is not None and not any(v == 0 for v in [data['steps'], data['active_minutes'], data['heart_rate']]):
+        return
+    db = DatabaseManager()
+    if not db.connect():
+        return
+    try:
+        if data is None:
+            result = db.execute_query("""
+                SELECT steps, active_minutes, heart_rate FROM daily_summaries
+                WHERE user_id = %s AND date = %s
+            """, (user_id, current_date.date()))
+            if not result or not any(v == 0 for v in result[0]):
+                return
+        db.insert_alert(
+            user_id=user_id,
+            alert_type='data_quality',
+            priority='high',
+            triggering_value=0,
+            threshold='30',
+            timestamp=current_date,
+            details="alerts.data_quality.zero_values"
+        )
+    finally:
+        db.close()
+
+def process_emails(emails, progress=None):
+    """
+    Recopila los resúmenes diarios de cada email hasta hoy.
+
+    Primero recoge los últimos FRESH_DAYS días de todos los usuarios y solo
+    después, usuario a usuario, el histórico pendiente, del día más nuevo al más
+    antiguo: un usuario con meses de histórico por recuperar no retrasa los datos
+    de hoy (ni sus alertas) del resto, y de cada usuario se completa antes lo más
+    reciente.
+
+    Los días recientes se vuelven a descargar en cada ejecución, así que no
+    evalúan alertas: las de ayer, ya cerrado, se encolan una sola vez en
+    work_queue.STREAM_ALERTS, igual que en ingestion_daemon.schedule_alerts.
+
+    Args:
+        emails (list): Lista de correos electrónicos a procesar.
+        progress (optional): Objeto de progreso (ver jobs.RefreshJob) que recibe
+            las llamadas a la API, filas escritas y usuarios completados.
+    """
 
     # Filtrar correos electrónicos vacíos
     valid_emails = [email for email in emails if email and email.strip()]
@@ -208,72 +224,217 @@ def process_emails(emails):
     # Rango de fechas
     START_DATE = datetime(2025, 2, 1)
     END_DATE = datetime.now()
+    FRESH_START = datetime.combine(END_DATE.date(), datetime.min.time()) - timedelta(days=FRESH_DAYS - 1)
+
+    # Los datos recientes no se cuentan como usuario en el progreso: cada usuario
+    # empieza y termina una sola vez, en la segunda pasada
+    for email in valid_emails:
+        logger.info(f"\n=== Datos recientes de: {email} ===")
+        _process_email(email, FRESH_START, END_DATE, progress, use_checkpoint=False, evaluate_alerts=False)
+
+    # Evaluar un día inserta sus alertas: se hace una sola vez, con el día ya cerrado
+    yesterday = END_DATE.date() - timedelta(days=1)
+    queue = WorkQueue()
+    try:
+        for email in valid_emails:
+            queue.enqueue(email, STREAM_ALERTS, yesterday, yesterday, PRIORITY_NORMAL, once=True)
+    finally:
+        queue.close()
 
     for email in valid_emails:
         logger.info(f"\n=== Procesando usuario: {email} ===")
-        # Obtener y desencriptar los tokens
-        access_token, refresh_token = get_user_tokens(email)
-        if not access_token or not refresh_token:
-            logger.warning(f"No se encontraron tokens válidos para el correo {email}. Es necesario vincular nuevamente el dispositivo.")
-            continue
+        if progress:
+            progress.user_started(email)
+        try:
+            _process_email(email, START_DATE, FRESH_START - timedelta(days=1), progress)
+        finally:
+            if progress:
+                progress.user_done(email)
 
-        # Checkpoint path
-        checkpoint_path = f"logs/checkpoint_{email.replace('@','_at_')}.json"
-        # Leer checkpoint
-        if os.path.exists(checkpoint_path):
-            with open(checkpoint_path, 'r') as f:
-                checkpoint = json.load(f)
-            last_date_str = checkpoint.get('last_date')
-            if last_date_str:
-                current_date = datetime.strptime(last_date_str, "%Y-%m-%d")
-            else:
-                current_date = START_DATE
+def _read_checkpoint(checkpoint_path, start_date):
+    """
+    Lee el intervalo de días ya recopilado de un email.
+
+    Returns:
+        tuple: (día más antiguo, día más nuevo) como date, o None si no hay checkpoint.
+            Los checkpoints antiguos ({'last_date'}, recorrido hacia delante desde
+            start_date) se interpretan como completos hasta el día anterior.
+    """
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('oldest_date') and checkpoint.get('newest_date'):
+        return (datetime.strptime(checkpoint['oldest_date'], "%Y-%m-%d").date(),
+                datetime.strptime(checkpoint['newest_date'], "%Y-%m-%d").date())
+    if checkpoint.get('last_date'):
+        last_date = datetime.strptime(checkpoint['last_date'], "%Y-%m-%d").date()
+        return start_date, last_date - timedelta(days=1)
+    return None
+
+def _days_newest_first(first_day, last_day):
+    """Días de [first_day, last_day], del más nuevo al más antiguo."""
+    return [last_day - timedelta(days=n) for n in range((last_day - first_day).days + 1)]
+
+def _process_email(email, start_date, end_date, progress=None, use_checkpoint=True, evaluate_alerts=True):
+    """
+    Recopila los días pendientes de un único email, del más nuevo al más antiguo.
+
+    El checkpoint guarda el intervalo continuo de días ya recopilado
+    ({'oldest_date', 'newest_date'}). Se recogen primero los días posteriores a ese
+    intervalo (los que han salido de la ventana reciente desde la última vez) y
+    después los anteriores, bajando hasta start_date. Con use_checkpoint=False
+    recoge todo el rango sin leer ni actualizar el checkpoint; con
+    evaluate_alerts=False no evalúa alertas (ver get_fitbit_data).
+    """
+    # Token vigente desde la caché compartida (se refresca antes de caducar)
+    access_token = token_manager.get_access_token(email)
+    if not access_token:
+        logger.warning(f"No se encontraron tokens válidos para el correo {email}. Es necesario vincular nuevamente el dispositivo.")
+        return
+
+    first_day, last_day = start_date.date(), end_date.date()
+    checkpoint_path = f"logs/checkpoint_{email.replace('@','_at_')}.json"
+    done = _read_checkpoint(checkpoint_path, first_day) if use_checkpoint else None
+    if done:
+        top_low = max(done[1] + timedelta(days=1), first_day)
+        days = _days_newest_first(top_low, last_day) + _days_newest_first(first_day, min(done[0] - timedelta(days=1), last_day))
+    else:
+        top_low = None
+        days = _days_newest_first(first_day, last_day)
+
+    def complete(day):
+        # Amplía el intervalo recopilado solo si sigue siendo continuo
+        nonlocal done
+        if done is None:
+            done = (day, last_day)
+        elif day == top_low and day > done[1]:
+            done = (done[0], last_day)
+        elif day == done[0] - timedelta(days=1):
+            done = (day, done[1])
         else:
-            current_date = START_DATE
+            return
+        if use_checkpoint:
+            with open(checkpoint_path, 'w') as f:
+                json.dump({'oldest_date': done[0].strftime("%Y-%m-%d"),
+                           'newest_date': done[1].strftime("%Y-%m-%d")}, f)
 
-        fetch_and_store = get_fitbit_data(access_token, email)
-        rate_limit_hit = False
-        current_access_token = access_token
-        current_refresh_token = refresh_token
-        while current_date <= END_DATE:
-            date_str = current_date.strftime("%Y-%m-%d")
-            logger.info(f"Procesando {date_str} para {email}")
-            try:
-                success = fetch_and_store(date_str)
-                if success:
-                    logger.info(f"Datos recopilados exitosamente para {email} en {date_str}.")
-                # Guardar checkpoint
-                with open(checkpoint_path, 'w') as f:
-                    json.dump({'last_date': date_str}, f)
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 401:
-                    logger.warning(f"Token expirado para el correo {email}. Intentando refrescar el token...")
-                    new_access_token, new_refresh_token = refresh_access_token(current_refresh_token)
-                    if new_access_token and new_refresh_token:
-                        update_users_tokens(email, new_access_token, new_refresh_token)
-                        current_access_token = new_access_token
-                        current_refresh_token = new_refresh_token
-                        fetch_and_store = get_fitbit_data(current_access_token, email)
-                        continue  # Reintentar el mismo día con el nuevo token
-                    else:
-                        logger.error(f"No se pudo refrescar el token para el correo {email}. Es necesario vincular nuevamente el dispositivo.")
-                        break
-                elif e.response.status_code == 429:
-                    logger.warning(f"Rate limit alcanzado para {email} en {date_str}. Guardando checkpoint y saltando al siguiente usuario.")
-                    with open(checkpoint_path, 'w') as f:
-                        json.dump({'last_date': date_str}, f)
-                    rate_limit_hit = True
-                    break
+    # Los días cerrados (ver db.day_is_final) no se vuelven a descargar
+    user_id = get_latest_user_id_by_email(email)
+    final_days = get_final_days(user_id, STREAM_DAILY, first_day, last_day) if user_id else set()
+    last_sync = None
+    sync_checked = False
+
+    fetch_and_store = get_fitbit_data(access_token, email, progress, evaluate_alerts)
+    stopped = False
+    index = 0
+    while index < len(days):
+        day = days[index]
+        if day in final_days:
+            complete(day)
+            index += 1
+            continue
+        # En backfills largos el token puede caducar: se renueva antes de la petición
+        current_access_token = token_manager.get_access_token(email)
+        if not current_access_token:
+            stopped = True
+            break
+        if current_access_token != access_token:
+            access_token = current_access_token
+            fetch_and_store = get_fitbit_data(access_token, email, progress, evaluate_alerts)
+        date_str = day.strftime("%Y-%m-%d")
+        logger.info(f"Procesando {date_str} para {email}")
+        try:
+            if not sync_checked:
+                last_sync = get_last_sync_time(access_token, progress)
+                sync_checked = True
+            success = fetch_and_store(date_str)
+            if success:
+                logger.info(f"Datos recopilados exitosamente para {email} en {date_str}.")
+                record_coverage(user_id, STREAM_DAILY, day, day_is_final(day, last_sync))
+            # Guardar checkpoint
+            complete(day)
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 401:
+                logger.warning(f"Token rechazado para el correo {email}. Intentando refrescar el token...")
+                new_access_token = token_manager.handle_unauthorized(email, access_token)
+                if new_access_token:
+                    access_token = new_access_token
+                    fetch_and_store = get_fitbit_data(access_token, email, progress, evaluate_alerts)
+                    continue  # Reintentar el mismo día con el nuevo token
                 else:
-                    logger.error(f"Error HTTP al obtener datos de Fitbit para el correo {email}: {e}")
-            except Exception as e:
-                logger.error(f"Error inesperado al procesar el correo {email} en {date_str}: {e}")
-            # Sleep para evitar rate limit
-            time.sleep(1)
-            current_date += timedelta(days=1)
+                    logger.error(f"No se pudo refrescar el token para el correo {email}. Es necesario vincular nuevamente el dispositivo.")
+                    stopped = True
+                    break
+            elif e.response.status_code == 429:
+                logger.warning(f"Rate limit alcanzado para {email} en {date_str}. Checkpoint guardado; saltando al siguiente usuario.")
+                stopped = True
+                break
+            else:
+                logger.error(f"Error HTTP al obtener datos de Fitbit para el correo {email}: {e}")
+                complete(day)
+        except Exception as e:
+            logger.error(f"Error inesperado al procesar el correo {email} en {date_str}: {e}")
+            complete(day)
+        # Sleep para evitar rate limit
+        time.sleep(1)
+        index += 1
+
+    if not stopped:
+        logger.info(f"Usuario {email} está up to date. Todos los datos recopilados entre {first_day} y {last_day}.")
+
+def collect_daily_range(email, start_date, end_date, progress=None, evaluate_alerts=False):
+    """
+    Recopila los resúmenes diarios de un email entre dos fechas (ambas incluidas).
+
+    A diferencia de _process_email no usa checkpoint (los resúmenes se guardan
+    con upsert, así que repetir un rango no duplica datos) y un 429 se propaga
+    para que quien lo llama (p. ej. un trabajo de work_queue) lo reintente más tarde.
+    Los días cerrados (ver db.day_is_final) se saltan sin ninguna petición.
+    Por defecto no evalúa alertas: un rango puede repetirse y cada evaluación
+    inserta alertas nuevas; la cola las evalúa una vez por día en su propio trabajo.
 
-        if not rate_limit_hit and current_date > END_DATE:
-            logger.info(f"Usuario {email} está up to date. Todos los datos recopilados hasta {END_DATE.strftime('%Y-%m-%d')}.")
+    Returns:
+        int: Número de días recopilados correctamente (sin contar los cerrados).
+
+    Raises:
+        requests.exceptions.HTTPError: Ante 429 o un 401 que persiste tras refrescar.
+        RuntimeError: Si el usuario no existe o no tiene un token válido.
+    """
+    user_id = get_latest_user_id_by_email(email)
+    if not user_id:
+        raise RuntimeError(f"No se encontró user_id para el email {email}")
+    final_days = get_final_days(user_id, STREAM_DAILY, start_date, end_date)
+    last_sync = None
+    sync_checked = False
+    days_done = 0
+    current_date = start_date
+    retried = False
+    while current_date <= end_date:
+        if current_date in final_days:
+            current_date += timedelta(days=1)
+            continue
+        access_token = token_manager.get_access_token(email)
+        if not access_token:
+            raise RuntimeError(f"No hay un token válido para {email}. Es necesario vincular nuevamente el dispositivo.")
+        date_str = current_date.strftime("%Y-%m-%d")
+        try:
+            # Una consulta de la última sincronización por rango, solo si hay algo que descargar
+            if not sync_checked:
+                last_sync = get_last_sync_time(access_token, progress)
+                sync_checked = True
+            if get_fitbit_data(access_token, email, progress, evaluate_alerts)(date_str):
+                days_done += 1
+                record_coverage(user_id, STREAM_DAILY, current_date, day_is_final(current_date, last_sync))
+        except requests.exceptions.HTTPError as e:
+            if (not retried and e.response is not None and e.response.status_code == 401
+                    and token_manager.handle_unauthorized(email, access_token)):
+                retried = True
+                continue
+            raise
+        retried = False
+        current_date += timedelta(days=1)
+    return days_done
 
 if __name__ == "__main__":
     # Crear directorio de logs si no existe
@@ -10,6 +10,8 @@ FUNCIONALIDAD PRINCIPAL:
 - El checkpoint se guarda por usuario y permite reanudar si se interrumpe la ejecución.
 - El rango de backfill es fácilmente modificable editando las variables al principio del script.
 - Cuando termines el backfill, pon ambas variables a None para volver al modo normal.
+- Con --poll [minutos] se ejecuta como proceso continuo que cada pocos minutos recoge solo los
+  puntos nuevos del día en curso (ver collect_intraday_range).
 
 Variables clave a modificar:
     BACKFILL_START_DATE = "2025-05-21"  # Primer día a recopilar (incluido)
@@ -18,11 +20,15 @@ Variables clave a modificar:
 Si tienes dudas, revisa este bloque o busca 'BACKFILL' en el código.
 """
 
-from base64 import b64encode
 from dotenv import load_dotenv
 import requests
+import numpy as np
 from datetime import datetime, timedelta
-from db import get_unique_emails, get_latest_user_id_by_email, insert_intraday_metric, get_user_tokens, update_users_tokens
+from concurrent.futures import ThreadPoolExecutor
+from db import get_unique_emails, get_latest_user_id_by_email, get_last_intraday_times, insert_intraday_batch, store_packed_intraday, PACKED_DETAIL_LEVELS, refresh_intraday_rollups, get_final_days, record_coverage, day_is_final
+from config import INTRADAY_DETAIL_LEVELS
+from tokens import token_manager, api_session, get_last_sync_time
+from work_queue import STREAM_INTRADAY
 import sys
 import os
 import json
@@ -42,8 +48,124 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-CLIENT_ID = os.getenv('CLIENT_ID')
-CLIENT_SECRET = os.getenv('CLIENT_SECRET')
+# --- REGISTRO DE MÉTRICAS INTRADÍA ---
+# Cada serie intradía se describe con un IntradayMetric y get_intraday_data las
+# recorre todas con el mismo flujo: petición -> extracción de puntos -> filtro por
+# checkpoint -> escritura por lotes. Añadir una serie es añadir una entrada a
+# INTRADAY_METRICS, por ejemplo:
+#
+#     IntradayMetric('spo2', 'spo2/date/{date}/all.json', minute_points(), time_window=False),
+#     IntradayMetric('hrv', 'hrv/date/{date}/all.json', minute_points('hrv', 'rmssd'), time_window=False),
+#
+# (con INTRADAY_LAYOUT = 'wide' hay que añadir además su columna a intraday_wide
+# y a db.INTRADAY_METRIC_TYPES).
+FITBIT_USER_API = "https://api.fitbit.com/1/user/-"
+
+# Formas de guardar una serie
+STORAGE_ROWS = 'rows'        # Un registro por punto (intraday_metrics / intraday_wide)
+STORAGE_PACKED = 'packed'    # Un registro por día (intraday_packed)
+STORAGE_AUTO = 'auto'        # Empaquetada solo a las resoluciones de db.PACKED_DETAIL_LEVELS
+
+DEFAULT_DETAIL_LEVEL = "15min"
+
+# Peticiones simultáneas a la API por usuario y día (una por métrica)
+INTRADAY_FETCH_WORKERS = int(os.getenv("INTRADAY_FETCH_WORKERS", "5"))
+
+# Intervalo (minutos) del sondeo incremental del día en curso (--poll)
+INTRADAY_POLL_MINUTES = int(os.getenv("INTRADAY_POLL_MINUTES", "15"))
+
+def dataset_points(response_key):
+    """
+    Extractor para las series de actividad y frecuencia cardíaca:
+    {response_key: {'dataset': [{'time': 'HH:MM:SS', 'value': v}, ...]}}
+    """
+    def extract(data):
+        intraday = data.get(response_key)
+        if not isinstance(intraday, dict):
+            return []
+        return [(point.get('time'), point.get('value')) for point in intraday.get('dataset', [])]
+    return extract
+
+def minute_points(response_key=None, value_field=None):
+    """
+    Extractor para las series por minuto con fecha completa (SpO2, HRV):
+    [{'minutes': [{'minute': 'YYYY-MM-DDTHH:MM:SS', 'value': v}, ...]}, ...]
+
+    Args:
+        response_key (str, optional): Clave de la lista de días; None si la respuesta es el día.
+        value_field (str, optional): Campo a usar cuando el valor es un diccionario.
+    """
+    def extract(data):
+        days = data.get(response_key) if response_key else data
+        if isinstance(days, dict):
+            days = [days]
+        points = []
+        for day in days or []:
+            for minute in day.get('minutes', []):
+                value = minute.get('value')
+                if value_field and isinstance(value, dict):
+                    value = value.get(value_field)
+                points.append((minute.get('minute'), value))
+        return points
+    return extract
+
+class IntradayMetric:
+    """
+    Descriptor de una serie intradía de Fitbit.
+
+    Args:
+        name (str): Tipo con el que se guarda ('heart_rate', 'steps', ...).
+        path (str): Ruta bajo /1/user/-/ con los huecos {date} y, si la admite, {detail}.
+        extract (callable): Respuesta JSON -> lista de (hora, valor); la hora es
+            'HH:MM:SS' del día pedido o una fecha y hora ISO completa.
+        detail_levels (tuple): Resoluciones que admite la API para esta serie.
+        storage (str): STORAGE_ROWS, STORAGE_PACKED o STORAGE_AUTO.
+        time_window (bool): Si la API admite pedir solo un tramo del día
+            (.../time/HH:mm/HH:mm.json); lo usa el sondeo incremental.
+    """
+
+    def __init__(self, name, path, extract, detail_levels=('1min', '5min', '15min'), storage=STORAGE_AUTO,
+                 time_window=True):
+        self.name = name
+        self.path = path
+        self.extract = extract
+        self.detail_levels = detail_levels
+        self.storage = storage
+        self.time_window = time_window
+
+    def detail_level(self):
+        """Resolución configurada (config.INTRADAY_DETAIL_LEVELS), validada."""
+        level = INTRADAY_DETAIL_LEVELS.get(self.name, DEFAULT_DETAIL_LEVEL)
+        if level not in self.detail_levels:
+            logger.warning(f"Resolución '{level}' no válida para {self.name}; se usa {DEFAULT_DETAIL_LEVEL}")
+            return DEFAULT_DETAIL_LEVEL
+        return level
+
+    def storage_for(self, detail_level):
+        if self.storage != STORAGE_AUTO:
+            return self.storage
+        return STORAGE_PACKED if detail_level in PACKED_DETAIL_LEVELS else STORAGE_ROWS
+
+    def url(self, date_str, detail_level, window_start=None):
+        """URL del día; con window_start (datetime), solo desde ese minuto hasta el final del día."""
+        path = self.path
+        if window_start is not None and self.time_window:
+            path = path.replace('.json', f"/time/{window_start:%H:%M}/23:59.json")
+        return f"{FITBIT_USER_API}/{path.format(date=date_str, detail=detail_level)}"
+
+INTRADAY_METRICS = (
+    IntradayMetric('heart_rate', 'activities/heart/date/{date}/1d/{detail}.json',
+                   dataset_points('activities-heart-intraday'),
+                   detail_levels=('1sec', '1min', '5min', '15min')),
+    IntradayMetric('steps', 'activities/steps/date/{date}/1d/{detail}.json',
+                   dataset_points('activities-steps-intraday')),
+    IntradayMetric('calories', 'activities/calories/date/{date}/1d/{detail}.json',
+                   dataset_points('activities-calories-intraday')),
+    IntradayMetric('distance', 'activities/distance/date/{date}/1d/{detail}.json',
+                   dataset_points('activities-distance-intraday')),
+    IntradayMetric('active_zone_minutes', 'activities/active-zone-minutes/date/{date}/1d/{detail}.json',
+                   dataset_points('activities-active-zone-minutes-intraday')),
+)
 
 # --- CHECKPOINT HELPERS ---
 def get_checkpoint(email):
@@ -64,31 +186,127 @@ def update_checkpoint(email, checkpoint):
     except Exception as e:
         logger.warning(f"No se pudo guardar el checkpoint para {email}: {e}")
 
-# --- TOKEN REFRESH ---
-def refresh_access_token(refresh_token):
-    url = "https://api.fitbit.com/oauth2/token"
-    auth_header = b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
-    headers = {
-        "Authorization": f"Basic {auth_header}",
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
-    data = {
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token
-    }
-    logger.info(f"Refreshing token for refresh_token: {refresh_token[:10]}...")
-    response = requests.post(url, headers=headers, data=data)
-    if response.status_code == 200:
-        new_tokens = response.json()
-        logger.info(f"Token refreshed successfully")
-        return new_tokens.get("access_token"), new_tokens.get("refresh_token")
+# --- INTRADAY DATA COLLECTION ---
+def _clock_offsets(time_strings):
+    """Segundos desde medianoche de una lista de horas 'HH:MM:SS', sin strptime por punto."""
+    # Cada carácter de un array 'U8' es un entero UCS-4: se leen los dígitos como una matriz n x 8
+    digits = np.asarray(time_strings, dtype='U8').view(np.uint32).reshape(-1, 8).astype(np.int64) - ord('0')
+    hours = digits[:, 0] * 10 + digits[:, 1]
+    minutes = digits[:, 3] * 10 + digits[:, 4]
+    seconds = digits[:, 6] * 10 + digits[:, 7]
+    return hours * 3600 + minutes * 60 + seconds
+
+def parse_points(raw_points, date_str, since=None):
+    """
+    Convierte los (hora, valor) de un extractor en arrays de un día, ordenados y
+    filtrados de una vez.
+
+    Las horas 'HH:MM:SS' se pasan a segundos desde el inicio del día con aritmética
+    sobre los dígitos; las fechas ISO completas (SpO2, HRV), con datetime64 de NumPy.
+    El checkpoint se convierte una sola vez a segundos y se compara con todo el array.
+    Se descartan los puntos sin hora o sin valor numérico, los no posteriores a since
+    y, en instantes repetidos, todos menos el último.
+
+    Args:
+        raw_points (list): Tuplas (hora, valor) de IntradayMetric.extract.
+        date_str (str): Día pedido ('YYYY-MM-DD').
+        since (datetime, optional): Checkpoint; solo se conservan puntos posteriores.
+
+    Returns:
+        tuple: (day_start, offsets, values): medianoche del día y arrays de NumPy con
+            los segundos desde day_start y los valores.
+    """
+    day_start = datetime.strptime(date_str, "%Y-%m-%d")
+    points = [(t, v) for t, v in raw_points if t and isinstance(v, (int, float))]
+    if not points:
+        return day_start, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    times = [t for t, _ in points]
+    values = np.array([v for _, v in points], dtype=np.float64)
+    if all(len(t) == 8 for t in times):
+        offsets = _clock_offsets(times)
     else:
-        logger.error(f"Error refreshing token: {response.status_code}, {response.text}")
-        return None, None
+        stamps = np.array(times, dtype='datetime64[ms]').astype('datetime64[s]')
+        offsets = (stamps - np.datetime64(day_start, 's')).astype(np.int64)
+    if since is not None:
+        keep = offsets > (since - day_start).total_seconds()
+        offsets, values = offsets[keep], values[keep]
+    # np.unique ordena y devuelve la primera aparición; sobre los arrays invertidos, la última
+    offsets, index = np.unique(offsets[::-1], return_index=True)
+    return day_start, offsets, values[::-1][index]
 
-# --- INTRADAY DATA COLLECTION ---
-def get_intraday_data(access_token, email, date_str=None):
+def collect_metric(metric, api_get, user_id, date_str, since=None, windowed=False):
+    """
+    Descarga, filtra y guarda por lotes un día de una serie.
+
+    Args:
+        metric (IntradayMetric): Serie a recopilar.
+        api_get (callable): URL -> respuesta (ver make_api_get).
+        user_id (int): ID del usuario.
+        date_str (str): Día ('YYYY-MM-DD').
+        since (datetime, optional): Solo se guardan los puntos posteriores.
+        windowed (bool): Pedir a la API solo el tramo desde since, si cae en el día.
+
+    Returns:
+        tuple: (número de puntos nuevos, instante del último punto o None)
+
+    Raises:
+        requests.exceptions.HTTPError: Ante 401 o 429, para que el llamador refresque
+            el token o se detenga.
+    """
+    detail_level = metric.detail_level()
+    window_start = since if windowed and since and since.strftime("%Y-%m-%d") == date_str else None
+    response = api_get(metric.url(date_str, detail_level, window_start))
+    if response.status_code in (401, 429):
+        response.raise_for_status()
+    if response.status_code != 200:
+        logger.warning(f"Respuesta {response.status_code} al pedir {metric.name} de {date_str}")
+        return 0, None
+    day_start, offsets, values = parse_points(metric.extract(response.json()), date_str, since)
+    if not len(offsets):
+        return 0, None
+    if metric.storage_for(detail_level) == STORAGE_PACKED:
+        store_packed_intraday(user_id, metric.name, day_start, offsets, values, detail_level)
+    else:
+        # datetime64[s].tolist() crea los datetime en C, sin un timedelta por punto
+        timestamps = (np.datetime64(day_start, 's') + offsets.astype('timedelta64[s]')).tolist()
+        insert_intraday_batch(user_id, metric.name, list(zip(timestamps, values.tolist())))
+    logger.info(f"{metric.name}: {len(offsets)} puntos nuevos ({detail_level})")
+    return len(offsets), day_start + timedelta(seconds=int(offsets[-1]))
+
+def make_api_get(access_token, progress=None, failures=None):
+    """
+    Función URL -> respuesta autenticada con el token del usuario.
+
+    Si se pasa la lista failures, recibe las URL cuya respuesta no fue 200.
+    """
     headers = {"Authorization": f"Bearer {access_token}"}
+    def api_get(url):
+        # Contabiliza cada llamada a la API para el progreso de los trabajos en segundo plano
+        if progress:
+            progress.api_call()
+        response = api_session.get(url, headers=headers)
+        if failures is not None and response.status_code != 200:
+            failures.append(url)
+        return response
+    return api_get
+
+def collect_day(api_get, user_id, date_str, since_by_metric, metrics=INTRADAY_METRICS, windowed=False):
+    """
+    Recopila un día de todas las métricas en paralelo (son independientes).
+
+    Returns:
+        dict: Nombre de métrica -> (puntos nuevos, instante del último punto o None)
+    """
+    with ThreadPoolExecutor(max_workers=INTRADAY_FETCH_WORKERS) as executor:
+        futures = {
+            metric.name: executor.submit(collect_metric, metric, api_get, user_id, date_str,
+                                         since_by_metric.get(metric.name), windowed)
+            for metric in metrics
+        }
+    return {name: future.result() for name, future in futures.items()}
+
+def get_intraday_data(access_token, email, date_str=None, progress=None, metrics=INTRADAY_METRICS):
+    api_get = make_api_get(access_token, progress)
     if date_str is None:
         today = datetime.now().strftime("%Y-%m-%d")
     else:
@@ -100,106 +318,21 @@ def get_intraday_data(access_token, email, date_str=None):
     checkpoint = get_checkpoint(email)
     try:
         logger.info(f"\n=== INICIALIZANDO RECOLECCIÓN DE DATOS INTRADÍA PARA {email} ({today}) ===")
-        total_heart_rate_points = 0
-        total_steps_points = 0
-        total_calories_points = 0
-        total_active_zone_points = 0
-        total_distance_points = 0
-        detail_level = "15min"
-        # 1. FRECUENCIA CARDÍACA INTRADÍA (Heart Rate)
-        heart_rate_url = f"https://api.fitbit.com/1/user/-/activities/heart/date/{today}/1d/{detail_level}.json"
-        heart_response = requests.get(heart_rate_url, headers=headers)
-        last_hr_ts = checkpoint.get("heart_rate")
-        if heart_response.status_code == 200:
-            heart_data = heart_response.json()
-            if 'activities-heart-intraday' in heart_data:
-                intraday_data = heart_data['activities-heart-intraday']
-                dataset = intraday_data.get('dataset', [])
-                for point in dataset:
-                    time_str = point.get('time')
-                    value = point.get('value')
-                    if time_str and value is not None:
-                        timestamp = datetime.strptime(f"{today} {time_str}", "%Y-%m-%d %H:%M:%S")
-                        if not last_hr_ts or timestamp > datetime.strptime(last_hr_ts, "%Y-%m-%d %H:%M:%S"):
-                            insert_intraday_metric(user_id, timestamp, 'heart_rate', value)
-                            total_heart_rate_points += 1
-                            checkpoint["heart_rate"] = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        # 2. PASOS INTRADÍA (Steps)
-        steps_url = f"https://api.fitbit.com/1/user/-/activities/steps/date/{today}/1d/{detail_level}.json"
-        steps_response = requests.get(steps_url, headers=headers)
-        last_steps_ts = checkpoint.get("steps")
-        if steps_response.status_code == 200:
-            steps_data = steps_response.json()
-            if 'activities-steps-intraday' in steps_data:
-                intraday_data = steps_data['activities-steps-intraday']
-                dataset = intraday_data.get('dataset', [])
-                for point in dataset:
-                    time_str = point.get('time')
-                    value = point.get('value')
-                    if time_str and value is not None:
-                        timestamp = datetime.strptime(f"{today} {time_str}", "%Y-%m-%d %H:%M:%S")
-                        if not last_steps_ts or timestamp > datetime.strptime(last_steps_ts, "%Y-%m-%d %H:%M:%S"):
-                            insert_intraday_metric(user_id, timestamp, 'steps', value)
-                            total_steps_points += 1
-                            checkpoint["steps"] = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        # 3. CALORÍAS INTRADÍA (Calories)
-        calories_url = f"https://api.fitbit.com/1/user/-/activities/calories/date/{today}/1d/{detail_level}.json"
-        calories_response = requests.get(calories_url, headers=headers)
-        last_calories_ts = checkpoint.get("calories")
-        if calories_response.status_code == 200:
-            calories_data = calories_response.json()
-            if 'activities-calories-intraday' in calories_data:
-                intraday_data = calories_data['activities-calories-intraday']
-                dataset = intraday_data.get('dataset', [])
-                for point in dataset:
-                    time_str = point.get('time')
-                    value = point.get('value')
-                    if time_str and value is not None:
-                        timestamp = datetime.strptime(f"{today} {time_str}", "%Y-%m-%d %H:%M:%S")
-                        if not last_calories_ts or timestamp > datetime.strptime(last_calories_ts, "%Y-%m-%d %H:%M:%S"):
-                            insert_intraday_metric(user_id, timestamp, 'calories', value)
-                            total_calories_points += 1
-                            checkpoint["calories"] = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        # 4. DISTANCIA INTRADÍA (Distance)
-        distance_url = f"https://api.fitbit.com/1/user/-/activities/distance/date/{today}/1d/{detail_level}.json"
-        distance_response = requests.get(distance_url, headers=headers)
-        last_distance_ts = checkpoint.get("distance")
-        if distance_response.status_code == 200:
-            distance_data = distance_response.json()
-            if 'activities-distance-intraday' in distance_data:
-                intraday_data = distance_data['activities-distance-intraday']
-                dataset = intraday_data.get('dataset', [])
-                for point in dataset:
-                    time_str = point.get('time')
-                    value = point.get('value')
-                    if time_str and value is not None:
-                        timestamp = datetime.strptime(f"{today} {time_str}", "%Y-%m-%d %H:%M:%S")
-                        if not last_distance_ts or timestamp > datetime.strptime(last_distance_ts, "%Y-%m-%d %H:%M:%S"):
-                            insert_intraday_metric(user_id, timestamp, 'distance', value)
-                            total_distance_points += 1
-                            checkpoint["distance"] = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        # 5. MINUTOS EN ZONAS ACTIVAS (Active Zone Minutes)
-        azm_url = f"https://api.fitbit.com/1/user/-/activities/active-zone-minutes/date/{today}/1d/{detail_level}.json"
-        azm_response = requests.get(azm_url, headers=headers)
-        last_azm_ts = checkpoint.get("active_zone_minutes")
-        if azm_response.status_code == 200:
-            azm_data = azm_response.json()
-            intraday_key = 'activities-active-zone-minutes-intraday'
-            if intraday_key in azm_data:
-                intraday_data = azm_data[intraday_key]
-                dataset = intraday_data.get('dataset', [])
-                for point in dataset:
-                    time_str = point.get('time')
-                    value = point.get('value')
-                    if time_str and value is not None:
-                        timestamp = datetime.strptime(f"{today} {time_str}", "%Y-%m-%d %H:%M:%S")
-                        if not last_azm_ts or timestamp > datetime.strptime(last_azm_ts, "%Y-%m-%d %H:%M:%S"):
-                            insert_intraday_metric(user_id, timestamp, 'active_zone_minutes', value)
-                            total_active_zone_points += 1
-                            checkpoint["active_zone_minutes"] = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        # El checkpoint se convierte a datetime una sola vez por métrica
+        since_by_metric = {
+            metric.name: datetime.strptime(checkpoint[metric.name], "%Y-%m-%d %H:%M:%S")
+            for metric in metrics if checkpoint.get(metric.name)
+        }
+        results = collect_day(api_get, user_id, today, since_by_metric, metrics)
+        total_points = 0
+        for name, (count, last_timestamp) in results.items():
+            total_points += count
+            if last_timestamp:
+                checkpoint[name] = last_timestamp.strftime("%Y-%m-%d %H:%M:%S")
         update_checkpoint(email, checkpoint)
-        total_points = (total_heart_rate_points + total_steps_points + total_calories_points + total_distance_points + total_active_zone_points)
         logger.info(f"Total de puntos recolectados: {total_points}")
+        if progress:
+            progress.rows(total_points)
         if total_points > 0:
             logger.info("\n✅ RECOLECCIÓN DE DATOS INTRADÍA EXITOSA")
             return True
@@ -207,8 +340,8 @@ def get_intraday_data(access_token, email, date_str=None):
             logger.warning("\n❌ NO SE PUDIERON RECOLECTAR DATOS INTRADÍA")
             return False
     except requests.exceptions.HTTPError as e:
-        if hasattr(e, 'response') and e.response and e.response.status_code == 401:
-            logger.error(f"Error de autenticación (401): {str(e)}")
+        if e.response is not None and e.response.status_code in (401, 429):
+            logger.error(f"Error HTTP {e.response.status_code} al obtener datos intradía: {str(e)}")
             raise
         logger.error(f"Error HTTP al obtener datos intradía: {e}")
         return False
@@ -223,125 +356,215 @@ BACKFILL_START_DATE = "2025-05-21"  # Primer día a recopilar (incluido)
 BACKFILL_END_DATE = "2025-05-28"    # Último día a recopilar (incluido)
 
 # --- MAIN WORKFLOW ---
-def process_all_users():
-    unique_emails = get_unique_emails()
+def process_all_users(emails=None, progress=None):
+    """
+    Recopila los datos intradía de todos los usuarios (o de los emails indicados).
+
+    Args:
+        emails (list, optional): Emails a procesar. Por defecto, todos los de la base de datos.
+        progress (optional): Objeto de progreso (ver jobs.RefreshJob).
+    """
+    unique_emails = emails if emails is not None else get_unique_emails()
     if not unique_emails:
         logger.error("No se encontraron emails en la base de datos")
         return
     today = datetime.now().date()
     for email in unique_emails:
         logger.info(f"\n=== Procesando usuario: {email} ===")
-        access_token, refresh_token = get_user_tokens(email)
-        if not access_token or not refresh_token:
-            logger.warning(f"No se encontraron tokens válidos para el correo {email}. Es necesario vincular nuevamente el dispositivo.")
-            continue
-        current_access_token = access_token
-        current_refresh_token = refresh_token
-        # Leer checkpoint
-        checkpoint_path = f"logs/checkpoint_intraday_{email}.json"
-        if os.path.exists(checkpoint_path):
-            with open(checkpoint_path, 'r', encoding='utf-8') as f:
-                checkpoint_data = json.load(f)
-            last_date_str = checkpoint_data.get('last_date')
-            if last_date_str:
-                last_date = datetime.strptime(last_date_str, "%Y-%m-%d").date()
-            else:
-                last_date = None
+        if progress:
+            progress.user_started(email)
+        try:
+            _process_user(email, today, progress)
+        finally:
+            if progress:
+                progress.user_done(email)
+    logger.info("=== FIN DE EJECUCIÓN DE FITBIT INTRADAY ===")
+
+def _collect_date(email, date_str, checkpoint_path, progress=None):
+    """
+    Recopila un día con el token vigente; tras un 401 reintenta una vez con un token nuevo.
+
+    Returns:
+        bool: False si hay que dejar de procesar al usuario (sin token válido o rate limit).
+    """
+    access_token = token_manager.get_access_token(email)
+    if not access_token:
+        logger.error(f"No hay un token válido para {email}. Reautorice el dispositivo.")
+        return False
+    for attempt in range(2):
+        try:
+            logger.info(f"Recolectando datos intradía para {email} en {date_str}")
+            success = get_intraday_data(access_token, email, date_str, progress)
+            # Guardar checkpoint
+            with open(checkpoint_path, 'w', encoding='utf-8') as f:
+                json.dump({'last_date': date_str}, f)
+            if not success:
+                logger.warning(f"No se pudieron recolectar datos para {email} en {date_str}")
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status == 401 and attempt == 0:
+                access_token = token_manager.handle_unauthorized(email, access_token)
+                if access_token:
+                    continue
+                logger.error(f"No se pudo refrescar el token para {email}. Reautorice el dispositivo.")
+                return False
+            if status == 429:
+                logger.warning(f"Rate limit alcanzado para {email} en {date_str}. Deteniendo procesamiento.")
+                return False
+            logger.error(f"Error HTTP al obtener datos intradía para {email}: {e}")
+        except Exception as e:
+            logger.error(f"Error inesperado al procesar {email} en {date_str}: {e}", exc_info=True)
+        return True
+    return True
+
+def _process_user(email, today, progress=None):
+    """Recopila los días intradía pendientes de un único email."""
+    if not token_manager.get_access_token(email):
+        logger.warning(f"No se encontraron tokens válidos para el correo {email}. Es necesario vincular nuevamente el dispositivo.")
+        return
+    # Leer checkpoint
+    checkpoint_path = f"logs/checkpoint_intraday_{email}.json"
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            checkpoint_data = json.load(f)
+        last_date_str = checkpoint_data.get('last_date')
+        if last_date_str:
+            last_date = datetime.strptime(last_date_str, "%Y-%m-%d").date()
         else:
             last_date = None
-        # Determinar rango de fechas a procesar
-        if BACKFILL_START_DATE and BACKFILL_END_DATE:
-            # Modo backfill: solo recopilar entre esas fechas
-            start_date = datetime.strptime(BACKFILL_START_DATE, "%Y-%m-%d").date()
-            end_date = datetime.strptime(BACKFILL_END_DATE, "%Y-%m-%d").date()
-            if last_date is not None and last_date >= start_date:
-                # Si el checkpoint ya está dentro del rango, continuar desde el siguiente día
-                current_date = last_date + timedelta(days=1)
-            else:
-                current_date = start_date
-            # Solo procesar hasta end_date
-            while current_date <= end_date:
-                date_str = current_date.strftime('%Y-%m-%d')
-                try:
-                    logger.info(f"Recolectando datos intradía para {email} en {date_str}")
-                    success = get_intraday_data(current_access_token, email, date_str)
-                    # Guardar checkpoint
-                    with open(checkpoint_path, 'w', encoding='utf-8') as f:
-                        json.dump({'last_date': date_str}, f)
-                    if not success:
-                        logger.warning(f"No se pudieron recolectar datos para {email} en {date_str}")
-                except requests.exceptions.HTTPError as e:
-                    if hasattr(e, 'response') and e.response and e.response.status_code == 401:
-                        logger.warning(f"Token expirado para {email}. Intentando refrescar el token...")
-                        new_access_token, new_refresh_token = refresh_access_token(current_refresh_token)
-                        if new_access_token and new_refresh_token:
-                            update_users_tokens(email, new_access_token, new_refresh_token)
-                            current_access_token = new_access_token
-                            current_refresh_token = new_refresh_token
-                            try:
-                                success = get_intraday_data(current_access_token, email, date_str)
-                                with open(checkpoint_path, 'w', encoding='utf-8') as f:
-                                    json.dump({'last_date': date_str}, f)
-                                if not success:
-                                    logger.warning(f"No se pudieron recolectar datos tras refrescar token para {email} en {date_str}")
-                            except Exception as e2:
-                                logger.error(f"Error tras refrescar token para {email}: {e2}")
-                        else:
-                            logger.error(f"No se pudo refrescar el token para {email}. Reautorice el dispositivo.")
-                            break
-                    elif hasattr(e, 'response') and e.response and e.response.status_code == 429:
-                        logger.warning(f"Rate limit alcanzado para {email} en {date_str}. Deteniendo procesamiento.")
-                        break
-                    else:
-                        logger.error(f"Error HTTP al obtener datos intradía para {email}: {e}")
-                except Exception as e:
-                    logger.error(f"Error inesperado al procesar {email} en {date_str}: {e}", exc_info=True)
-                time.sleep(1)
-                current_date += timedelta(days=1)
-            logger.info(f"Usuario {email} procesado hasta {end_date} (modo backfill).")
+    else:
+        last_date = None
+    # Determinar rango de fechas a procesar
+    if BACKFILL_START_DATE and BACKFILL_END_DATE:
+        # Modo backfill: solo recopilar entre esas fechas
+        start_date = datetime.strptime(BACKFILL_START_DATE, "%Y-%m-%d").date()
+        end_date = datetime.strptime(BACKFILL_END_DATE, "%Y-%m-%d").date()
+        if last_date is not None and last_date >= start_date:
+            # Si el checkpoint ya está dentro del rango, continuar desde el siguiente día
+            current_date = last_date + timedelta(days=1)
         else:
-            # Modo normal: recopilar solo el día actual si ya está al día
-            if last_date is None or last_date < today:
-                current_date = today
-                date_str = current_date.strftime('%Y-%m-%d')
-                try:
-                    logger.info(f"Recolectando datos intradía para {email} en {date_str}")
-                    success = get_intraday_data(current_access_token, email, date_str)
-                    with open(checkpoint_path, 'w', encoding='utf-8') as f:
-                        json.dump({'last_date': date_str}, f)
-                    if not success:
-                        logger.warning(f"No se pudieron recolectar datos para {email} en {date_str}")
-                except requests.exceptions.HTTPError as e:
-                    if hasattr(e, 'response') and e.response and e.response.status_code == 401:
-                        logger.warning(f"Token expirado para {email}. Intentando refrescar el token...")
-                        new_access_token, new_refresh_token = refresh_access_token(current_refresh_token)
-                        if new_access_token and new_refresh_token:
-                            update_users_tokens(email, new_access_token, new_refresh_token)
-                            current_access_token = new_access_token
-                            current_refresh_token = new_refresh_token
-                            try:
-                                success = get_intraday_data(current_access_token, email, date_str)
-                                with open(checkpoint_path, 'w', encoding='utf-8') as f:
-                                    json.dump({'last_date': date_str}, f)
-                                if not success:
-                                    logger.warning(f"No se pudieron recolectar datos tras refrescar token para {email} en {date_str}")
-                            except Exception as e2:
-                                logger.error(f"Error tras refrescar token para {email}: {e2}")
-                        else:
-                            logger.error(f"No se pudo refrescar el token para {email}. Reautorice el dispositivo.")
-                    elif hasattr(e, 'response') and e.response and e.response.status_code == 429:
-                        logger.warning(f"Rate limit alcanzado para {email} en {date_str}. Deteniendo procesamiento.")
-                    else:
-                        logger.error(f"Error HTTP al obtener datos intradía para {email}: {e}")
-                except Exception as e:
-                    logger.error(f"Error inesperado al procesar {email} en {date_str}: {e}", exc_info=True)
-                time.sleep(1)
-            logger.info(f"Usuario {email} procesado para el día {today} (modo normal).")
-    logger.info("=== FIN DE EJECUCIÓN DE FITBIT INTRADAY ===")
+            current_date = start_date
+        # Solo procesar hasta end_date
+        while current_date <= end_date:
+            if not _collect_date(email, current_date.strftime('%Y-%m-%d'), checkpoint_path, progress):
+                break
+            time.sleep(1)
+            current_date += timedelta(days=1)
+        # Los días antiguos quedan fuera de la ventana de refresco de los agregados
+        refresh_intraday_rollups(datetime.combine(start_date, datetime.min.time()),
+                                 datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+        logger.info(f"Usuario {email} procesado hasta {end_date} (modo backfill).")
+    else:
+        # Modo normal: recopilar solo el día actual si ya está al día
+        if last_date is None or last_date < today:
+            _collect_date(email, today.strftime('%Y-%m-%d'), checkpoint_path, progress)
+            time.sleep(1)
+        logger.info(f"Usuario {email} procesado para el día {today} (modo normal).")
+
+# --- RECOLECCIÓN INCREMENTAL POR RANGO DE FECHAS ---
+def collect_intraday_range(email, start_date, end_date, progress=None, metrics=INTRADAY_METRICS):
+    """
+    Recopila los días intradía de un email entre dos fechas (ambas incluidas).
+
+    El punto de partida de cada métrica y día es su último instante en la base de
+    datos (no el checkpoint JSON), y a la API se le pide solo el tramo desde ese
+    minuto (parámetros de hora de inicio y fin). Así el sondeo del día en curso
+    cuesta una petición corta por métrica y escribe solo los puntos nuevos, y
+    repetir un rango (p. ej. un trabajo de la cola tras caerse su trabajador) no
+    duplica datos. Los días cerrados (ver db.day_is_final) se saltan sin ninguna
+    petición.
+
+    Args:
+        email (str): Correo electrónico del usuario.
+        start_date (date): Primer día.
+        end_date (date): Último día.
+
+    Returns:
+        int: Número de puntos nuevos guardados.
+
+    Raises:
+        requests.exceptions.HTTPError: Ante 429 o un 401 que persiste tras refrescar.
+        RuntimeError: Si el usuario no existe o no tiene un token válido.
+    """
+    user_id = get_latest_user_id_by_email(email)
+    if not user_id:
+        raise RuntimeError(f"No se encontró user_id para el email {email}")
+    final_days = get_final_days(user_id, STREAM_INTRADAY, start_date, end_date)
+    last_sync = None
+    sync_checked = False
+    total_points = 0
+    current_date = start_date
+    retried = False
+    while current_date <= end_date:
+        if current_date in final_days:
+            current_date += timedelta(days=1)
+            continue
+        access_token = token_manager.get_access_token(email)
+        if not access_token:
+            raise RuntimeError(f"No hay un token válido para {email}. Reautorice el dispositivo.")
+        day_start = datetime.combine(current_date, datetime.min.time())
+        last_times = get_last_intraday_times(user_id, day_start, day_start + timedelta(days=1))
+        failures = []
+        try:
+            # Una consulta de la última sincronización por rango, solo si hay algo que descargar
+            if not sync_checked:
+                last_sync = get_last_sync_time(access_token, progress)
+                sync_checked = True
+            results = collect_day(make_api_get(access_token, progress, failures), user_id,
+                                  current_date.strftime("%Y-%m-%d"), last_times, metrics, windowed=True)
+        except requests.exceptions.HTTPError as e:
+            if (not retried and e.response is not None and e.response.status_code == 401
+                    and token_manager.handle_unauthorized(email, access_token)):
+                retried = True
+                continue
+            raise
+        retried = False
+        points = sum(count for count, _ in results.values())
+        total_points += points
+        if progress:
+            progress.rows(points)
+        # Solo cuenta como descargado si todas las series respondieron (con o sin puntos)
+        if not failures and metrics is INTRADAY_METRICS:
+            record_coverage(user_id, STREAM_INTRADAY, current_date, day_is_final(current_date, last_sync))
+        current_date += timedelta(days=1)
+    if total_points:
+        # Los días antiguos quedan fuera de la ventana de refresco de los agregados
+        refresh_intraday_rollups(datetime.combine(start_date, datetime.min.time()),
+                                 datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+    return total_points
+
+def poll_all_users(emails=None, progress=None):
+    """Un ciclo de sondeo incremental del día en curso para todos los usuarios (o los emails indicados)."""
+    today = datetime.now().date()
+    for email in (emails if emails is not None else get_unique_emails()):
+        try:
+            points = collect_intraday_range(email, today, today, progress)
+            logger.info(f"Sondeo de {email}: {points} puntos nuevos")
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 429:
+                logger.warning(f"Rate limit alcanzado para {email}; se reintentará en el próximo ciclo.")
+            else:
+                logger.error(f"Error HTTP en el sondeo de {email}: {e}")
+        except RuntimeError as e:
+            logger.warning(str(e))
+        except Exception as e:
+            logger.error(f"Error inesperado en el sondeo de {email}: {e}", exc_info=True)
+
+def run_polling(interval_minutes=INTRADAY_POLL_MINUTES):
+    """Sondea el día en curso de todos los usuarios cada interval_minutes, indefinidamente."""
+    logger.info(f"=== SONDEO INTRADÍA CADA {interval_minutes} MINUTOS ===")
+    while True:
+        started = time.monotonic()
+        poll_all_users()
+        time.sleep(max(0, interval_minutes * 60 - (time.monotonic() - started)))
 
 if __name__ == "__main__":
     os.makedirs("logs", exist_ok=True)
     logger.info("=== INICIO DE EJECUCIÓN DE FITBIT INTRADAY (MODO MULTI-USUARIO DB) ===")
     logger.info(f"Python version: {sys.version}")
     logger.info(f"Working directory: {os.getcwd()}")
-    process_all_users()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "--poll":
+        # python fitbit_intraday.py --poll [minutos]
+        run_polling(int(sys.argv[2]) if len(sys.argv) > 2 else INTRADAY_POLL_MINUTES)
+    else:
+        process_all_users()
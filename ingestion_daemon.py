@@ -0,0 +1,175 @@
+"""
+Demonio de ingesta de larga duración: sustituye a las ejecuciones por cron de
+fitbit.py y fitbit_intraday.py (run_fitbit.sh y run_fitbit_intraday.sh).
+
+Cada ejecución por cron pagaba de nuevo el arranque del intérprete, una conexión
+a la base de datos por consulta, un handshake TLS por petición a la API y la
+lectura y descifrado de los tokens de cada usuario. El demonio vive entre
+ciclos y conserva todo eso caliente:
+
+- Un pool de conexiones a la base de datos (db.enable_connection_pool).
+- La sesión HTTP compartida con la API de Fitbit (tokens.api_session), con
+  keep-alive.
+- Los tokens en memoria con refresco proactivo (tokens.token_manager).
+
+Un planificador encola los trabajos de cada flujo con su cadencia en la cola de
+ingesta (work_queue) y INGESTION_WORKERS hilos trabajadores los ejecutan. La
+cola es compartida: se pueden lanzar más trabajadores en otras máquinas con
+`python work_queue.py worker`.
+
+- daily: ayer y hoy de cada usuario, cada INGESTION_DAILY_MINUTES.
+- intraday: hoy de cada usuario (sondeo incremental), cada INGESTION_INTRADAY_MINUTES.
+- alerts: evaluación de las alertas de ayer, una sola vez por usuario y día.
+- backfill: siguiente tramo del histórico de cada usuario y flujo, del más nuevo
+  al más antiguo, cada INGESTION_BACKFILL_MINUTES.
+
+Los datos recientes van siempre por delante: sus trabajos tienen la prioridad
+más alta y el relleno histórico solo usa la cuota de la API que les sobra a
+cada usuario (ver work_queue.schedule_backfill), en lugar de rellenar un
+usuario entero desde el principio antes de pasar al siguiente.
+
+Con SIGTERM o SIGINT deja de planificar y de reclamar trabajos, espera a que
+cada trabajador termine (y guarde) el trabajo en curso y cierra el pool.
+
+Uso:
+    python ingestion_daemon.py
+"""
+
+import logging
+import os
+import signal
+import threading
+from datetime import datetime, timedelta
+
+os.makedirs('logs', exist_ok=True)
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(threadName)s %(message)s',
+    handlers=[
+        logging.FileHandler("logs/ingestion.log"),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+from db import enable_connection_pool, close_connection_pool, get_unique_emails
+from work_queue import (
+    WorkQueue, Worker, STREAM_DAILY, STREAM_INTRADAY, STREAM_ALERTS, PRIORITY_NORMAL
+)
+
+# Hilos trabajadores en este proceso
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "4"))
+# Cadencia de cada flujo en minutos
+DAILY_MINUTES = int(os.getenv("INGESTION_DAILY_MINUTES", "60"))
+INTRADAY_MINUTES = int(os.getenv("INGESTION_INTRADAY_MINUTES", "15"))
+ALERTS_MINUTES = int(os.getenv("INGESTION_ALERTS_MINUTES", "60"))
+BACKFILL_MINUTES = int(os.getenv("INGESTION_BACKFILL_MINUTES", "5"))
+# Días recientes que se recopilan en cada ciclo: ayer y hoy para los resúmenes,
+# hoy para el intradía (el resto de ayer se recoge una vez al cambiar de día)
+FRESH_DAYS = {STREAM_DAILY: 2, STREAM_INTRADAY: 1}
+# Primer día del relleno histórico de cada flujo
+BACKFILL_START = {
+    STREAM_DAILY: datetime.strptime(os.getenv("INGESTION_BACKFILL_START_DAILY", "2025-02-01"), "%Y-%m-%d").date(),
+    STREAM_INTRADAY: datetime.strptime(os.getenv("INGESTION_BACKFILL_START_INTRADAY", "2025-05-21"), "%Y-%m-%d").date(),
+}
+# Días que se conservan los trabajos terminados en la cola
+PURGE_DAYS = 7
+
+
+def schedule_daily(queue, emails, today):
+    for email in emails:
+        queue.schedule_fresh(email, STREAM_DAILY, today, FRESH_DAYS[STREAM_DAILY])
+
+
+def schedule_intraday(queue, emails, today):
+    for email in emails:
+        queue.schedule_fresh(email, STREAM_INTRADAY, today, FRESH_DAYS[STREAM_INTRADAY])
+
+
+def schedule_alerts(queue, emails, today):
+    # Evaluar un día inserta sus alertas: se hace una sola vez, con el día ya cerrado
+    yesterday = today - timedelta(days=1)
+    for email in emails:
+        queue.enqueue(email, STREAM_ALERTS, yesterday, yesterday, PRIORITY_NORMAL, once=True)
+
+
+def schedule_backfill(queue, emails, today):
+    for email in emails:
+        for stream, start_date in BACKFILL_START.items():
+            queue.schedule_backfill(email, stream, start_date)
+
+
+# (nombre, minutos entre ejecuciones, función que encola)
+SCHEDULES = (
+    (STREAM_DAILY, DAILY_MINUTES, schedule_daily),
+    (STREAM_INTRADAY, INTRADAY_MINUTES, schedule_intraday),
+    (STREAM_ALERTS, ALERTS_MINUTES, schedule_alerts),
+    ('backfill', BACKFILL_MINUTES, schedule_backfill),
+)
+
+
+class IngestionDaemon:
+    """Planificador más trabajadores en hilos, con parada ordenada."""
+
+    def __init__(self, workers=INGESTION_WORKERS):
+        self.stop_event = threading.Event()
+        self.workers = [Worker(idle_seconds=min(30, INTRADAY_MINUTES * 60)) for _ in range(workers)]
+        self.threads = []
+
+    def stop(self, signum=None, frame=None):
+        if not self.stop_event.is_set():
+            logger.info("Señal de parada recibida; terminando los trabajos en curso")
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.stop()
+
+    def schedule(self, next_run):
+        """Encola los flujos que han cumplido su cadencia."""
+        now = datetime.now()
+        due = [s for s in SCHEDULES if next_run.get(s[0], now) <= now]
+        if not due:
+            return
+        queue = WorkQueue()
+        try:
+            emails = get_unique_emails()
+            today = now.date()
+            for name, minutes, enqueue in due:
+                enqueue(queue, emails, today)
+                next_run[name] = now + timedelta(minutes=minutes)
+                logger.info(f"Flujo {name} planificado para {len(emails)} usuarios")
+            queue.purge_finished(PURGE_DAYS)
+        except Exception as e:
+            logger.error(f"Error al planificar: {e}", exc_info=True)
+        finally:
+            queue.close()
+
+    def run(self):
+        for number, worker in enumerate(self.workers, 1):
+            thread = threading.Thread(target=worker.run, name=f"worker-{number}")
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"Demonio de ingesta iniciado con {len(self.workers)} trabajadores")
+        next_run = {}
+        while not self.stop_event.is_set():
+            self.schedule(next_run)
+            self.stop_event.wait(30)
+        for thread in self.threads:
+            thread.join()
+        logger.info("Demonio de ingesta detenido")
+
+
+def main():
+    # Cada trabajador usa su conexión, la del latido de su arrendamiento y las de
+    # los hilos de descarga intradía; más la del planificador
+    enable_connection_pool(maxconn=4 + INGESTION_WORKERS * 6)
+    daemon = IngestionDaemon()
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    try:
+        daemon.run()
+    finally:
+        close_connection_pool()
+
+
+if __name__ == "__main__":
+    main()
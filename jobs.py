@@ -0,0 +1,312 @@
+"""
+Ejecutor de trabajos en segundo plano para la actualización y exportación de datos.
+
+La ruta /refresh_data ya no ejecuta la recolección dentro de la petición HTTP:
+encola un trabajo de refresco (todos los usuarios o uno concreto), devuelve su
+identificador al instante y el progreso se consulta aparte.
+
+- Los trabajos se ejecutan en un único hilo trabajador, de modo que nunca hay
+  dos recolecciones simultáneas contra la API de Fitbit desde este proceso.
+- Las peticiones concurrentes se deduplican: si ya hay un trabajo pendiente o en
+  curso que cubre el mismo alcance (o un refresco de todos los usuarios), se
+  devuelve ese trabajo en lugar de crear otro.
+- La deduplicación es por proceso; con varios workers de gunicorn cada uno
+  mantiene su propia cola.
+- Las exportaciones de cohortes (research_export) usan una cola propia para no
+  retrasar los refrescos. Sus .zip se borran pasadas EXPORT_TTL_HOURS horas.
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Estados posibles de un trabajo
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_ERROR = 'error'
+
+# Número de trabajos terminados que se conservan para poder consultarlos
+MAX_FINISHED_JOBS = 50
+# Horas que se conserva en disco el .zip de una exportación para descargarlo
+EXPORT_TTL_HOURS = int(os.getenv("EXPORT_TTL_HOURS", "24"))
+
+
+class Job:
+    """
+    Trabajo en segundo plano con sus contadores de progreso.
+
+    El propio trabajo actúa como objeto de progreso que reciben los
+    recolectores (fitbit.process_emails, fitbit_intraday.process_all_users)
+    y la exportación de cohortes.
+    """
+
+    kind = 'job'
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = JOB_QUEUED
+        self.created_at = datetime.now(timezone.utc)
+        self.started_at = None
+        self.finished_at = None
+        self.stage = None
+        self.current_user = None
+        self.users_total = 0
+        self.users_done = 0
+        self.api_calls = 0
+        self.rows_written = 0
+        self.error = None
+        self._lock = threading.Lock()
+        # Se incrementa con cada cambio para que quien consulta el estado sepa
+        # si hay algo nuevo
+        self.version = 0
+
+    @property
+    def active(self):
+        return self.status in (JOB_QUEUED, JOB_RUNNING)
+
+    def _touch(self):
+        self.version += 1
+
+    # --- Interfaz de progreso usada por los recolectores ---
+    def stage_started(self, stage, users_total):
+        with self._lock:
+            self.stage = stage
+            self.users_total = users_total
+            self.users_done = 0
+            self._touch()
+
+    def user_started(self, email):
+        with self._lock:
+            self.current_user = email
+            self._touch()
+
+    def user_done(self, email):
+        with self._lock:
+            self.users_done += 1
+            self.current_user = None
+            self._touch()
+
+    def api_call(self, count=1):
+        with self._lock:
+            self.api_calls += count
+            self._touch()
+
+    def rows(self, count):
+        with self._lock:
+            self.rows_written += count
+            self._touch()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'stage': self.stage,
+                'current_user': self.current_user,
+                'users_total': self.users_total,
+                'users_done': self.users_done,
+                'api_calls': self.api_calls,
+                'rows_written': self.rows_written,
+                'error': self.error,
+                'version': self.version,
+                'created_at': self.created_at.isoformat(),
+                'started_at': self.started_at.isoformat() if self.started_at else None,
+                'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            }
+
+
+class RefreshJob(Job):
+    """Refresco de datos de Fitbit de todos los usuarios o de un único email."""
+
+    kind = 'refresh'
+
+    def __init__(self, email=None):
+        super().__init__()
+        self.email = email
+
+    def covers(self, email):
+        """Indica si este trabajo ya cubre un refresco para el email dado."""
+        return self.email is None or self.email == email
+
+    def to_dict(self):
+        data = super().to_dict()
+        data['email'] = self.email
+        return data
+
+
+class ExportJob(Job):
+    """Exportación de una cohorte a Parquet (ver research_export.export_cohort)."""
+
+    kind = 'export'
+
+    def __init__(self, user_ids, start_date, end_date, tables=None):
+        super().__init__()
+        self.user_ids = list(user_ids)
+        self.start_date = start_date
+        self.end_date = end_date
+        self.tables = tables
+        self.archive_path = None
+        # El .zip se ha borrado por antigüedad (ver JobRunner.purge_exports)
+        self.expired = False
+
+    def to_dict(self):
+        data = super().to_dict()
+        data.update({
+            'user_ids': self.user_ids,
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat(),
+            'tables': self.tables,
+            'ready': self.archive_path is not None,
+            'expired': self.expired,
+        })
+        return data
+
+
+class JobRunner:
+    """Cola en proceso de trabajos de refresco y exportación, con deduplicación."""
+
+    def __init__(self, export_dir='exports'):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='refresh-job')
+        self._export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export-job')
+        self.export_dir = export_dir
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit_refresh(self, email=None):
+        """
+        Encola un refresco de datos.
+
+        Args:
+            email (str, optional): Email a refrescar. None para todos los usuarios.
+
+        Returns:
+            tuple: (RefreshJob, bool) con el trabajo y si se ha creado uno nuevo.
+        """
+        with self._lock:
+            for job in self._jobs.values():
+                if job.active and isinstance(job, RefreshJob) and job.covers(email):
+                    return job, False
+            job = RefreshJob(email)
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._execute, job, self._run_refresh)
+        return job, True
+
+    def submit_export(self, user_ids, start_date, end_date, tables=None):
+        """
+        Encola la exportación Parquet de una cohorte.
+
+        Returns:
+            ExportJob: El trabajo creado.
+        """
+        self.purge_exports()
+        job = ExportJob(user_ids, start_date, end_date, tables)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._export_executor.submit(self._execute, job, self._run_export)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active_jobs(self):
+        with self._lock:
+            return [job for job in self._jobs.values() if job.active]
+
+    def purge_exports(self, older_than_hours=EXPORT_TTL_HOURS):
+        """
+        Borra de export_dir las exportaciones con más de older_than_hours horas,
+        también las que quedaron de ejecuciones anteriores del proceso.
+
+        Returns:
+            int: Número de exportaciones borradas.
+        """
+        if not os.path.isdir(self.export_dir):
+            return 0
+        cutoff = time.time() - older_than_hours * 3600
+        with self._lock:
+            exports = [job for job in self._jobs.values() if isinstance(job, ExportJob)]
+        # Las exportaciones en curso no se tocan aunque su directorio sea antiguo
+        active = {f"cohort_{job.id}" for job in exports if job.active}
+        removed = 0
+        for name in os.listdir(self.export_dir):
+            path = os.path.join(self.export_dir, name)
+            if not name.startswith('cohort_') or os.path.splitext(name)[0] in active:
+                continue
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+            except OSError as e:
+                logger.warning(f"No se pudo borrar la exportación {path}: {e}")
+        for job in exports:
+            if job.archive_path and not os.path.exists(job.archive_path):
+                job.archive_path = None
+                job.expired = True
+        if removed:
+            logger.info(f"Exportaciones antiguas borradas: {removed}")
+        return removed
+
+    def _prune(self):
+        finished = sorted(
+            (job for job in self._jobs.values() if not job.active),
+            key=lambda job: job.finished_at
+        )
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.id]
+
+    def _execute(self, job, target):
+        job.status = JOB_RUNNING
+        job.started_at = datetime.now(timezone.utc)
+        job._touch()
+        try:
+            target(job)
+            job.status = JOB_DONE
+        except Exception as e:
+            logger.error(f"Error en el trabajo {job.kind} {job.id}: {e}", exc_info=True)
+            job.error = str(e)
+            job.status = JOB_ERROR
+        finally:
+            job.finished_at = datetime.now(timezone.utc)
+            job.stage = None
+            job._touch()
+
+    def _run_refresh(self, job):
+        # Importaciones diferidas: los recolectores configuran su propio logging
+        from db import get_unique_emails
+        from fitbit import process_emails
+        from fitbit_intraday import process_all_users
+
+        emails = [job.email] if job.email else get_unique_emails()
+        job.stage_started('daily', len(emails))
+        process_emails(emails, progress=job)
+        job.stage_started('intraday', len(emails))
+        process_all_users(emails, progress=job)
+
+    def _run_export(self, job):
+        from research_export import export_cohort, zip_export
+
+        output_dir = os.path.join(self.export_dir, f"cohort_{job.id}")
+        export_cohort(job.user_ids, job.start_date, job.end_date, output_dir, job.tables, progress=job)
+        job.archive_path = zip_export(output_dir)
+        # Solo se descarga el .zip
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+# Instancia compartida por la aplicación
+job_runner = JobRunner()
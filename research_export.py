@@ -0,0 +1,248 @@
+"""
+EXPORTACIÓN DE COHORTES PARA INVESTIGACIÓN (PARQUET)
+
+Escribe daily_summaries, intraday_metrics, sleep_logs y alerts de un conjunto de
+usuarios y un rango de fechas en ficheros Parquet comprimidos, particionados por
+tabla y usuario al estilo Hive:
+
+    <salida>/<tabla>/user_id=<id>/part-0000.parquet
+
+Los datos se leen de la base de datos con cursores server-side y se escriben por
+bloques (row groups), de modo que la memoria usada no depende del tamaño del
+export. El resultado se carga directamente con pandas/pyarrow/polars/DuckDB, por
+ejemplo: pd.read_parquet("<salida>/intraday_metrics").
+
+Uso desde línea de comandos:
+    python research_export.py --users 3,7,12 --start 2025-05-01 --end 2025-05-31 --output exports/cohorte_mayo
+    python research_export.py --emails a@x.com,b@x.com --start 2025-05-01 --end 2025-05-31 --tables intraday_metrics,alerts
+
+Requiere pyarrow (opcional, solo para esta exportación).
+"""
+
+import argparse
+import logging
+import os
+import zipfile
+from datetime import datetime, timedelta
+
+from db import DatabaseManager, get_user_id_by_email, intraday_source, packed_intraday_source
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow solo es necesario para esta exportación
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+# Filas por bloque leído de la base de datos y escrito como row group
+CHUNK_ROWS = 100_000
+# Códec de compresión de los ficheros Parquet
+COMPRESSION = 'zstd'
+
+
+def _schemas():
+    """Esquemas Arrow de cada tabla exportable, con su columna temporal de filtrado."""
+    ts = pa.timestamp('us', tz='UTC')
+    return {
+        'daily_summaries': ('date', pa.schema([
+            ('user_id', pa.int32()), ('date', pa.date32()),
+            ('steps', pa.int32()), ('heart_rate', pa.int32()), ('sleep_minutes', pa.int32()),
+            ('calories', pa.int32()), ('distance', pa.float64()), ('floors', pa.int32()),
+            ('elevation', pa.float64()), ('active_minutes', pa.int32()), ('sedentary_minutes', pa.int32()),
+            ('nutrition_calories', pa.int32()), ('water', pa.float64()), ('weight', pa.float64()),
+            ('bmi', pa.float64()), ('fat', pa.float64()), ('oxygen_saturation', pa.float64()),
+            ('respiratory_rate', pa.float64()), ('temperature', pa.float64()),
+        ])),
+        'intraday_metrics': ('time', pa.schema([
+            ('user_id', pa.int32()), ('time', ts),
+            ('type', pa.dictionary(pa.int8(), pa.string())), ('value', pa.float64()),
+        ])),
+        'sleep_logs': ('start_time', pa.schema([
+            ('user_id', pa.int32()), ('start_time', ts), ('end_time', ts),
+            ('duration_ms', pa.int64()), ('efficiency', pa.int32()),
+            ('minutes_asleep', pa.int32()), ('minutes_awake', pa.int32()),
+            ('minutes_in_rem', pa.int32()), ('minutes_in_light', pa.int32()), ('minutes_in_deep', pa.int32()),
+        ])),
+        'alerts': ('alert_time', pa.schema([
+            ('id', pa.int32()), ('user_id', pa.int32()), ('alert_time', ts),
+            ('alert_type', pa.string()), ('priority', pa.string()),
+            ('triggering_value', pa.float64()), ('threshold_value', pa.string()),
+            ('details', pa.string()), ('acknowledged', pa.bool_()),
+            ('acknowledged_at', ts), ('acknowledged_by', pa.int32()),
+        ])),
+    }
+
+# Tablas exportables (en el orden en que se escriben)
+EXPORT_TABLES = ('daily_summaries', 'intraday_metrics', 'sleep_logs', 'alerts')
+
+
+def _to_record_batch(rows, schema):
+    """Convierte una lista de filas (tuplas) en un RecordBatch columnar."""
+    columns = list(zip(*rows))
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, pa.string()).dictionary_encode().cast(field.type))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _export_table_for_user(db, table, time_column, schema, user_id, start, end, output_dir):
+    """
+    Exporta una tabla de un usuario a su partición. Devuelve el número de filas escritas.
+    """
+    columns = ', '.join(field.name for field in schema)
+    if table == 'intraday_metrics':
+        # Formato largo sea cual sea INTRADAY_LAYOUT, más los puntos de las series
+        # empaquetadas (intraday_packed) desplegados
+        query = f"""
+            SELECT {columns} FROM {intraday_source()}
+            WHERE user_id = %s AND time >= %s AND time < %s
+            UNION ALL
+            SELECT {columns} FROM {packed_intraday_source('p')}
+            WHERE user_id = %s AND day_start > %s::timestamptz - INTERVAL '1 day' AND day_start < %s
+            AND time >= %s AND time < %s
+            ORDER BY time
+        """
+        params = (user_id, start, end, user_id, start, end, start, end)
+    else:
+        query = f"""
+            SELECT {columns}
+            FROM {table}
+            WHERE user_id = %s AND {time_column} >= %s AND {time_column} < %s
+            ORDER BY {time_column}
+        """
+        params = (user_id, start, end)
+    partition_dir = os.path.join(output_dir, table, f"user_id={user_id}")
+    writer = None
+    total = 0
+    chunk = []
+    try:
+        for row in db.stream_query(query, params, batch_size=CHUNK_ROWS):
+            chunk.append(row)
+            if len(chunk) >= CHUNK_ROWS:
+                writer = writer or _open_writer(partition_dir, schema)
+                writer.write_batch(_to_record_batch(chunk, schema))
+                total += len(chunk)
+                chunk = []
+        if chunk:
+            writer = writer or _open_writer(partition_dir, schema)
+            writer.write_batch(_to_record_batch(chunk, schema))
+            total += len(chunk)
+    finally:
+        if writer:
+            writer.close()
+    return total
+
+
+def _open_writer(partition_dir, schema):
+    os.makedirs(partition_dir, exist_ok=True)
+    return pq.ParquetWriter(os.path.join(partition_dir, 'part-0000.parquet'), schema, compression=COMPRESSION)
+
+
+def export_cohort(user_ids, start_date, end_date, output_dir, tables=None, progress=None):
+    """
+    Exporta los datos de una cohorte a ficheros Parquet particionados.
+
+    Args:
+        user_ids (list): IDs de usuario a exportar.
+        start_date (date): Primer día del rango (incluido).
+        end_date (date): Último día del rango (incluido).
+        output_dir (str): Directorio de salida.
+        tables (list, optional): Subconjunto de EXPORT_TABLES. Por defecto, todas.
+        progress (optional): Objeto de progreso (ver jobs.ExportJob).
+
+    Returns:
+        dict: Filas escritas por tabla.
+    """
+    if pa is None:
+        raise RuntimeError("La exportación Parquet requiere pyarrow (pip install pyarrow).")
+    tables = list(tables or EXPORT_TABLES)
+    unknown = [t for t in tables if t not in EXPORT_TABLES]
+    if unknown:
+        raise ValueError(f"Tablas desconocidas: {', '.join(unknown)}")
+
+    schemas = _schemas()
+    start = datetime.combine(start_date, datetime.min.time())
+    end = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+    if progress:
+        progress.stage_started('export', len(tables) * len(user_ids))
+
+    db = DatabaseManager()
+    if not db.connect():
+        raise RuntimeError("No se pudo conectar a la base de datos")
+    written = {}
+    try:
+        for table in tables:
+            time_column, schema = schemas[table]
+            written[table] = 0
+            for user_id in user_ids:
+                if progress:
+                    progress.user_started(f"{table}/user_id={user_id}")
+                rows = _export_table_for_user(db, table, time_column, schema, user_id, start, end, output_dir)
+                written[table] += rows
+                logger.info(f"[export] {table} user_id={user_id}: {rows} filas")
+                if progress:
+                    progress.rows(rows)
+                    progress.user_done(user_id)
+    finally:
+        db.close()
+    return written
+
+
+def zip_export(output_dir):
+    """
+    Empaqueta un directorio de exportación en un .zip (sin recomprimir los Parquet).
+
+    Returns:
+        str: Ruta del fichero .zip.
+    """
+    archive_path = f"{output_dir.rstrip(os.sep)}.zip"
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for root, _, files in os.walk(output_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                archive.write(path, os.path.relpath(path, output_dir))
+    return archive_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta una cohorte a Parquet particionado.")
+    parser.add_argument('--users', help="IDs de usuario separados por comas")
+    parser.add_argument('--emails', help="Emails separados por comas (se usa la instancia más reciente)")
+    parser.add_argument('--start', required=True, help="Primer día (YYYY-MM-DD)")
+    parser.add_argument('--end', required=True, help="Último día (YYYY-MM-DD)")
+    parser.add_argument('--output', default=None, help="Directorio de salida")
+    parser.add_argument('--tables', default=None, help=f"Tablas separadas por comas ({', '.join(EXPORT_TABLES)})")
+    parser.add_argument('--zip', action='store_true', help="Empaquetar el resultado en un .zip")
+    args = parser.parse_args()
+
+    user_ids = [int(u) for u in args.users.split(',')] if args.users else []
+    if args.emails:
+        for email in args.emails.split(','):
+            user_id = get_user_id_by_email(email.strip())
+            if user_id:
+                user_ids.append(user_id)
+            else:
+                logger.warning(f"No se encontró usuario para {email}")
+    if not user_ids:
+        parser.error("Debe indicar al menos un usuario (--users o --emails)")
+
+    start_date = datetime.strptime(args.start, "%Y-%m-%d").date()
+    end_date = datetime.strptime(args.end, "%Y-%m-%d").date()
+    output_dir = args.output or os.path.join('exports', f"cohort_{args.start}_{args.end}")
+    tables = args.tables.split(',') if args.tables else None
+
+    written = export_cohort(user_ids, start_date, end_date, output_dir, tables)
+    for table, rows in written.items():
+        logger.info(f"{table}: {rows} filas")
+    if args.zip:
+        logger.info(f"Fichero generado: {zip_export(output_dir)}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    main()
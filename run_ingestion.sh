@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# Demonio de ingesta: sustituye a las ejecuciones por cron de run_fitbit.sh y
+# run_fitbit_intraday.sh. Se lanza una sola vez (p. ej. como servicio de systemd)
+# y se detiene con SIGTERM, que deja terminar los trabajos en curso.
+
+PROJECT_DIR="/home/pablo.morenomunoz/fitbit_project"
+
+# Configurar el directorio de logs
+LOG_DIR="$PROJECT_DIR/logs"
+# El demonio escribe su log en logs/ingestion.log; aquí queda la salida de consola
+CONSOLE_LOG="$LOG_DIR/ingestion_console.log"
+
+# Crear directorio de logs si no existe
+mkdir -p "$LOG_DIR"
+
+cd "$PROJECT_DIR"
+
+# Activar el entorno virtual
+source "$PROJECT_DIR/venv/bin/activate"
+
+echo "=== Inicio del demonio de ingesta: $(date) ===" >> "$CONSOLE_LOG"
+
+# exec: el demonio recibe directamente las señales de parada
+exec "$PROJECT_DIR/venv/bin/python" "$PROJECT_DIR/ingestion_daemon.py" >> "$CONSOLE_LOG" 2>&1
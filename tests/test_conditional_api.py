@@ -0,0 +1,77 @@
+import os
+import sys
+import logging
+from datetime import datetime, timezone
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+from db import DataVersion
+
+# Configure logging directory
+LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs', 'conditional_api')
+os.makedirs(LOG_DIR, exist_ok=True)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler(os.path.join(LOG_DIR, 'conditional_api.log')),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+USER_ID = 1
+PATH = f'/livelyageing/api/user/{USER_ID}/alerts'
+# Version of a user with alerts: last_alert_id is an integer, not a timestamp
+ACKNOWLEDGED_AT = datetime(2031, 1, 2, 9, 30, tzinfo=timezone.utc)
+VERSION_WITH_ALERTS = DataVersion(
+    intraday_time=datetime(2031, 1, 1, 23, 59, tzinfo=timezone.utc),
+    packed_updated_at=datetime(2031, 1, 1, 12, 0, tzinfo=timezone.utc),
+    summary_updated_at=datetime(2031, 1, 2, 8, 0, tzinfo=timezone.utc),
+    last_alert_id=42,
+    last_acknowledged_at=ACKNOWLEDGED_AT,
+)
+
+def view(user_id):
+    return {'user_id': user_id}
+
+def call_wrapper(headers=None):
+    """Calls the conditional wrapper as a request to the alerts endpoint would."""
+    wrapped = app_module.conditional_user_api(view)
+    with app_module.app.test_request_context(PATH, headers=headers or {}):
+        return wrapped(USER_ID)
+
+def test_user_with_alerts():
+    """A user with alerts gets a 200 whose Last-Modified is the newest timestamp."""
+    response = call_wrapper()
+    ok = response.status_code == 200 and response.last_modified == ACKNOWLEDGED_AT
+    logger.info(f"{'PASS' if ok else 'FAIL'} user with alerts: {response.status_code}, Last-Modified {response.last_modified}")
+    return ok, response
+
+def test_revalidation(etag):
+    """Sending back the ETag returns 304 without running the view."""
+    response = call_wrapper({'If-None-Match': etag})
+    ok = response.status_code == 304
+    logger.info(f"{'PASS' if ok else 'FAIL'} revalidation with ETag: {response.status_code}")
+    return ok
+
+def run_all_tests():
+    original = app_module.get_user_data_version
+    app_module.get_user_data_version = lambda user_id: VERSION_WITH_ALERTS
+    try:
+        first, response = test_user_with_alerts()
+        second = first and test_revalidation(response.headers['ETag'])
+        return first and second
+    except Exception as e:
+        logger.error(f"FAIL conditional wrapper raised: {e}", exc_info=True)
+        return False
+    finally:
+        app_module.get_user_data_version = original
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
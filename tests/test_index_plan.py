@@ -0,0 +1,170 @@
+import os
+import sys
+import logging
+import json
+from datetime import datetime, timedelta
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import DatabaseManager, INDEXES, init_db
+
+# Configure logging directory
+LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs', 'index_plan')
+os.makedirs(LOG_DIR, exist_ok=True)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler(os.path.join(LOG_DIR, 'index_plan.log')),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+TEST_EMAIL = 'index.plan.test@example.com'
+
+# Hot query shapes and the index each one must use (see db.INDEXES).
+# Each query receives the test user's id and email through named parameters.
+HOT_QUERIES = [
+    ('latest_user_by_email', 'idx_users_email_created', """
+        SELECT id FROM users
+        WHERE email = %(email)s
+        ORDER BY created_at DESC, id DESC
+        LIMIT 1
+    """),
+    ('intraday_series', 'idx_intraday_user_type_time', """
+        SELECT time, value FROM intraday_metrics
+        WHERE user_id = %(user_id)s AND type = 'heart_rate'
+        AND time >= %(start)s AND time < %(end)s
+        ORDER BY time
+    """),
+    ('sleep_logs_range', 'idx_sleep_logs_user_start', """
+        SELECT * FROM sleep_logs
+        WHERE user_id = %(user_id)s AND start_time >= %(start)s AND start_time < %(end)s
+    """),
+    ('user_recent_alerts', 'idx_alerts_user_time', """
+        SELECT alert_time, alert_type, priority FROM alerts
+        WHERE user_id = %(user_id)s AND alert_time >= %(start)s
+        ORDER BY alert_time DESC
+    """),
+    ('alerts_by_priority', 'idx_alerts_priority_time', """
+        SELECT id, alert_time FROM alerts
+        WHERE priority = 'high' AND alert_time >= %(start)s
+        ORDER BY alert_time DESC
+    """),
+    ('unacknowledged_alerts', 'idx_alerts_unacknowledged', """
+        SELECT id, alert_time FROM alerts
+        WHERE acknowledged = FALSE AND alert_time <= NOW() - INTERVAL '24 hours'
+        ORDER BY alert_time DESC
+    """),
+    ('home_active_users', 'idx_user_status_active', """
+        SELECT user_id, name, email, last_update FROM user_status
+        WHERE status = 'active'
+        ORDER BY last_update DESC NULLS LAST
+        LIMIT 10
+    """),
+    ('user_stats_listing', 'idx_user_status_email', """
+        SELECT user_id, name, email, created_at FROM user_status
+        ORDER BY email, created_at DESC
+    """),
+]
+
+def insert_plan_data(db, start):
+    """
+    Insert a small data set for a dedicated test user so that every hypertable
+    has at least one chunk to plan against. Returns the test user id.
+    """
+    user_id = db.add_user('Index Plan Test', TEST_EMAIL, 'tok', 'ref')
+    for hour in range(24):
+        t = start + timedelta(hours=hour)
+        db.execute_query("""
+            INSERT INTO intraday_metrics (user_id, time, type, value) VALUES (%s, %s, 'heart_rate', %s)
+        """, (user_id, t, 70 + hour % 5))
+    db.execute_query("""
+        INSERT INTO sleep_logs (user_id, start_time, end_time, duration_ms) VALUES (%s, %s, %s, %s)
+    """, (user_id, start, start + timedelta(hours=7), 7 * 3600 * 1000))
+    db.execute_query("""
+        INSERT INTO alerts (user_id, alert_time, alert_type, priority, details) VALUES (%s, %s, %s, %s, %s)
+    """, (user_id, start, 'activity_drop', 'high', 'Index plan test'))
+    return user_id
+
+def cleanup_plan_data(db):
+    """Remove the test user and all of its data."""
+    ids = [row[0] for row in db.execute_query("SELECT id FROM users WHERE email = %s", (TEST_EMAIL,)) or []]
+    for table in ('intraday_metrics', 'sleep_logs', 'alerts', 'daily_summaries', 'user_status'):
+        db.execute_query(f"DELETE FROM {table} WHERE user_id = ANY(%s)", (ids,))
+    db.execute_query("DELETE FROM users WHERE id = ANY(%s)", (ids,))
+
+def plan_index_names(plan):
+    """Collect every index name referenced by an EXPLAIN (FORMAT JSON) plan node tree."""
+    names = []
+    if 'Index Name' in plan:
+        names.append(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        names.extend(plan_index_names(child))
+    return names
+
+def test_query_uses_index(db, name, expected_index, query, params):
+    """
+    EXPLAIN a hot query and check that the plan uses its index.
+
+    Sequential scans are disabled for the session: on a small test database the
+    planner would rightly prefer them, and what we check is that the index can
+    serve the query shape. On hypertables the index appears with the chunk
+    prefix (_hyper_X_Y_chunk_<index>).
+    """
+    result = {'name': name, 'expected': expected_index, 'passed': False, 'indexes': []}
+    rows = db.execute_query("EXPLAIN (FORMAT JSON) " + query, params)
+    if not rows:
+        result['reason'] = 'EXPLAIN failed'
+        return result
+    plan = rows[0][0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    result['indexes'] = plan_index_names(plan[0]['Plan'])
+    result['passed'] = any(index.endswith(expected_index) for index in result['indexes'])
+    result['reason'] = 'index used' if result['passed'] else 'index not used'
+    return result
+
+def test_indexes_exist(db):
+    """Check that every index declared in db.INDEXES exists after init_db."""
+    existing = {row[0] for row in db.execute_query("SELECT indexname FROM pg_indexes") or []}
+    return [name for name, _, _ in INDEXES if name not in existing]
+
+def run_all_tests():
+    init_db()
+    db = DatabaseManager()
+    if not db.connect():
+        logger.error("Could not connect to the database")
+        return False
+
+    start = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=2)
+    try:
+        cleanup_plan_data(db)
+        user_id = insert_plan_data(db, start)
+        params = {'user_id': user_id, 'email': TEST_EMAIL, 'start': start, 'end': start + timedelta(days=1)}
+
+        missing = test_indexes_exist(db)
+        if missing:
+            logger.error(f"Missing indexes: {', '.join(missing)}")
+
+        db.execute_query("SET enable_seqscan = off")
+        results = [test_query_uses_index(db, name, index, query, params) for name, index, query in HOT_QUERIES]
+        db.execute_query("SET enable_seqscan = on")
+
+        for result in results:
+            status = "PASS" if result['passed'] else "FAIL"
+            logger.info(f"{status} {result['name']}: expected {result['expected']}, plan used {result['indexes']}")
+
+        passed = not missing and all(r['passed'] for r in results)
+        logger.info(f"Index plan: {sum(r['passed'] for r in results)}/{len(results)} queries use their index")
+        return passed
+    finally:
+        cleanup_plan_data(db)
+        db.close()
+
+if __name__ == "__main__":
+    sys.exit(0 if run_all_tests() else 1)
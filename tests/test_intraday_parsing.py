@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import logging
+from datetime import datetime, timedelta
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fitbit_intraday import parse_points
+
+# Configure logging directory
+LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs', 'intraday_parsing')
+os.makedirs(LOG_DIR, exist_ok=True)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler(os.path.join(LOG_DIR, 'intraday_parsing.log')),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+DATE = '2025-05-21'
+# Checkpoint at midday: half of the points must be filtered out
+CHECKPOINT = '2025-05-21 12:00:00'
+REPEATS = 5
+
+def one_second_day():
+    """Heart rate dataset at 1sec resolution: 86,400 (time, value) points."""
+    return [
+        (f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}", 60 + (s * 7) % 40)
+        for s in range(86400)
+    ]
+
+def parse_points_strptime(raw_points, date_str, checkpoint):
+    """Previous implementation: strptime per point and per checkpoint comparison."""
+    points = []
+    for time_str, value in raw_points:
+        if time_str and value is not None:
+            timestamp = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M:%S")
+            if not checkpoint or timestamp > datetime.strptime(checkpoint, "%Y-%m-%d %H:%M:%S"):
+                points.append((timestamp, value))
+    return points
+
+def best_time(func):
+    """Best time of REPEATS runs, in seconds."""
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def test_same_result(raw_points):
+    """The vectorized parser returns exactly the same points as the previous one."""
+    expected = parse_points_strptime(raw_points, DATE, CHECKPOINT)
+    since = datetime.strptime(CHECKPOINT, "%Y-%m-%d %H:%M:%S")
+    day_start, offsets, values = parse_points(raw_points, DATE, since)
+    got = [(day_start + timedelta(seconds=int(o)), v) for o, v in zip(offsets, values.tolist())]
+    return got == [(t, float(v)) for t, v in expected], len(expected)
+
+def run_all_tests():
+    raw_points = one_second_day()
+    since = datetime.strptime(CHECKPOINT, "%Y-%m-%d %H:%M:%S")
+
+    same, kept = test_same_result(raw_points)
+    logger.info(f"{'PASS' if same else 'FAIL'} same points as strptime parser ({kept} of {len(raw_points)} kept)")
+
+    old = best_time(lambda: parse_points_strptime(raw_points, DATE, CHECKPOINT))
+    new = best_time(lambda: parse_points(raw_points, DATE, since))
+    logger.info(f"strptime parser:   {old * 1000:8.1f} ms per 1sec day")
+    logger.info(f"vectorized parser: {new * 1000:8.1f} ms per 1sec day ({old / new:.1f}x faster)")
+
+    faster = new < old
+    logger.info(f"{'PASS' if faster else 'FAIL'} vectorized parser is faster")
+    return same and faster
+
+if __name__ == "__main__":
+    sys.exit(0 if run_all_tests() else 1)
@@ -0,0 +1,141 @@
+import io
+import os
+import re
+import sys
+import logging
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+
+# Add the project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+from encryption import encrypt_token, decrypt_token
+
+# Configure logging directory
+LOG_DIR = os.path.join(os.path.dirname(__file__), 'logs', 'token_refresh')
+os.makedirs(LOG_DIR, exist_ok=True)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler(os.path.join(LOG_DIR, 'token_refresh.log')),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+EMAIL = 'token.refresh@test.com'
+OLD_TOKENS = ('old-access', 'old-refresh')
+NEW_TOKENS = ('new-access', 'new-refresh', datetime.now(timezone.utc) + timedelta(hours=8))
+
+class RecordingConnection:
+    """
+    Connection that records the statements of refresh_tokens_single_flight and
+    makes the first failing_updates UPDATEs of the users table fail.
+    """
+
+    def __init__(self, failing_updates=0):
+        self.failing_updates = failing_updates
+        self.statements = []
+        self.closed = 0
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.statements.append('COMMIT')
+
+    def rollback(self):
+        self.statements.append('ROLLBACK')
+
+    def close(self):
+        self.statements.append('CLOSE')
+
+    def count(self, prefix):
+        return sum(1 for s in self.statements if s.startswith(prefix))
+
+class RecordingCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        statement = ' '.join(query.split())
+        self.connection.statements.append(statement)
+        if statement.startswith('UPDATE users') and self.connection.failing_updates > 0:
+            self.connection.failing_updates -= 1
+            raise RuntimeError('connection lost during UPDATE')
+
+    def fetchone(self):
+        return (1, encrypt_token(OLD_TOKENS[0]), encrypt_token(OLD_TOKENS[1]), None)
+
+def run_refresh(connection, still_valid=lambda tokens: False):
+    """Runs refresh_tokens_single_flight on the recording connection; returns (tokens, output, refresh calls)."""
+    calls = []
+
+    def refresh(refresh_token):
+        calls.append(refresh_token)
+        return NEW_TOKENS
+
+    original_connect, original_sleep = db.connect_to_db, db.time.sleep
+    db.connect_to_db = lambda: connection
+    db.time.sleep = lambda seconds: None
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output):
+            tokens = db.refresh_tokens_single_flight(EMAIL, refresh, still_valid)
+    finally:
+        db.connect_to_db, db.time.sleep = original_connect, original_sleep
+    return tokens, output.getvalue(), calls
+
+def lock_released(connection):
+    return connection.count('SELECT pg_advisory_unlock') == 1 and connection.statements[-1] == 'CLOSE'
+
+def test_save_retried():
+    """A failed UPDATE after Fitbit accepted the refresh is retried under the lock."""
+    connection = RecordingConnection(failing_updates=2)
+    tokens, _, calls = run_refresh(connection)
+    unlock = connection.statements.index('SELECT pg_advisory_unlock(hashtext(%s));')
+    last_update = max(i for i, s in enumerate(connection.statements) if s.startswith('UPDATE users'))
+    ok = (tokens == NEW_TOKENS and calls == [OLD_TOKENS[1]]
+          and connection.count('UPDATE users') == 3 and last_update < unlock
+          and lock_released(connection))
+    logger.info(f"{'PASS' if ok else 'FAIL'} save retried before releasing the lock ({connection.count('UPDATE users')} UPDATEs)")
+    return ok
+
+def test_save_failed():
+    """If every save fails, the new refresh token is logged encrypted and still returned."""
+    connection = RecordingConnection(failing_updates=db.TOKEN_SAVE_ATTEMPTS)
+    tokens, output, _ = run_refresh(connection)
+    logged = re.search(r'para recuperarlo: (\S+)', output)
+    recovered = decrypt_token(logged.group(1)) if logged else None
+    ok = (tokens == NEW_TOKENS and recovered == NEW_TOKENS[1]
+          and connection.count('UPDATE users') == db.TOKEN_SAVE_ATTEMPTS
+          and lock_released(connection))
+    logger.info(f"{'PASS' if ok else 'FAIL'} unsaved refresh token logged for recovery ({recovered})")
+    return ok
+
+def test_still_valid():
+    """Tokens refreshed by another process are reused without calling Fitbit."""
+    connection = RecordingConnection()
+    tokens, _, calls = run_refresh(connection, still_valid=lambda tokens: True)
+    ok = (tokens[:2] == OLD_TOKENS and not calls and connection.count('UPDATE users') == 0
+          and lock_released(connection))
+    logger.info(f"{'PASS' if ok else 'FAIL'} valid tokens reused without refreshing")
+    return ok
+
+def run_all_tests():
+    results = [test_save_retried(), test_save_failed(), test_still_valid()]
+    return all(results)
+
+if __name__ == "__main__":
+    success = run_all_tests()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,243 @@
+"""
+Cliente de la API de Fitbit compartido por todos los recolectores: sesión HTTP y tokens OAuth.
+
+api_session es una única sesión de requests: las peticiones de todos los
+recolectores del proceso reutilizan las conexiones TLS con api.fitbit.com
+(keep-alive) en lugar de abrir una por petición. Además anota en rate_budget la
+cuota por usuario que Fitbit devuelve en las cabeceras Fitbit-Rate-Limit-*.
+
+Antes cada ejecución leía y descifraba los tokens de cada usuario en cada paso y
+solo los refrescaba después de que una petición fallase con 401. TokenManager:
+
+- Guarda en memoria los tokens descifrados de cada email junto con su caducidad.
+- Refresca el access token de forma proactiva cuando le quedan menos de
+  REFRESH_MARGIN (o si no se conoce su caducidad), antes de que falle ninguna
+  petición.
+- Persiste los tokens nuevos cifrados, incluida la caducidad, para que el resto
+  de procesos la conozcan.
+- Refresca en vuelo único entre procesos (db.refresh_tokens_single_flight): un
+  cerrojo consultivo por email garantiza que solo un recolector gaste el refresh
+  token, de un solo uso, y los demás reciben los tokens que ha obtenido.
+
+Uso: token_manager.get_access_token(email); tras un 401, token_manager.handle_unauthorized(email, token).
+"""
+
+import logging
+import threading
+import time
+from base64 import b64encode
+from datetime import datetime, timedelta, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import CLIENT_ID, CLIENT_SECRET, TOKEN_URL
+from db import get_user_token_record, refresh_tokens_single_flight
+
+logger = logging.getLogger(__name__)
+
+# Antelación con la que se refresca un access token antes de que caduque
+REFRESH_MARGIN = timedelta(minutes=10)
+
+# Conexiones simultáneas que mantiene abiertas la sesión compartida
+API_POOL_SIZE = 20
+
+api_session = requests.Session()
+api_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=API_POOL_SIZE))
+
+
+class RateBudget:
+    """
+    Cuota restante de la API por usuario (Fitbit limita las peticiones por usuario y hora).
+
+    Se toma de las cabeceras Fitbit-Rate-Limit-Remaining y Fitbit-Rate-Limit-Reset
+    (segundos hasta que se reinicia) de la última respuesta de cada usuario en
+    este proceso.
+    """
+
+    def __init__(self):
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def record(self, email, response):
+        remaining = response.headers.get("Fitbit-Rate-Limit-Remaining")
+        reset = response.headers.get("Fitbit-Rate-Limit-Reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            budget = (int(remaining), time.time() + int(reset))
+        except ValueError:
+            return
+        with self._lock:
+            self._budgets[email] = budget
+
+    def remaining(self, email):
+        """
+        Returns:
+            tuple: (peticiones restantes, segundos hasta el reinicio), o (None, None)
+                si no se conoce o ya se ha reiniciado.
+        """
+        with self._lock:
+            budget = self._budgets.get(email)
+        if budget is None or budget[1] <= time.time():
+            return None, None
+        return budget[0], budget[1] - time.time()
+
+
+rate_budget = RateBudget()
+
+
+def _record_rate_limit(response, *args, **kwargs):
+    # Las peticiones llevan el access token, no el email: se busca en la caché de tokens
+    authorization = response.request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        email = token_manager.email_for(authorization[len("Bearer "):])
+        if email:
+            rate_budget.record(email, response)
+
+
+api_session.hooks["response"].append(_record_rate_limit)
+
+DEVICES_URL = "https://api.fitbit.com/1/user/-/devices.json"
+
+
+def get_last_sync_time(access_token, progress=None):
+    """
+    Última sincronización de los dispositivos del usuario (la más reciente si tiene varios).
+
+    Returns:
+        datetime: Hora local del usuario, sin zona horaria, o None si no se conoce.
+
+    Raises:
+        requests.exceptions.HTTPError: Ante 401 o 429, como el resto de peticiones.
+    """
+    if progress:
+        progress.api_call()
+    response = api_session.get(DEVICES_URL, headers={"Authorization": f"Bearer {access_token}"})
+    if response.status_code in (401, 429):
+        response.raise_for_status()
+    if response.status_code != 200:
+        logger.warning(f"Respuesta {response.status_code} al pedir los dispositivos")
+        return None
+    sync_times = [
+        datetime.strptime(device["lastSyncTime"][:19], "%Y-%m-%dT%H:%M:%S")
+        for device in response.json() if device.get("lastSyncTime")
+    ]
+    return max(sync_times) if sync_times else None
+
+
+def refresh_access_token(refresh_token):
+    """
+    Refresca el access token con el refresh token (OAuth 2.0, RFC 6749).
+
+    Los refresh tokens de Fitbit son de un solo uso: tras una llamada correcta el
+    anterior deja de valer y hay que guardar el nuevo.
+
+    Returns:
+        tuple: (access_token, refresh_token, expires_at) o (None, None, None) si falla.
+    """
+    auth_header = b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
+    headers = {
+        "Authorization": f"Basic {auth_header}",
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+    data = {
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token
+    }
+    response = api_session.post(TOKEN_URL, headers=headers, data=data)
+    if response.status_code != 200:
+        logger.error(f"Error refreshing token: {response.status_code}, {response.text}")
+        return None, None, None
+    tokens = response.json()
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=tokens.get("expires_in", 28800))
+    logger.info("Token refreshed successfully")
+    return tokens.get("access_token"), tokens.get("refresh_token"), expires_at
+
+
+class TokenManager:
+    """Caché en memoria de los tokens por email con refresco proactivo."""
+
+    def __init__(self, margin=REFRESH_MARGIN):
+        self.margin = margin
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._user_locks = {}
+
+    def _user_lock(self, email):
+        with self._lock:
+            return self._user_locks.setdefault(email, threading.Lock())
+
+    def _load(self, email):
+        access_token, refresh_token, expires_at = get_user_token_record(email)
+        if not access_token or not refresh_token:
+            self._tokens.pop(email, None)
+            return None
+        self._tokens[email] = (access_token, refresh_token, expires_at)
+        return self._tokens[email]
+
+    def _expiring(self, expires_at):
+        return expires_at is None or expires_at - self.margin <= datetime.now(timezone.utc)
+
+    def _refresh(self, email, stale_access_token):
+        # Si al obtener el cerrojo la base de datos ya tiene otro token vigente, otro
+        # proceso ha refrescado mientras tanto y se usa el suyo
+        def still_valid(tokens):
+            return tokens[0] != stale_access_token and not self._expiring(tokens[2])
+        tokens = refresh_tokens_single_flight(email, refresh_access_token, still_valid)
+        if not tokens[0]:
+            self._tokens.pop(email, None)
+            logger.error(f"No se pudo refrescar el token para {email}. Es necesario vincular nuevamente el dispositivo.")
+            return None
+        self._tokens[email] = tokens
+        return tokens[0]
+
+    def get_access_token(self, email):
+        """
+        Devuelve un access token válido para el email, refrescándolo si está a punto de caducar.
+
+        Returns:
+            str: Access token, o None si el usuario no tiene tokens o no se pudo refrescar.
+        """
+        with self._user_lock(email):
+            tokens = self._tokens.get(email) or self._load(email)
+            if tokens is None:
+                return None
+            access_token, refresh_token, expires_at = tokens
+            if self._expiring(expires_at):
+                logger.info(f"Token de {email} caducado o a punto de caducar; refrescando")
+                return self._refresh(email, access_token)
+            return access_token
+
+    def handle_unauthorized(self, email, access_token):
+        """
+        Obtiene un token nuevo tras un 401 con access_token.
+
+        Si en la base de datos ya hay otro token (lo ha refrescado otro proceso) se
+        usa ese; si no, se refresca.
+
+        Returns:
+            str: Access token nuevo, o None si no se pudo obtener.
+        """
+        with self._user_lock(email):
+            logger.warning(f"Token rechazado para {email}. Intentando refrescar el token...")
+            return self._refresh(email, access_token)
+
+    def email_for(self, access_token):
+        """Email al que pertenece un access token en caché, o None."""
+        for email, tokens in list(self._tokens.items()):
+            if tokens[0] == access_token:
+                return email
+        return None
+
+    def invalidate(self, email=None):
+        """Olvida los tokens en caché de un email (o de todos)."""
+        with self._lock:
+            if email is None:
+                self._tokens.clear()
+            else:
+                self._tokens.pop(email, None)
+
+
+# Instancia compartida por los recolectores del proceso
+token_manager = TokenManager()
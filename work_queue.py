@@ -0,0 +1,482 @@
+"""
+Cola de trabajo de ingesta en PostgreSQL para varios trabajadores concurrentes.
+
+Cada trabajo es una unidad (email, flujo, rango de fechas, prioridad) en la
+tabla ingestion_jobs. Cualquier número de procesos trabajadores, en cualquier
+número de máquinas, reclaman trabajos con SELECT ... FOR UPDATE SKIP LOCKED:
+cada fila pendiente la toma un único trabajador y los demás la saltan sin
+esperar, así que nunca se descarga dos veces lo mismo.
+
+- Al reclamar un trabajo se le asigna un arrendamiento (lease) de LEASE_SECONDS
+  que el trabajador renueva mientras lo ejecuta. Si el trabajador se cae, el
+  arrendamiento caduca y otro trabajador recupera el trabajo.
+- Los fallos se reintentan con espera creciente hasta max_attempts; un 429
+  (límite de la API por hora) devuelve el trabajo a la cola hasta la hora
+  siguiente sin consumir intento.
+- Los trabajos abiertos (pendientes o en curso) son únicos por (email, flujo,
+  rango), de modo que encolar dos veces lo mismo no crea duplicados.
+- Los recolectores por rango (fitbit.collect_daily_range,
+  fitbit_intraday.collect_intraday_range) son idempotentes: repetir un trabajo
+  recuperado no duplica datos.
+
+Planificación con prioridad a lo reciente (schedule_fresh, schedule_backfill):
+los últimos días de cada usuario se encolan con PRIORITY_HIGH en cada ciclo, de
+modo que paneles y alertas están al día aunque haya rellenos en marcha. El
+histórico se rellena hacia atrás, del día más nuevo al más antiguo, en tramos de
+BACKFILL_CHUNK_DAYS con un solo tramo abierto por usuario y flujo, y un tramo
+solo se ejecuta si el usuario conserva más de BACKFILL_RESERVE_CALLS peticiones
+de su cuota horaria (si no, espera al reinicio de la cuota).
+
+Dispositivos recién vinculados (enqueue_device_backfill): sus últimos
+ONBOARDING_DAYS días se encolan de golpe con PRIORITY_ONBOARDING, en tramos que
+los trabajadores descargan en paralelo con la misma reserva de cuota, y el
+relleno histórico continúa desde ahí.
+
+Uso:
+    python work_queue.py worker
+    python work_queue.py enqueue <daily|intraday|alerts> <YYYY-MM-DD> <YYYY-MM-DD> [email ...]
+"""
+
+import logging
+import os
+import socket
+import sys
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import requests
+
+from db import DatabaseManager, get_unique_emails, get_latest_user_id_by_email
+from tokens import rate_budget
+
+logger = logging.getLogger(__name__)
+
+# Flujos de datos que sabe ejecutar un trabajador
+STREAM_DAILY = 'daily'
+STREAM_INTRADAY = 'intraday'
+STREAM_ALERTS = 'alerts'    # Reglas de alerta y calidad de datos de cada día del rango
+STREAMS = (STREAM_DAILY, STREAM_INTRADAY, STREAM_ALERTS)
+
+# Estados de un trabajo
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# Prioridades habituales (mayor = antes)
+PRIORITY_BACKFILL = 0
+PRIORITY_NORMAL = 50
+PRIORITY_ONBOARDING = 75    # Histórico reciente de un dispositivo recién vinculado
+PRIORITY_HIGH = 100
+
+# Duración del arrendamiento de un trabajo; se renueva cada LEASE_SECONDS / 3
+LEASE_SECONDS = int(os.getenv("WORK_QUEUE_LEASE_SECONDS", "600"))
+# Espera del trabajador cuando no hay trabajos pendientes
+IDLE_SECONDS = int(os.getenv("WORK_QUEUE_IDLE_SECONDS", "30"))
+# Espera base entre reintentos tras un error (se multiplica por el número de intento)
+RETRY_SECONDS = 300
+# Días por trabajo de relleno histórico
+BACKFILL_CHUNK_DAYS = int(os.getenv("BACKFILL_CHUNK_DAYS", "3"))
+# Peticiones de la cuota horaria de cada usuario reservadas para los datos recientes
+BACKFILL_RESERVE_CALLS = int(os.getenv("BACKFILL_RESERVE_CALLS", "60"))
+# Días que se descargan al vincular un dispositivo y días por trabajo
+ONBOARDING_DAYS = int(os.getenv("ONBOARDING_DAYS", "30"))
+ONBOARDING_CHUNK_DAYS = int(os.getenv("ONBOARDING_CHUNK_DAYS", "5"))
+
+
+def date_chunks(start_date, end_date, days):
+    """Divide [start_date, end_date] en tramos de days días, del más nuevo al más antiguo."""
+    chunks = []
+    chunk_end = end_date
+    while chunk_end >= start_date:
+        chunk_start = max(start_date, chunk_end - timedelta(days=days - 1))
+        chunks.append((chunk_start, chunk_end))
+        chunk_end = chunk_start - timedelta(days=1)
+    return chunks
+
+
+def run_stream(stream, email, start_date, end_date, progress=None):
+    """Ejecuta un trabajo con el recolector por rango de su flujo."""
+    # Importaciones diferidas: los recolectores configuran su propio logging
+    if stream == STREAM_DAILY:
+        from fitbit import collect_daily_range
+        return collect_daily_range(email, start_date, end_date, progress)
+    if stream == STREAM_INTRADAY:
+        from fitbit_intraday import collect_intraday_range
+        return collect_intraday_range(email, start_date, end_date, progress)
+    if stream == STREAM_ALERTS:
+        from alert_rules import evaluate_all_alerts
+        from fitbit import check_data_quality
+        user_id = get_latest_user_id_by_email(email)
+        if not user_id:
+            raise RuntimeError(f"No se encontró user_id para el email {email}")
+        day = start_date
+        while day <= end_date:
+            current_date = datetime.combine(day, datetime.min.time())
+            evaluate_all_alerts(user_id, current_date)
+            check_data_quality(user_id, current_date)
+            day += timedelta(days=1)
+        return None
+    raise ValueError(f"Flujo de ingesta desconocido: {stream}")
+
+
+class IngestionJob:
+    """Trabajo reclamado de la cola."""
+
+    def __init__(self, id, email, stream, start_date, end_date, priority, attempts):
+        self.id = id
+        self.email = email
+        self.stream = stream
+        self.start_date = start_date
+        self.end_date = end_date
+        self.priority = priority
+        self.attempts = attempts
+
+    def __repr__(self):
+        return f"<IngestionJob {self.id} {self.stream} {self.email} {self.start_date}..{self.end_date}>"
+
+
+class WorkQueue:
+    """Operaciones sobre la tabla ingestion_jobs con una conexión propia."""
+
+    def __init__(self, db=None):
+        self.db = db or DatabaseManager()
+        if self.db.connection is None:
+            self.db.connect()
+
+    def close(self):
+        self.db.close()
+
+    def enqueue(self, email, stream, start_date, end_date, priority=PRIORITY_NORMAL, not_before=None, once=False):
+        """
+        Encola un trabajo. Si ya hay uno abierto igual, no se crea otro.
+
+        Args:
+            once (bool): Tampoco encolarlo si ya se completó (p. ej. evaluar las alertas
+                de un día, que inserta alertas nuevas cada vez).
+
+        Returns:
+            int: ID del trabajo creado, o None si ya existía.
+        """
+        if stream not in STREAMS:
+            raise ValueError(f"Flujo de ingesta desconocido: {stream}")
+        result = self.db.execute_query("""
+            INSERT INTO ingestion_jobs (email, stream, start_date, end_date, priority, not_before)
+            SELECT %(email)s, %(stream)s, %(start)s, %(end)s, %(priority)s, COALESCE(%(not_before)s, NOW())
+            WHERE NOT %(once)s OR NOT EXISTS (
+                SELECT 1 FROM ingestion_jobs
+                WHERE email = %(email)s AND stream = %(stream)s
+                AND start_date = %(start)s AND end_date = %(end)s AND status = 'done'
+            )
+            ON CONFLICT (email, stream, start_date, end_date) WHERE status IN ('pending', 'running')
+            DO NOTHING
+            RETURNING id
+        """, {'email': email, 'stream': stream, 'start': start_date, 'end': end_date,
+              'priority': priority, 'not_before': not_before, 'once': once})
+        return result[0][0] if result else None
+
+    def schedule_fresh(self, email, stream, today, days):
+        """
+        Encola con PRIORITY_HIGH los últimos days días (hasta today) de un email.
+
+        Si desde la última vez la ventana ha avanzado más allá de días que no
+        llegaron a cerrarse (el día anterior al pasar la medianoche, o varios si el
+        planificador ha estado parado), esos días se encolan también una vez más,
+        con PRIORITY_NORMAL. La primera vez, el relleno histórico del email empieza
+        justo antes de la ventana.
+        """
+        window_start = today - timedelta(days=days - 1)
+        result = self.db.execute_query("""
+            WITH previous AS (
+                SELECT fresh_through FROM ingestion_frontier
+                WHERE email = %(email)s AND stream = %(stream)s
+                FOR UPDATE
+            )
+            INSERT INTO ingestion_frontier (email, stream, fresh_through, backfill_next)
+            VALUES (%(email)s, %(stream)s, %(today)s, %(backfill_next)s)
+            ON CONFLICT (email, stream) DO UPDATE
+            SET fresh_through = GREATEST(ingestion_frontier.fresh_through, EXCLUDED.fresh_through),
+                updated_at = NOW()
+            RETURNING (SELECT fresh_through FROM previous)
+        """, {'email': email, 'stream': stream, 'today': today,
+              'backfill_next': window_start - timedelta(days=1)})
+        previous = result[0][0] if result else None
+        if previous is not None and previous < window_start:
+            for chunk_start, chunk_end in date_chunks(previous, window_start - timedelta(days=1),
+                                                      BACKFILL_CHUNK_DAYS):
+                self.enqueue(email, stream, chunk_start, chunk_end, PRIORITY_NORMAL)
+        return self.enqueue(email, stream, window_start, today, PRIORITY_HIGH)
+
+    def schedule_backfill(self, email, stream, start_date):
+        """
+        Encola el siguiente tramo del relleno histórico de un email (hacia atrás,
+        hasta start_date) si no tiene ya uno abierto.
+
+        Returns:
+            int: ID del trabajo creado, o None si no tocaba o el relleno ha terminado.
+        """
+        result = self.db.execute_query("""
+            UPDATE ingestion_frontier f
+            SET backfill_next = c.chunk_start - 1, updated_at = NOW()
+            FROM (
+                SELECT email, stream, backfill_next AS chunk_end,
+                       GREATEST(%(start)s::date, backfill_next - %(days)s + 1) AS chunk_start
+                FROM ingestion_frontier
+                WHERE email = %(email)s AND stream = %(stream)s AND backfill_next >= %(start)s
+                AND NOT EXISTS (
+                    SELECT 1 FROM ingestion_jobs
+                    WHERE email = %(email)s AND stream = %(stream)s
+                    AND priority <= %(priority)s AND status IN ('pending', 'running')
+                )
+                FOR UPDATE
+            ) c
+            WHERE f.email = c.email AND f.stream = c.stream
+            RETURNING c.chunk_start, c.chunk_end
+        """, {'email': email, 'stream': stream, 'start': start_date,
+              'days': BACKFILL_CHUNK_DAYS, 'priority': PRIORITY_BACKFILL})
+        if not result:
+            return None
+        chunk_start, chunk_end = result[0]
+        return self.enqueue(email, stream, chunk_start, chunk_end, PRIORITY_BACKFILL)
+
+    def schedule_onboarding(self, email, today, streams, days=ONBOARDING_DAYS):
+        """
+        Encola los últimos days días (hasta today) de un email recién vinculado, en
+        tramos de ONBOARDING_CHUNK_DAYS con PRIORITY_ONBOARDING, y reinicia su
+        relleno histórico justo antes de esos días.
+
+        El email puede haber tenido otro usuario (reasignación): sus datos son de
+        otro user_id, así que el relleno empieza de nuevo.
+
+        Returns:
+            list: IDs de los trabajos creados.
+        """
+        start_date = today - timedelta(days=days - 1)
+        for stream in streams:
+            self.db.execute_query("""
+                INSERT INTO ingestion_frontier (email, stream, fresh_through, backfill_next)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (email, stream) DO UPDATE
+                SET fresh_through = EXCLUDED.fresh_through,
+                    backfill_next = EXCLUDED.backfill_next,
+                    updated_at = NOW()
+            """, (email, stream, today, start_date - timedelta(days=1)))
+        job_ids = []
+        # Del tramo más nuevo al más antiguo, alternando flujos: a igual prioridad se
+        # reclaman por orden de creación
+        for chunk_start, chunk_end in date_chunks(start_date, today, ONBOARDING_CHUNK_DAYS):
+            for stream in streams:
+                job_id = self.enqueue(email, stream, chunk_start, chunk_end, PRIORITY_ONBOARDING)
+                if job_id:
+                    job_ids.append(job_id)
+        return job_ids
+
+    def claim(self, worker_id, lease_seconds=LEASE_SECONDS):
+        """
+        Reclama el trabajo disponible de mayor prioridad (más antiguo a igual prioridad).
+
+        Son reclamables los pendientes cuyo not_before ha pasado y los que están en
+        curso con el arrendamiento caducado (su trabajador se ha caído). Los que
+        agotan sus intentos así pasan a fallidos.
+
+        Returns:
+            IngestionJob: El trabajo reclamado, o None si no hay ninguno.
+        """
+        self.db.execute_query("""
+            UPDATE ingestion_jobs
+            SET status = 'failed', finished_at = NOW(),
+                last_error = COALESCE(last_error, 'Arrendamiento caducado')
+            WHERE status = 'running' AND lease_expires_at < NOW() AND attempts >= max_attempts
+        """)
+        result = self.db.execute_query("""
+            UPDATE ingestion_jobs
+            SET status = 'running', leased_by = %s, attempts = attempts + 1,
+                lease_expires_at = NOW() + make_interval(secs => %s)
+            WHERE id = (
+                SELECT id FROM ingestion_jobs
+                WHERE (status = 'pending' AND not_before <= NOW())
+                   OR (status = 'running' AND lease_expires_at < NOW())
+                ORDER BY priority DESC, created_at
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, email, stream, start_date, end_date, priority, attempts
+        """, (worker_id, lease_seconds))
+        return IngestionJob(*result[0]) if result else None
+
+    def extend_lease(self, job_id, worker_id, lease_seconds=LEASE_SECONDS):
+        """Renueva el arrendamiento. Devuelve False si el trabajo ya no es de este trabajador."""
+        result = self.db.execute_query("""
+            UPDATE ingestion_jobs SET lease_expires_at = NOW() + make_interval(secs => %s)
+            WHERE id = %s AND leased_by = %s AND status = 'running'
+            RETURNING id
+        """, (lease_seconds, job_id, worker_id))
+        return bool(result)
+
+    def complete(self, job_id, worker_id):
+        """Marca el trabajo como terminado (solo si sigue arrendado por este trabajador)."""
+        return bool(self.db.execute_query("""
+            UPDATE ingestion_jobs
+            SET status = 'done', finished_at = NOW(), lease_expires_at = NULL, last_error = NULL
+            WHERE id = %s AND leased_by = %s AND status = 'running'
+            RETURNING id
+        """, (job_id, worker_id)))
+
+    def retry_later(self, job_id, worker_id, delay, error, count_attempt=True):
+        """
+        Devuelve el trabajo a la cola para dentro de delay, o lo marca como fallido si
+        ha agotado sus intentos.
+
+        Args:
+            count_attempt (bool): Si es False (p. ej. un 429) no consume intento.
+        """
+        return bool(self.db.execute_query("""
+            UPDATE ingestion_jobs
+            SET attempts = attempts - CASE WHEN %s THEN 0 ELSE 1 END,
+                status = CASE WHEN %s AND attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                finished_at = CASE WHEN %s AND attempts >= max_attempts THEN NOW() END,
+                not_before = NOW() + %s,
+                lease_expires_at = NULL,
+                last_error = %s
+            WHERE id = %s AND leased_by = %s AND status = 'running'
+            RETURNING id
+        """, (count_attempt, count_attempt, count_attempt, delay, str(error)[:1000], job_id, worker_id)))
+
+    def counts(self):
+        """Número de trabajos por estado."""
+        rows = self.db.execute_query("SELECT status, COUNT(*) FROM ingestion_jobs GROUP BY status") or []
+        return dict(rows)
+
+    def purge_finished(self, older_than_days=7):
+        """Borra los trabajos terminados o fallidos de hace más de older_than_days días."""
+        return self.db.execute_query("""
+            DELETE FROM ingestion_jobs
+            WHERE status IN ('done', 'failed') AND finished_at < NOW() - make_interval(days => %s)
+        """, (older_than_days,))
+
+
+def enqueue_device_backfill(email, today=None):
+    """
+    Encola el relleno inicial de un dispositivo recién vinculado (ver
+    WorkQueue.schedule_onboarding) para que su panel tenga datos en minutos en
+    lugar de esperar a que le llegue el turno al relleno histórico.
+
+    Returns:
+        list: IDs de los trabajos creados.
+    """
+    queue = WorkQueue()
+    try:
+        return queue.schedule_onboarding(email, today or datetime.now().date(), (STREAM_DAILY, STREAM_INTRADAY))
+    finally:
+        queue.close()
+
+
+def _seconds_to_next_hour():
+    now = datetime.now()
+    return (now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1) - now).total_seconds() + 60
+
+
+class Worker:
+    """
+    Proceso trabajador: reclama trabajos, los ejecuta y renueva su arrendamiento
+    en un hilo aparte mientras tanto.
+    """
+
+    def __init__(self, worker_id=None, lease_seconds=LEASE_SECONDS, idle_seconds=IDLE_SECONDS):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.idle_seconds = idle_seconds
+        self.queue = WorkQueue()
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def _heartbeat(self, job, done):
+        # Conexión propia: la del hilo principal está ocupada ejecutando el trabajo
+        queue = WorkQueue()
+        try:
+            while not done.wait(self.lease_seconds / 3):
+                if not queue.extend_lease(job.id, self.worker_id, self.lease_seconds):
+                    logger.warning(f"{job} ya no está arrendado por {self.worker_id}")
+                    return
+        finally:
+            queue.close()
+
+    def _postpone_backfill(self, job):
+        # Los rellenos (histórico e inicial) solo gastan la cuota que no hace falta
+        # para los datos recientes
+        if job.priority not in (PRIORITY_BACKFILL, PRIORITY_ONBOARDING):
+            return False
+        remaining, reset_seconds = rate_budget.remaining(job.email)
+        if remaining is None or remaining > BACKFILL_RESERVE_CALLS:
+            return False
+        logger.info(f"{job} aplazado: a {job.email} le quedan {remaining} peticiones esta hora")
+        self.queue.retry_later(job.id, self.worker_id, timedelta(seconds=reset_seconds + 60),
+                               "Cuota reservada para los datos recientes", count_attempt=False)
+        return True
+
+    def run_job(self, job):
+        """Ejecuta un trabajo reclamado y registra su resultado en la cola."""
+        if self._postpone_backfill(job):
+            return False
+        logger.info(f"{self.worker_id} ejecuta {job} (intento {job.attempts})")
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, done), daemon=True)
+        heartbeat.start()
+        try:
+            run_stream(job.stream, job.email, job.start_date, job.end_date)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 429:
+                # El límite de Fitbit se reinicia cada hora: no cuenta como intento
+                logger.warning(f"Rate limit en {job}; vuelve a la cola hasta la próxima hora")
+                self.queue.retry_later(job.id, self.worker_id, timedelta(seconds=_seconds_to_next_hour()),
+                                       e, count_attempt=False)
+            else:
+                logger.error(f"Error HTTP en {job}: {e}")
+                self.queue.retry_later(job.id, self.worker_id, timedelta(seconds=RETRY_SECONDS * job.attempts), e)
+            return False
+        except Exception as e:
+            logger.error(f"Error en {job}: {e}", exc_info=True)
+            self.queue.retry_later(job.id, self.worker_id, timedelta(seconds=RETRY_SECONDS * job.attempts), e)
+            return False
+        finally:
+            done.set()
+            heartbeat.join()
+        self.queue.complete(job.id, self.worker_id)
+        logger.info(f"{job} terminado")
+        return True
+
+    def run(self):
+        """Bucle principal hasta stop()."""
+        logger.info(f"Trabajador {self.worker_id} iniciado")
+        try:
+            while not self._stop.is_set():
+                job = self.queue.claim(self.worker_id, self.lease_seconds)
+                if job is None:
+                    self._stop.wait(self.idle_seconds)
+                    continue
+                self.run_job(job)
+        finally:
+            self.queue.close()
+            logger.info(f"Trabajador {self.worker_id} detenido")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    command = sys.argv[1] if len(sys.argv) > 1 else 'worker'
+    if command == 'worker':
+        Worker().run()
+    elif command == 'enqueue' and len(sys.argv) >= 5:
+        stream = sys.argv[2]
+        start = datetime.strptime(sys.argv[3], "%Y-%m-%d").date()
+        end = datetime.strptime(sys.argv[4], "%Y-%m-%d").date()
+        queue = WorkQueue()
+        for email in (sys.argv[5:] or get_unique_emails()):
+            job_id = queue.enqueue(email, stream, start, end)
+            print(f"{email}: {'trabajo ' + str(job_id) if job_id else 'ya estaba en la cola'}")
+        queue.close()
+    else:
+        print(__doc__)
+        sys.exit(1)